@@ -11,30 +11,46 @@
 #---------------------------------------------------------------------
 
 import os
+import sys
+import time
 
-from qgis.PyQt.QtGui import *
-from qgis.PyQt.QtWidgets import QAction
-from .config_dialog import ConfigDialog
+# only the minimum is imported when QGIS starts - dialogs, their UI and psycopg2 are loaded on the first run();
+# nothing from Qt is imported here, so that the command line tools (python -m ...) work without QGIS
 
 this_dir = os.path.dirname(__file__)
 
 def classFactory(iface):
     return PostGIS_SamplingToolPlugin(iface)
 
+def log_timing(message, start):
+    """Logs duration since start (from time.perf_counter()) to the plugin's tab of QGIS message log"""
+    from qgis.core import QgsMessageLog, Qgis
+    QgsMessageLog.logMessage("%s: %.1f ms" % (message, (time.perf_counter() - start) * 1000),
+                             "PostGIS Sampling Tool", Qgis.Info)
+
 class PostGIS_SamplingToolPlugin:
     def __init__(self, iface):
         self.iface = iface
 
     def initGui(self):
+        from qgis.PyQt.QtGui import QIcon
+        from qgis.PyQt.QtWidgets import QAction
+
+        start = time.perf_counter()
         self.action = QAction(QIcon(os.path.join(this_dir, 'icon.svg')), u'Configure PostGIS Sampling Tool', self.iface.mainWindow())
         self.action.triggered.connect(self.run)
         self.iface.addToolBarIcon(self.action)
+        log_timing("Plugin initialized", start)
 
     def unload(self):
         self.iface.removeToolBarIcon(self.action)
         del self.action
 
     def run(self):
+        start = time.perf_counter()
+        first_run = __name__ + '.config_dialog' not in sys.modules
+        from .config_dialog import ConfigDialog
+        if first_run:
+            log_timing("Dialogs loaded", start)
         dlg = ConfigDialog()
         dlg.exec_()
-
@@ -0,0 +1,192 @@
+# encoding: utf-8
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+"""
+Backfill (full resync) of target rows of a trigger pair.
+
+Triggers only react to future edits, so the existing rows of the target table need to be
+sampled once after a trigger pair is created. The target table is processed in chunks given by
+ranges of its integer primary key, every chunk is committed separately (short locks) and marked
+as done in the backfill table, so an interrupted backfill continues where it stopped.
+Chunks can be processed by several connections in parallel - the work is done by the database
+server, so threads are sufficient.
+
+It does not need QGIS GUI, it can be started from the directory containing the plugin:
+
+  python -m postgis_sampling_tool.backfill --dsn "host=localhost dbname=gis" --trigger 3 --workers 4
+"""
+
+import argparse
+import queue
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import psycopg2
+
+from .sql_generator import load_sql_generator, get_primary_key, backfill_table
+
+
+def backfill_table_sql():
+    """Returns SQL creating the table with finished chunks (if it does not exist yet)"""
+    return """
+        CREATE TABLE IF NOT EXISTS %(backfill_table)s (
+            trg_fcn_id integer NOT NULL,
+            chunk_start bigint NOT NULL,
+            done_at timestamptz NOT NULL DEFAULT now(),
+            PRIMARY KEY (trg_fcn_id, chunk_start)
+        );
+        """ % {'backfill_table': backfill_table}
+
+
+def plan_chunks(conn, sql_gen, chunk_size, resume=True):
+    """Returns tuple (key column, list of (start, end) ranges still to be processed, total number of chunks).
+    Without an integer primary key the whole table is one chunk."""
+    cur = conn.cursor()
+    cur.execute(backfill_table_sql())
+    if not resume:
+        cur.execute("DELETE FROM %s WHERE trg_fcn_id = %%s" % backfill_table, (sql_gen.trg_fcn_id,))
+    conn.commit()
+
+    key_column = get_primary_key(conn, sql_gen.target_table)
+    if key_column is None:
+        return None, [(None, None)], 1
+
+    cur.execute("SELECT min(%s), max(%s) FROM %s" % (key_column, key_column, sql_gen.target_table))
+    key_min, key_max = cur.fetchone()
+    if key_min is None:
+        return key_column, [], 0   # empty table
+
+    cur.execute("SELECT chunk_start FROM %s WHERE trg_fcn_id = %%s" % backfill_table, (sql_gen.trg_fcn_id,))
+    done = set(row[0] for row in cur.fetchall())
+    conn.commit()
+
+    chunks = [(start, start + chunk_size) for start in range(key_min, key_max + 1, chunk_size)]
+    return key_column, [chunk for chunk in chunks if chunk[0] not in done], len(chunks)
+
+
+def backfill(connect, trigger_id, chunk_size=50000, workers=1, resume=True, progress=None, should_stop=None,
+             target_columns=None, connections=None):
+    """Re-samples all rows of the target table of the trigger pair (only the given target columns if set,
+    e.g. after their mapping has been edited).
+
+    connect is a callable returning a new psycopg2 connection - one is opened for each worker
+    (always from the calling thread). Instead, a list of already open connections can be passed
+    in connections (one per worker) - they are left open, so that another thread can interrupt
+    running chunks with their cancel().
+    progress(done, total) is called from the calling thread after each finished chunk, afterwards
+    the backfill stops early (and can be resumed later) if should_stop() returns True.
+    Returns True if the whole table has been processed.
+    """
+    conn = connections[0] if connections else connect()
+    try:
+        sql_gen = load_sql_generator(conn, trigger_id)
+        if sql_gen is None:
+            raise ValueError("Cannot load configuration of trigger %d" % trigger_id)
+        key_column, chunks, total = plan_chunks(conn, sql_gen, chunk_size, resume)
+    finally:
+        if not connections:
+            conn.close()
+
+    sql = sql_gen.backfill_sql(key_column, target_columns)
+
+    # connections are opened here in the calling thread and shared by the workers through a queue
+    if connections:
+        workers = len(connections)
+        worker_connections = connections[:len(chunks)]
+    else:
+        worker_connections = [connect() for i in range(min(max(1, workers), len(chunks)))]
+    pool = queue.Queue()
+    for c in worker_connections:
+        pool.put(c)
+
+    def run_chunk(start, end):
+        c = pool.get()
+        try:
+            cur = c.cursor()
+            cur.execute(sql, {'start': start, 'end': end})
+            if start is not None:
+                cur.execute("INSERT INTO %s (trg_fcn_id, chunk_start) VALUES (%%s, %%s)" % backfill_table,
+                            (trigger_id, start))
+            c.commit()
+        except Exception:
+            c.rollback()
+            raise
+        finally:
+            pool.put(c)
+
+    done = total - len(chunks)
+    if progress is not None:
+        progress(done, total)
+
+    finished = True
+    executor = ThreadPoolExecutor(max_workers=max(1, workers))
+    futures = [executor.submit(run_chunk, start, end) for start, end in chunks]
+    try:
+        for future in as_completed(futures):
+            if future.cancelled():
+                finished = False
+                continue
+            future.result()
+            done += 1
+            if progress is not None:
+                progress(done, total)
+            if should_stop is not None and should_stop():
+                finished = False
+                for f in futures:
+                    f.cancel()
+    except BaseException:
+        # e.g. KeyboardInterrupt - do not start any other chunks, finished chunks are kept
+        for f in futures:
+            f.cancel()
+        raise
+    finally:
+        executor.shutdown(wait=True)
+        if not connections:
+            for c in worker_connections:
+                c.close()
+
+    if finished:
+        # the next resync should process the whole table again
+        conn = connections[0] if connections else connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM %s WHERE trg_fcn_id = %%s" % backfill_table, (trigger_id,))
+            conn.commit()
+        finally:
+            if not connections:
+                conn.close()
+    return finished
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Backfill of target rows of a PostGIS Sampling Tool trigger pair")
+    parser.add_argument("--dsn", required=True, help="libpq connection string")
+    parser.add_argument("--trigger", type=int, required=True, help="ID of the trigger pair")
+    parser.add_argument("--chunk-size", type=int, default=50000, help="number of primary key values in one chunk")
+    parser.add_argument("--workers", type=int, default=1, help="number of parallel connections")
+    parser.add_argument("--restart", action="store_true", help="ignore progress of an interrupted backfill")
+    parser.add_argument("--columns", help="comma-separated target columns to re-sample (default: all mapped columns)")
+    args = parser.parse_args(argv)
+
+    def progress(done, total):
+        sys.stderr.write("\r%d / %d chunks" % (done, total))
+
+    try:
+        backfill(lambda: psycopg2.connect(args.dsn), args.trigger, args.chunk_size, args.workers,
+                 not args.restart, progress, target_columns=args.columns.split(',') if args.columns else None)
+    except KeyboardInterrupt:
+        sys.stderr.write("\ninterrupted - run again to resume\n")
+        return 1
+    sys.stderr.write("\n")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
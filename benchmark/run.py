@@ -0,0 +1,337 @@
+# encoding: utf-8
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+"""
+Benchmark of the generated triggers.
+
+Starts a throwaway PostgreSQL cluster (initdb and pg_ctl of the installed PostgreSQL with PostGIS,
+found in PATH or by pg_config) unless an existing database is given with --dsn, generates a grid
+of source polygons and random target points or lines, and for each trigger mode times edits
+of both layers: single-row updates, bulk INSERT / UPDATE / DELETE and COPY. The same edits are
+timed without triggers as a baseline. In the deferred mode, draining of the queue by the worker
+is timed as another scenario. Random data are seeded, so every mode runs on the same tables.
+Results are written as JSON:
+
+  python -m postgis_sampling_tool.benchmark.run --scale 100000 --modes row,statement -o results.json
+
+The data are created in the "dsp_bench" schema, which is dropped at the end.
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import psycopg2
+
+from ..queue_worker import process_batch
+from ..sql_generator import SqlGenerator, init_registry, new_trigger_id, generator_version, predicates
+
+schema = 'dsp_bench'
+cell_size = 1000.0  # size of the source polygons
+seed = 0.5  # seed of random() in the database (setseed) and of Python's generator
+
+
+class TemporaryCluster:
+    """ PostgreSQL cluster in a temporary directory, removed when stopped """
+
+    def __init__(self, bindir=None):
+        self.bindir = bindir or _find_bindir()
+        self.data_dir = tempfile.mkdtemp(prefix='dsp_bench_')
+        self.port = _free_port()
+
+    def _run(self, program, *args):
+        subprocess.run([os.path.join(self.bindir, program)] + list(args), check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    def start(self):
+        data = os.path.join(self.data_dir, 'data')
+        self._run('initdb', '-D', data, '-U', 'postgres', '-A', 'trust', '-E', 'UTF8')
+        self._run('pg_ctl', '-D', data, '-w', '-l', os.path.join(self.data_dir, 'log'), '-o',
+                  "-p %d -k %s -c listen_addresses='' -c fsync=off" % (self.port, self.data_dir), 'start')
+        return "host=%s port=%d user=postgres dbname=postgres" % (self.data_dir, self.port)
+
+    def stop(self):
+        try:
+            self._run('pg_ctl', '-D', os.path.join(self.data_dir, 'data'), '-w', '-m', 'immediate', 'stop')
+        finally:
+            shutil.rmtree(self.data_dir, ignore_errors=True)
+
+
+def _find_bindir():
+    initdb = shutil.which('initdb')
+    if initdb:
+        return os.path.dirname(initdb)
+    try:
+        return subprocess.check_output(['pg_config', '--bindir']).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        raise RuntimeError("initdb not found - add PostgreSQL binaries to PATH or use --dsn")
+
+
+def _free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def create_data(conn, sources, targets, target_type, srid=3857):
+    """Creates source polygons in a square grid and random target points or lines in the same extent"""
+    side = max(1, int(round(sources ** 0.5)))
+    extent = side * cell_size
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE EXTENSION IF NOT EXISTS postgis;
+        DROP SCHEMA IF EXISTS %(schema)s CASCADE;
+        CREATE SCHEMA %(schema)s;
+        CREATE TABLE %(schema)s.source (id serial PRIMARY KEY, code integer, geom geometry(Polygon, %(srid)d));
+        CREATE TABLE %(schema)s.target (id serial PRIMARY KEY, code integer, geom geometry(%(target_type)s, %(srid)d));
+
+        INSERT INTO %(schema)s.source (code, geom)
+        SELECT x * %(side)d + y, ST_MakeEnvelope(x * %(cell)s, y * %(cell)s, (x + 1) * %(cell)s, (y + 1) * %(cell)s, %(srid)d)
+        FROM generate_series(0, %(side)d - 1) x, generate_series(0, %(side)d - 1) y;
+        CREATE INDEX ON %(schema)s.source USING gist (geom);
+        CREATE INDEX ON %(schema)s.target USING gist (geom);
+        """ % {'schema': schema, 'srid': srid, 'target_type': target_type, 'side': side, 'cell': cell_size})
+    _set_seed(conn)
+    cur.execute(_insert_targets_sql(target_type, srid, extent), {'count': targets})
+    cur.execute("ANALYZE %s.source; ANALYZE %s.target;" % (schema, schema))
+    conn.commit()
+    return extent
+
+
+def _set_seed(conn):
+    """Seeds random() of the session, so that the generated targets are the same in every run"""
+    cur = conn.cursor()
+    cur.execute("SELECT setseed(%s)", (seed,))
+
+
+def _insert_targets_sql(target_type, srid, extent):
+    if target_type == 'Point':
+        geom = "ST_SetSRID(ST_MakePoint(random() * %(extent)s, random() * %(extent)s), %(srid)d)"
+    else:
+        geom = ("ST_SetSRID(ST_MakeLine(ST_MakePoint(x, y), ST_MakePoint(x + random() * 200, y + random() * 200)), %(srid)d) "
+                "FROM (SELECT random() * %(extent)s AS x, random() * %(extent)s AS y")
+    sql = "INSERT INTO %s.target (geom) SELECT " % schema + geom % {'extent': extent, 'srid': srid}
+    if target_type == 'Point':
+        return sql + " FROM generate_series(1, %(count)s)"
+    return sql + " FROM generate_series(1, %(count)s)) p"
+
+
+def _insert_sources_sql(srid, extent):
+    """Returns SQL inserting %(count)s source polygons (half of a cell) at random positions, overlapping the grid"""
+    return """INSERT INTO %(schema)s.source (code, geom)
+        SELECT (random() * 1000000)::integer, ST_MakeEnvelope(x, y, x + %(size)s, y + %(size)s, %(srid)d)
+        FROM (SELECT random() * %(extent)s AS x, random() * %(extent)s AS y FROM generate_series(1, %%(count)s)) p""" % {
+        'schema': schema, 'size': cell_size / 2, 'srid': srid, 'extent': extent}
+
+
+def _copy(conn, table, columns, lines):
+    """Loads the lines (tab-separated values of the columns) by COPY, returns elapsed time"""
+    data = io.StringIO("".join(line + "\n" for line in lines))
+    cur = conn.cursor()
+    start = time.perf_counter()
+    cur.copy_expert("COPY %s.%s (%s) FROM STDIN" % (schema, table, ", ".join(columns)), data)
+    conn.commit()
+    return time.perf_counter() - start
+
+
+def _copy_targets(conn, rows, target_type, extent, srid=3857):
+    """Loads rows of random targets by COPY, returns elapsed time"""
+    lines = []
+    for i in range(rows):
+        x, y = random.random() * extent, random.random() * extent
+        if target_type == 'Point':
+            wkt = "POINT(%f %f)" % (x, y)
+        else:
+            wkt = "LINESTRING(%f %f,%f %f)" % (x, y, x + random.random() * 200, y + random.random() * 200)
+        lines.append("SRID=%d;%s" % (srid, wkt))
+    return _copy(conn, 'target', ['geom'], lines)
+
+
+def _copy_sources(conn, rows, extent, srid=3857):
+    """Loads rows of random source polygons (like _insert_sources_sql()) by COPY, returns elapsed time"""
+    size = cell_size / 2
+    lines = []
+    for i in range(rows):
+        x, y = random.random() * extent, random.random() * extent
+        lines.append("%d\tSRID=%d;POLYGON((%f %f,%f %f,%f %f,%f %f,%f %f))" % (
+            random.randint(0, 1000000), srid, x, y, x + size, y, x + size, y + size, x, y + size, x, y))
+    return _copy(conn, 'source', ['code', 'geom'], lines)
+
+
+def _timed(conn, sql, params=None):
+    cur = conn.cursor()
+    start = time.perf_counter()
+    cur.execute(sql, params)
+    conn.commit()
+    return time.perf_counter() - start
+
+
+def _drain_queue(conn):
+    """Processes the queue of the deferred mode like the worker until it is empty.
+    Returns tuple (processed queue entries, elapsed time)."""
+    entries = 0
+    start = time.perf_counter()
+    while True:
+        processed = process_batch(conn)
+        if not processed:
+            break
+        entries += processed
+    return entries, time.perf_counter() - start
+
+
+def run_scenarios(conn, args, extent):
+    """Returns list of (scenario, rows, seconds) for the edits of both layers"""
+    results = []
+    cur = conn.cursor()
+    cur.execute("SELECT max(id) FROM %s.target" % schema)
+    max_target = cur.fetchone()[0]
+    cur.execute("SELECT max(id) FROM %s.source" % schema)
+    max_source = cur.fetchone()[0]
+    conn.commit()
+    rng = random.Random(1)
+
+    # single-row edits - total time of all of them, each in its own transaction
+    seconds = 0.0
+    for i in range(args.single):
+        seconds += _timed(conn, "UPDATE %s.target SET geom = ST_Translate(geom, 1, 1) WHERE id = %%s" % schema,
+                          (rng.randint(1, max_target),))
+    results.append(('target_single_update', args.single, seconds))
+    seconds = 0.0
+    for i in range(args.single):
+        seconds += _timed(conn, "UPDATE %s.source SET code = code + 1 WHERE id = %%s" % schema,
+                          (rng.randint(1, max_source),))
+    results.append(('source_single_update', args.single, seconds))
+
+    bulk = args.bulk
+    _set_seed(conn)
+    conn.commit()
+    results.append(('target_bulk_insert', bulk, _timed(conn, _insert_targets_sql(args.target_type, 3857, extent), {'count': bulk})))
+    results.append(('target_bulk_update', bulk, _timed(
+        conn, "UPDATE %s.target SET geom = ST_Translate(geom, 1, 1) WHERE id <= %%s" % schema, (bulk,))))
+    source_rows = max(1, min(max_source, bulk // 10))
+    results.append(('source_bulk_update', source_rows, _timed(
+        conn, "UPDATE %s.source SET code = code + 1 WHERE id <= %%s" % schema, (source_rows,))))
+    results.append(('source_bulk_geometry_update', source_rows, _timed(
+        conn, "UPDATE %s.source SET geom = ST_Translate(geom, 0.5, 0.5) WHERE id <= %%s" % schema, (source_rows,))))
+    results.append(('source_bulk_insert', source_rows, _timed(conn, _insert_sources_sql(3857, extent), {'count': source_rows})))
+    results.append(('target_copy', bulk, _copy_targets(conn, bulk, args.target_type, extent)))
+    results.append(('source_copy', source_rows, _copy_sources(conn, source_rows, extent)))
+    results.append(('target_bulk_delete', bulk, _timed(
+        conn, "DELETE FROM %s.target WHERE id > %%s" % schema, (max_target,))))
+    results.append(('source_bulk_delete', source_rows, _timed(
+        conn, "DELETE FROM %s.source WHERE id <= %%s" % schema, (source_rows,))))
+    return results
+
+
+def benchmark(conn, args):
+    """Runs the scenarios without triggers and with triggers in each mode, returns list of result dictionaries"""
+    init_registry(conn)
+    results = []
+    for mode in ['none'] + args.modes:
+        # fresh data for each mode, so that the modes are compared on the same tables
+        random.seed(seed)
+        extent = create_data(conn, args.sources, args.scale, args.target_type)
+        sql_gen = None
+        install_seconds = 0.0
+        if mode != 'none':
+            sql_gen = SqlGenerator()
+            sql_gen.trg_fcn_id = new_trigger_id(conn)
+            sql_gen.source_table = schema + '.source'
+            sql_gen.target_table = schema + '.target'
+            sql_gen.attr_map = {'code': 'code'}
+            sql_gen.agg_map = {}
+            sql_gen.mode = mode
+            sql_gen.predicate = args.predicate
+            install_seconds = _timed(conn, sql_gen.create_sql())
+        try:
+            for scenario, rows, seconds in run_scenarios(conn, args, extent):
+                results.append({'mode': mode, 'predicate': args.predicate, 'scenario': scenario, 'rows': rows,
+                                'seconds': round(seconds, 6),
+                                'ms_per_row': round(seconds * 1000 / rows, 4) if rows else None})
+                print("%-10s %-28s %9d rows %10.3f s" % (mode, scenario, rows, seconds), file=sys.stderr)
+            if mode == 'deferred':
+                entries, seconds = _drain_queue(conn)
+                results.append({'mode': mode, 'predicate': args.predicate, 'scenario': 'queue_drain', 'rows': entries,
+                                'seconds': round(seconds, 6),
+                                'ms_per_row': round(seconds * 1000 / entries, 4) if entries else None})
+                print("%-10s %-28s %9d rows %10.3f s" % (mode, 'queue_drain', entries, seconds), file=sys.stderr)
+            if sql_gen is not None:
+                results.append({'mode': mode, 'predicate': args.predicate, 'scenario': 'install', 'rows': 0,
+                                'seconds': round(install_seconds, 6), 'ms_per_row': None})
+        finally:
+            if sql_gen is not None:
+                _timed(conn, sql_gen.drop_sql())
+    _timed(conn, "DROP SCHEMA IF EXISTS %s CASCADE" % schema)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of PostGIS Sampling Tool triggers")
+    parser.add_argument("--dsn", help="existing database with PostGIS (default: a temporary cluster is started)")
+    parser.add_argument("--scale", type=int, default=10000, help="number of target features")
+    parser.add_argument("--sources", type=int, default=0, help="number of source polygons (default: scale / 10)")
+    parser.add_argument("--target-type", choices=('Point', 'LineString'), default='Point')
+    parser.add_argument("--modes", default="row,statement,deferred", help="comma-separated trigger modes")
+    parser.add_argument("--predicate", choices=predicates, default="intersects", help="spatial relation of the trigger pair")
+    parser.add_argument("--single", type=int, default=100, help="number of single-row edits")
+    parser.add_argument("--bulk", type=int, default=0, help="rows of bulk edits (default: scale / 10)")
+    parser.add_argument("-o", "--output", help="JSON file with results (default: standard output)")
+    args = parser.parse_args(argv)
+    args.modes = [mode for mode in args.modes.split(',') if mode]
+    args.sources = args.sources or max(1, args.scale // 10)
+    args.bulk = args.bulk or max(1, args.scale // 10)
+
+    cluster = None
+    dsn = args.dsn
+    if dsn is None:
+        cluster = TemporaryCluster()
+        dsn = cluster.start()
+    try:
+        conn = psycopg2.connect(dsn)
+        try:
+            cur = conn.cursor()
+            cur.execute("CREATE EXTENSION IF NOT EXISTS postgis")
+            cur.execute("SELECT version(), postgis_full_version()")
+            pg_version, postgis_version = cur.fetchone()
+            conn.commit()
+            results = benchmark(conn, args)
+        finally:
+            conn.close()
+    finally:
+        if cluster is not None:
+            cluster.stop()
+
+    report = {
+        'meta': {'postgresql': pg_version, 'postgis': postgis_version, 'generator_version': generator_version,
+                 'scale': args.scale, 'sources': args.sources, 'bulk': args.bulk, 'single': args.single,
+                 'target_type': args.target_type, 'started_at': time.strftime('%Y-%m-%dT%H:%M:%S')},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,151 @@
+# encoding: utf-8
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+"""
+Snapshot of catalog metadata (schemas, spatial tables, their columns and keys) shared by the dialogs.
+
+Everything is loaded by a few bulk queries instead of one query per table and combo box change.
+Snapshots are kept for the session (per database) and reloaded only when a cheap check
+of the system catalogs shows that something has changed.
+"""
+
+INTEGER_TYPES = ('int2', 'int4', 'int8')
+
+# changes whenever a table, column, schema or constraint is created, altered or dropped
+_fingerprint_sql = """SELECT (SELECT count(*) FROM pg_class),
+    (SELECT max(xmin::text::bigint) FROM pg_class),
+    (SELECT max(xmin::text::bigint) FROM pg_attribute),
+    (SELECT max(xmin::text::bigint) FROM pg_namespace),
+    (SELECT max(xmin::text::bigint) FROM pg_constraint)"""
+
+_snapshots = {}  # key = connection string, value = CatalogSnapshot
+
+
+def get_snapshot(conn):
+    """Returns catalog snapshot of the database of the connection - the shared one if it is still valid"""
+    snapshot = _snapshots.get(conn.dsn)
+    if snapshot is None:
+        snapshot = CatalogSnapshot(conn)
+        _snapshots[conn.dsn] = snapshot
+    else:
+        snapshot.conn = conn   # the previous connection may have been closed already
+        snapshot.refresh()
+    return snapshot
+
+
+class CatalogSnapshot:
+    """ Catalog metadata of one database """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.reload()
+
+    def _fingerprint(self):
+        cur = self.conn.cursor()
+        cur.execute(_fingerprint_sql)
+        return cur.fetchone()
+
+    def refresh(self):
+        """Reloads the snapshot if the catalog has changed. Returns True if it has been reloaded."""
+        if self._fingerprint() == self.fingerprint:
+            return False
+        self.reload()
+        return True
+
+    def reload(self):
+        self.fingerprint = self._fingerprint()
+        cur = self.conn.cursor()
+
+        cur.execute("""SELECT oid, nspname
+             FROM pg_namespace
+             WHERE nspname !~ '^pg_' AND nspname != 'information_schema'
+             ORDER BY nspname""")
+        self._schemas = cur.fetchall()
+
+        cur.execute("""SELECT f_table_schema, f_table_name, f_geometry_column, type, srid
+             FROM geometry_columns
+             ORDER BY f_table_schema, f_table_name""")
+        self._geometry_columns = cur.fetchall()
+
+        # columns of all tables with a geometry column, in the format of get_table_fields()
+        cur.execute("""SELECT nsp.nspname, c.relname,
+                            a.attnum AS ordinal_position,
+                            a.attname AS column_name,
+                            t.typname AS data_type,
+                            a.attlen AS char_max_len,
+                            a.atttypmod AS modifier,
+                            a.attnotnull AS notnull,
+                            a.atthasdef AS hasdefault,
+                            pg_get_expr(adef.adbin, adef.adrelid) AS default_value,
+                            pg_catalog.format_type(a.atttypid,a.atttypmod) AS formatted_type
+                    FROM pg_class c
+                    JOIN pg_attribute a ON a.attrelid = c.oid
+                    JOIN pg_type t ON a.atttypid = t.oid
+                    JOIN pg_namespace nsp ON c.relnamespace = nsp.oid
+                    LEFT JOIN pg_attrdef adef ON adef.adrelid = a.attrelid AND adef.adnum = a.attnum
+                    WHERE a.attnum > 0 AND NOT a.attisdropped
+                      AND EXISTS (SELECT 1 FROM pg_attribute g JOIN pg_type gt ON gt.oid = g.atttypid
+                                  WHERE g.attrelid = c.oid AND gt.typname = 'geometry' AND NOT g.attisdropped)
+                    ORDER BY nsp.nspname, c.relname, a.attnum""")
+        self._fields = {}  # key = (schema, table), value = list of rows
+        for row in cur.fetchall():
+            self._fields.setdefault((row[0], row[1]), []).append(row[2:])
+
+        # columns of primary, unique and foreign keys
+        cur.execute("""SELECT nsp.nspname, c.relname, con.contype, a.attname, t.typname, array_length(con.conkey, 1)
+                    FROM pg_constraint con
+                    JOIN pg_class c ON c.oid = con.conrelid
+                    JOIN pg_namespace nsp ON c.relnamespace = nsp.oid
+                    JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum = ANY(con.conkey)
+                    JOIN pg_type t ON a.atttypid = t.oid
+                    WHERE con.contype IN ('p', 'u', 'f')
+                    ORDER BY nsp.nspname, c.relname, con.contype = 'p'""")
+        self._keys = {}  # key = (schema, table), value = list of (constraint type, column, type, number of columns)
+        for row in cur.fetchall():
+            self._keys.setdefault((row[0], row[1]), []).append(row[2:])
+        self.conn.commit()
+
+    def schemas(self):
+        """Returns list of (oid, name) of user schemas"""
+        return self._schemas
+
+    def spatial_tables(self):
+        """Returns list of (schema, table, geometry column) of all spatial tables"""
+        return [row[:3] for row in self._geometry_columns]
+
+    def geometry_info(self, schema, table):
+        """Returns tuple (geometry column, geometry type, SRID) of the table or None"""
+        for row in self._geometry_columns:
+            if row[0] == schema and row[1] == table:
+                return row[2:]
+        return None
+
+    def table_fields(self, schema, table):
+        """Returns columns of the spatial table in the format of get_table_fields()"""
+        return self._fields.get((schema, table), [])
+
+    def primary_key(self, table, integer_only=True):
+        """Returns name of the single-column (integer) primary key of the table "schema.table" or None"""
+        schema, name = table.split('.', 1)
+        for contype, column, data_type, column_count in self._keys.get((schema, name), []):
+            if contype == 'p' and column_count == 1 and (not integer_only or data_type in INTEGER_TYPES):
+                return column
+        return None
+
+    def uic_geom_fields(self):
+        """Returns dictionary "schema.table" -> [geometry column, key column] of spatial tables with a key,
+        same as list_uic_geom_fields()"""
+        uic_geom_columns = {}
+        for schema, table, geom, geom_type, srid in self._geometry_columns:
+            keys = self._keys.get((schema, table))
+            if keys:
+                # primary key is sorted last
+                uic_geom_columns[schema + '.' + table] = [geom, keys[-1][1]]
+        return uic_geom_columns
@@ -0,0 +1,107 @@
+# encoding: utf-8
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+"""
+Command line interface for deployment of trigger pairs (see deploy.py), it does not need QGIS:
+
+  python -m postgis_sampling_tool export --dsn "host=localhost dbname=gis" > pairs.json
+  python -m postgis_sampling_tool diff --dsn "host=localhost dbname=gis" pairs.json
+  python -m postgis_sampling_tool apply --dsn "host=localhost dbname=gis" pairs.json [--prune]
+  python -m postgis_sampling_tool explain --dsn "host=localhost dbname=gis" pairs.json [--analyze]
+
+"diff" exits with code 2 if the database differs from the file, "explain" (dry run of the pairs'
+queries, see explain.py) exits with code 2 if there are warnings.
+"""
+
+import argparse
+import json
+import sys
+
+import psycopg2
+
+from .explain import preview_pairs
+from .ddl import LOCK_TIMEOUT, RETRIES
+from .deploy import load_pairs, export_pairs, plan_deployment, apply_plan
+from .sql_generator import list_triggers, list_invalid_triggers, list_missing_indexes, init_registry
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="postgis_sampling_tool",
+                                     description="Deployment of PostGIS Sampling Tool trigger pairs")
+    parser.add_argument("--dsn", required=True, help="libpq connection string")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    commands.add_parser("list", help="list registered trigger pairs")
+    commands.add_parser("export", help="write deployment file with the registered pairs to standard output")
+    for name, text in (("diff", "show differences between the deployment file and the database"),
+                       ("apply", "apply differences of the deployment file in one transaction")):
+        command = commands.add_parser(name, help=text)
+        command.add_argument("file", help="deployment file (JSON)")
+        command.add_argument("--prune", action="store_true", help="remove registered pairs which are not in the file")
+        command.add_argument("--lock-timeout", type=int, default=LOCK_TIMEOUT,
+                             help="maximum wait for a lock of a busy table in ms before the transaction is retried")
+        command.add_argument("--retries", type=int, default=RETRIES, help="number of retries when tables are busy")
+    command = commands.add_parser("explain", help="check plans of the queries of pairs in the deployment file")
+    command.add_argument("file", help="deployment file (JSON)")
+    command.add_argument("--analyze", action="store_true",
+                         help="also execute the queries on a few features (rolled back) to measure time")
+    args = parser.parse_args(argv)
+
+    conn = psycopg2.connect(args.dsn)
+    try:
+        if args.command == "list":
+            init_registry(conn)
+            invalid = list_invalid_triggers(conn)
+            missing = list_missing_indexes(conn)
+            for trigger_id, source_table, target_table in list_triggers(conn):
+                print("%d\t%s\t%s\t%s" % (trigger_id, source_table, target_table,
+                                          "; ".join(invalid.get(trigger_id, []) + missing.get(trigger_id, [])) or "ok"))
+            return 0
+
+        if args.command == "export":
+            init_registry(conn)
+            json.dump(export_pairs(conn), sys.stdout, indent=2, sort_keys=True)
+            sys.stdout.write("\n")
+            return 0
+
+        try:
+            generators = load_pairs(args.file)
+        except ValueError as e:
+            sys.stderr.write("%s: %s\n" % (args.file, e))
+            return 1
+        if args.command == "explain":
+            previews = preview_pairs(conn, generators, analyze=args.analyze)
+            for preview in previews:
+                print("\n".join(preview.describe()))
+            if any(preview.errors for preview in previews):
+                return 1
+            return 2 if any(preview.warnings for preview in previews) else 0
+
+        try:
+            plan = plan_deployment(conn, generators, args.prune)
+        except ValueError as e:
+            sys.stderr.write("%s: %s\n" % (args.file, e))
+            return 1
+        for line in plan.describe():
+            print(line)
+        if args.command == "diff":
+            return 2 if not plan.is_empty() else 0
+
+        apply_plan(conn, plan, lock_timeout=args.lock_timeout, retries=args.retries)
+        sys.stderr.write("%d created, %d updated, %d removed, %d unchanged\n" % (
+            len(plan.create), len(plan.update), len(plan.remove), len(plan.unchanged)))
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,19 +15,25 @@ import psycopg2
 
 from qgis.PyQt.QtGui import *
 from qgis.PyQt.QtCore import *
-from qgis.PyQt import uic
 from qgis.PyQt.QtWidgets import QMessageBox
 
 from qgis.core import QgsApplication
 
-from .trigger_dialog import TriggerDialog
-from .sql_generator import SqlGenerator, list_triggers, list_invalid_triggers
-from .pg_connection import connection_from_name
-from .wizard_dialog import WizardDialog
+from .sql_generator import SqlGenerator, list_triggers, list_invalid_triggers, list_missing_indexes, regenerate_dispatch_sql, \
+    init_registry, new_trigger_ids, load_sql_generator, auto_repair_sql, drop_auto_repair_sql, has_auto_repair, \
+    pair_stats, set_instrumentation, has_instrumentation
+from .pg_connection import connection_from_name, cached_connection, close_connections
+from .backfill import backfill
+from .catalog import get_snapshot
+from .ui_loader import load_ui
+from .db_task import run_task, execute_statements, TaskCanceled
+from .explain import preview_pairs
 
 this_dir = os.path.dirname(__file__)
 
-WIDGET, BASE = uic.loadUiType(os.path.join(this_dir, 'config_dialog.ui'))
+WIDGET, BASE = load_ui('config_dialog')
+
+BACKFILL_WORKERS = 4  # connections sampling existing features in parallel
 
 
 class ConfigDialog(BASE, WIDGET):
@@ -55,6 +61,7 @@ class ConfigDialog(BASE, WIDGET):
             self.cboConnection.setCurrentIndex(pg_connections.index(last_conn_name)+1)
 
         self.triggers = []
+        self.stats = {}
         self.model = QStandardItemModel()
         self.treeTriggers.setModel(self.model)
 
@@ -64,8 +71,12 @@ class ConfigDialog(BASE, WIDGET):
         self.btnEdit.clicked.connect(self.edit_trigger)
         self.btnRemove.clicked.connect(self.remove_trigger)
         self.btnWizard.clicked.connect(self.open_wizard)
+        self.btnBackfill.clicked.connect(self.backfill_trigger)
+        self.btnAutoRepair.toggled.connect(self.toggle_auto_repair)
+        self.btnInstrument.toggled.connect(self.toggle_instrumentation)
 
         self.broken_triggers = None
+        self.missing_indexes = {}
         self.populate_triggers()
         self.delete_not_valid_triggers()
 
@@ -75,15 +86,17 @@ class ConfigDialog(BASE, WIDGET):
         settings = QSettings()
         settings.setValue("/Plugins/RRM_Plugin/config_geometry", self.saveGeometry())
         settings.setValue("/Plugins/RRM_Plugin/last_conn_name", self.cboConnection.currentText())
+        close_connections()
         BASE.hideEvent(self, e)
 
     def get_connection(self):
-
+        """Returns connection of the selected database - the same one for all actions of the dialog"""
         name = self.cboConnection.currentText()
-        return connection_from_name(name)
+        return cached_connection(name)
 
     def enable_controls(self, enabled):
-        for w in [self.btnAdd, self.btnEdit, self.btnRemove, self.cboSchema, self.btnWizard]:
+        for w in [self.btnAdd, self.btnEdit, self.btnRemove, self.cboSchema, self.btnWizard, self.btnBackfill, self.btnAutoRepair,
+                  self.btnInstrument]:
             w.setEnabled(enabled)
 
     def populate_triggers(self):
@@ -98,6 +111,25 @@ class ConfigDialog(BASE, WIDGET):
             self.enable_controls(False)
             return
 
+        load_invalid = self.broken_triggers is None
+
+        def load(task):
+            snapshot = get_snapshot(conn)
+            init_registry(conn)
+            triggers = list_triggers(conn)
+            auto_repair = has_auto_repair(conn)
+            broken_triggers = list_invalid_triggers(conn) if load_invalid else self.broken_triggers
+            return snapshot.schemas(), triggers, auto_repair, broken_triggers, list_missing_indexes(conn), \
+                pair_stats(conn), has_instrumentation(conn)
+
+        try:
+            schemas, self.triggers, auto_repair, self.broken_triggers, self.missing_indexes, self.stats, instrumented = \
+                run_task(self, conn, "Loading triggers...", load, cancelable=False)
+        except psycopg2.Error as e:
+            QMessageBox.warning(self, "PostGIS Sampling Tool", "Cannot read the registry of triggers:\n\n" + str(e))
+            self.enable_controls(False)
+            return
+
         self.enable_controls(True)
 
         # populate list of schemas (for filtering)
@@ -105,20 +137,50 @@ class ConfigDialog(BASE, WIDGET):
         self.cboSchema.blockSignals(True)
         self.cboSchema.clear()
         self.cboSchema.addItem("[all]")
-        c = conn.cursor()
-        c.execute("SELECT oid, nspname FROM pg_namespace WHERE nspname !~ '^pg_' AND nspname != 'information_schema'")
-        for row in c.fetchall():
-            self.cboSchema.addItem(row[1])
+        for schema_oid, schema_name in schemas:
+            self.cboSchema.addItem(schema_name)
         if self.cboSchema.findText(old_schema_filter) != -1:  # select previously used filter
             self.cboSchema.setCurrentIndex(self.cboSchema.findText(old_schema_filter))
         self.cboSchema.blockSignals(False)
 
-        self.triggers = list_triggers(conn)
+        self._update_auto_repair(auto_repair)
+        self.btnInstrument.blockSignals(True)
+        self.btnInstrument.setChecked(instrumented)
+        self.btnInstrument.blockSignals(False)
+        self._update_triggers_model()
 
-        if self.broken_triggers == None:
-            self.broken_triggers = list_invalid_triggers(conn, self.triggers)
+    def _update_auto_repair(self, checked):
+        self.btnAutoRepair.blockSignals(True)
+        self.btnAutoRepair.setChecked(checked)
+        self.btnAutoRepair.blockSignals(False)
 
-        self._update_triggers_model()
+    def toggle_auto_repair(self, checked):
+        conn = self.get_connection()
+        sql = auto_repair_sql() if checked else drop_auto_repair_sql()
+        try:
+            run_task(self, conn, "Changing automatic repair...",
+                     lambda task: execute_statements(task, [sql], "Changing automatic repair..."))
+        except TaskCanceled:
+            pass
+        except psycopg2.Error as e:
+            QMessageBox.warning(self, "PostGIS Sampling Tool", "Cannot change automatic repair of triggers "
+                                "(superuser privileges are needed):\n\n" + str(e))
+        self._update_auto_repair(run_task(self, conn, "Loading triggers...",
+                                          lambda task: has_auto_repair(conn), cancelable=False))
+
+    def toggle_instrumentation(self, checked):
+        conn = self.get_connection()
+        try:
+            run_task(self, conn, "Changing statistics...", lambda task: set_instrumentation(conn, checked))
+        except TaskCanceled:
+            pass
+        except psycopg2.Error as e:
+            QMessageBox.warning(self, "PostGIS Sampling Tool", "Cannot change recording of statistics "
+                                "(owner of the database is needed):\n\n" + str(e))
+        else:
+            QMessageBox.information(self, "PostGIS Sampling Tool", "The change applies to new connections to the database.\n\n"
+                                    "Triggers created by older versions of the plugin record statistics after they are edited.")
+        self.populate_triggers()
 
     def delete_not_valid_triggers(self):
         if not self.triggers: return
@@ -129,8 +191,8 @@ class ConfigDialog(BASE, WIDGET):
             # if source or target table has been deleted
             if not src or not trg:
                 invalid.append((trigger_id, src, trg))
-            # if schema has been changed, but trigger function not - invalid references in trigger fn
-            elif (trigger_id, src, trg) in self.broken_triggers:
+            # renamed tables or schemas, missing triggers or columns
+            elif trigger_id in self.broken_triggers:
                 invalid.append((trigger_id, src, trg))
 
         if not invalid: return
@@ -142,15 +204,25 @@ class ConfigDialog(BASE, WIDGET):
         msgBox.addButton(QMessageBox.No)
         msgBox.setDefaultButton(QMessageBox.No)
         if msgBox.exec_() == QMessageBox.Yes:
-            for trigger_id, src, trg in invalid:
+            def delete(task):
+                statements = []
+                for trigger_id, src, trg in invalid:
                     sql_gen = SqlGenerator()
                     sql_gen.trg_fcn_id = trigger_id
                     sql_gen.source_table = src
                     sql_gen.target_table = trg
-                    sql = sql_gen.drop_sql()
-
-                    cur = conn.cursor()
-                    cur.execute("BEGIN;" + sql + "COMMIT;")
+                    statements.append(sql_gen.drop_sql())
+                tables = [src for trigger_id, src, trg in invalid] + [trg for trigger_id, src, trg in invalid]
+                statements.append(regenerate_dispatch_sql(conn, tables,
+                                                          removed_ids=[trigger_id for trigger_id, src, trg in invalid]))
+                execute_statements(task, statements, "Deleting invalid triggers...")
+
+            try:
+                run_task(self, conn, "Deleting invalid triggers...", delete)
+            except TaskCanceled:
+                pass
+            except psycopg2.Error as e:
+                QMessageBox.critical(self, "Error", "Deleting of invalid triggers failed:\n\n" + str(e))
 
             self.populate_triggers()
 
@@ -160,7 +232,7 @@ class ConfigDialog(BASE, WIDGET):
             return schema_filter is None or table_name.startswith(schema_filter+".")
 
         self.model.clear()
-        self.model.setHorizontalHeaderLabels(["ID", "Source Table", "Target Table"])
+        self.model.setHorizontalHeaderLabels(["ID", "Source Table", "Target Table", "Calls", "Time [ms]"])
         index = -1
         for trigger_id, source_table, target_table in self.triggers:
             index += 1
@@ -170,60 +242,194 @@ class ConfigDialog(BASE, WIDGET):
             item_0.setData(index)  # store index of the item in self.triggers (used in _current_item_to_generator)
             item_1 = QStandardItem(source_table)
             item_2 = QStandardItem(target_table)
-            for i in [item_0, item_1, item_2]:
+            item_3, item_4 = self._stats_items(trigger_id)
+            for i in [item_0, item_1, item_2, item_3, item_4]:
                 i.setEditable(False)
+                if trigger_id in self.missing_indexes:
+                    i.setData(QColor("lightyellow"), Qt.BackgroundRole)
+                    i.setToolTip("Every edit scans the whole table, edit the trigger to create the missing indexes:\n" +
+                                 "\n".join(self.missing_indexes[trigger_id]))
                 if not source_table or not target_table:
                     i.setData(QColor("pink"), Qt.BackgroundRole)
                     i.setToolTip("Not valid, the trigger is missing source or target table.")
-                if self.broken_triggers and (trigger_id, source_table, target_table) in self.broken_triggers:
+                if self.broken_triggers and trigger_id in self.broken_triggers:
                     i.setData(QColor("pink"), Qt.BackgroundRole)
-                    i.setToolTip("The trigger function is invalid - probably a schema name has been changed.")
+                    i.setToolTip("The trigger is invalid:\n" + "\n".join(self.broken_triggers[trigger_id]))
 
-            self.model.appendRow([item_0, item_1, item_2])
+            self.model.appendRow([item_0, item_1, item_2, item_3, item_4])
 
         self.treeTriggers.resizeColumnToContents(1)
 
+    def _load_catalog(self, conn):
+        """Loads metadata of tables for the dialogs in the background (they use the shared snapshot)"""
+        try:
+            run_task(self, conn, "Reading tables...", lambda task: get_snapshot(conn))
+        except TaskCanceled:
+            return False
+        return True
+
+    def _check_plans(self, conn, generators):
+        """Explains queries of the new pairs (without executing them) and asks whether to continue
+        if there are problems. Returns True if the pairs should be installed."""
+        def check(task):
+            return preview_pairs(conn, generators, progress=lambda done, total: task.set_progress(
+                done, total, "Checking the triggers' queries..."))
+
+        try:
+            previews = run_task(self, conn, "Checking the triggers' queries...", check)
+        except TaskCanceled:
+            res = QMessageBox.question(self, "PostGIS Sampling Tool",
+                                       "Checking of the triggers' queries has been cancelled.\n\n"
+                                       "Do you want to install the triggers without the check?",
+                                       QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+            return res == QMessageBox.Yes
+        lines = [line for preview in previews if preview.warnings or preview.errors for line in preview.describe()]
+        if not lines:
+            return True
+        res = QMessageBox.question(self, "PostGIS Sampling Tool",
+                                   "\n".join(lines) + "\n\nDo you want to install the triggers anyway?")
+        return res == QMessageBox.Yes
+
+    def _install(self, conn, generators, text, old_generators=()):
+        """Creates trigger pairs in one transaction in the background. The first pairs replace
+        the installed old_generators (in the same order) under their IDs. Returns True on success."""
+        replaced = list(zip(generators, old_generators))
+        created = generators[len(replaced):]
+
+        def install(task):
+            task.set_progress(0, 0, "Preparing triggers...")
+            for sql_gen, old in replaced:
+                sql_gen.trg_fcn_id = old.trg_fcn_id
+            if created:
+                for sql_gen, trigger_id in zip(created, new_trigger_ids(conn, len(created))):
+                    sql_gen.trg_fcn_id = trigger_id
+            statements = []
+            for i, sql_gen in enumerate(generators):
+                task.check_canceled()
+                task.set_progress(i, len(generators), "Preparing triggers...")
+                if i < len(replaced):
+                    statements.append(sql_gen.replace_sql(replaced[i][1]))
+                else:
+                    statements.append(sql_gen.create_sql())
+            tables = [table for sql_gen in list(generators) + list(old_generators)
+                      for table in (sql_gen.source_table, sql_gen.target_table)]
+            statements.append(regenerate_dispatch_sql(conn, tables, new_generators=generators,
+                                                      removed_ids=[old.trg_fcn_id for sql_gen, old in replaced]))
+            execute_statements(task, statements, text)
+
+        try:
+            run_task(self, conn, text, install)
+        except TaskCanceled:
+            QMessageBox.information(self, "PostGIS Sampling Tool", "Cancelled, no changes have been made.")
+            return False
+        except psycopg2.Error as e:
+            QMessageBox.critical(self, "Error", "Creating of triggers failed, no changes have been made:\n\n" + str(e))
+            return False
+        return True
+
+    def _stats_items(self, trigger_id):
+        """Returns items with calls and time of the pair - recorded by the triggers, otherwise from pg_stat_user_functions"""
+        stats = self.stats.get(trigger_id, {})
+        if 'calls' in stats:
+            calls, total_time = stats['calls'], stats['total_time']
+        else:
+            calls, total_time = stats.get('fn_calls'), stats.get('fn_time')
+        item_calls = QStandardItem(str(calls) if calls is not None else "")
+        item_time = QStandardItem("%.1f" % total_time if total_time is not None else "")
+        tooltip = []
+        if 'calls' in stats:
+            tooltip.append("Recorded by the triggers: %d calls, %d rows re-sampled, %d lookups, %.1f ms" % (
+                stats['calls'], stats['rows_invalidated'], stats['lookups'], stats['total_time']))
+        if 'fn_calls' in stats:
+            tooltip.append("pg_stat_user_functions: %d calls, %.1f ms" % (stats['fn_calls'], stats['fn_time']))
+        for item in (item_calls, item_time):
+            item.setData(Qt.AlignRight, Qt.TextAlignmentRole)
+            item.setToolTip("\n".join(tooltip))
+        return item_calls, item_time
+
     def open_wizard(self):
+        from .wizard_dialog import WizardDialog   # UI is loaded on first use
+
         conn = self.get_connection()
+        if not self._load_catalog(conn):
+            return
         dlg = WizardDialog(conn)
         if not dlg.exec_():
             return
         generators = dlg.to_sql_generator()
+        if not generators or not self._check_plans(conn, generators):
+            return
 
-        final_sql = ""
-        offset = 0
-        for sql_gen in generators:
-            sql_gen.trg_fcn_id = self._new_trigger_id() + offset
-            sql = sql_gen.create_sql()
-            final_sql += sql + ";"
-            offset +=1
-
-        cur = conn.cursor()
-        cur.execute("BEGIN;" + final_sql + "COMMIT;")
+        installed = self._install(conn, generators, "Installing triggers...")
         self.populate_triggers()
+        if installed:
+            self._ask_backfill([sql_gen.trg_fcn_id for sql_gen in generators])
 
 
     def add_trigger(self):
+        from .trigger_dialog import TriggerDialog   # UI is loaded on first use
+
         conn = self.get_connection()
+        if not self._load_catalog(conn):
+            return
         dlg = TriggerDialog(conn)
         if not dlg.exec_():
             return
 
         sql_gen = dlg.to_sql_generator()
-        sql_gen.trg_fcn_id = self._new_trigger_id()
-        sql = sql_gen.create_sql()
-
-        cur = conn.cursor()
-        cur.execute("BEGIN;" + sql + "COMMIT;")
+        if not self._check_plans(conn, [sql_gen]):
+            return
+        installed = self._install(conn, [sql_gen], "Installing triggers...")
 
         self.populate_triggers()
+        if installed:
+            self._ask_backfill([sql_gen.trg_fcn_id])
+
+    def _ask_backfill(self, trigger_ids):
+        if not trigger_ids:
+            return
+        res = QMessageBox.question(self, "PostGIS Sampling Tool",
+                                   "The triggers only update features modified from now on.\n\n"
+                                   "Do you want to sample all existing features of the target table now?")
+        if res == QMessageBox.Yes:
+            self._run_backfill(trigger_ids)
+
+    def _run_backfill(self, trigger_ids, target_columns=None):
+        """ Sample existing rows of target tables (only the given columns if set) in the background.
+        Cancelling interrupts the running chunks, finished chunks are kept for the next resync. """
+        name = self.cboConnection.currentText()
+        try:
+            # connections are opened in the GUI thread (a password may be asked for)
+            connections = [connection_from_name(name) for i in range(BACKFILL_WORKERS)]
+        except Exception as e:
+            QMessageBox.critical(self, "Error", "Cannot connect to the database:\n\n" + str(e))
+            return
 
-    def _new_trigger_id(self):
-        # find new trigger ID
-        if len(self.triggers) == 0:
-            return 1
+        def resync(task):
+            for trigger_id in trigger_ids:
+                text = "Sampling existing features of trigger %d..." % trigger_id
+                task.set_progress(0, 0, text)
+                if not backfill(None, trigger_id, progress=lambda done, total: task.set_progress(done, total, text),
+                                should_stop=lambda: task.canceled, target_columns=target_columns,
+                                connections=connections):
+                    raise TaskCanceled()
 
-        return max(trigger[0] for trigger in self.triggers) + 1
+        try:
+            run_task(self, connections[0], "Sampling existing features...", resync, cancel_connections=connections)
+        except TaskCanceled:
+            QMessageBox.information(self, "PostGIS Sampling Tool",
+                                    "Sampling has been interrupted, it will continue from the same place next time.")
+        except Exception as e:
+            QMessageBox.critical(self, "Error", "Sampling of existing features failed:\n\n" + str(e))
+        finally:
+            for conn in connections:
+                conn.close()
+
+    def backfill_trigger(self):
+        sql_gen = self._current_item_to_sql_generator()
+        if not sql_gen:
+            return
+        self._run_backfill([sql_gen.trg_fcn_id])
 
     def _current_item_to_sql_generator(self):
         index = self.treeTriggers.selectionModel().currentIndex()
@@ -241,43 +447,40 @@ class ConfigDialog(BASE, WIDGET):
         return sql_gen
 
     def edit_trigger(self):
+        from .trigger_dialog import TriggerDialog   # UI is loaded on first use
+
         sql_gen = self._current_item_to_sql_generator()
         if not sql_gen:
             return
 
-        sql = sql_gen.load_trigger_sql()
-
         conn = self.get_connection()
-        cur = conn.cursor()
-        cur.execute(sql)
-        trigger_json_str = cur.fetchone()[0]
-        if trigger_json_str is None:
-            QMessageBox.critical(self, "Error", "Cannot fetch trigger's details.\n\nRemoving the trigger and adding it again will fix the problem.")
-            return
-
         try:
-            sql_gen.parse_json(trigger_json_str)
-        except ValueError:
-            QMessageBox.critical(self, "Error", "Trigger's details are malformed.\n\nRemoving the trigger and adding it again will fix the problem.")
+            sql_gen = run_task(self, conn, "Reading trigger...",
+                               lambda task: get_snapshot(conn) and load_sql_generator(conn, sql_gen.trg_fcn_id))
+        except TaskCanceled:
+            return
+        if sql_gen is None:
+            QMessageBox.critical(self, "Error", "Cannot fetch trigger's details.\n\nRemoving the trigger and adding it again will fix the problem.")
             return
 
         dlg = TriggerDialog(conn, sql_gen)
         if not dlg.exec_():
             return
 
-        cur = conn.cursor()
-
-        # remove the existing pair of triggers
-        sql_drop_old = sql_gen.drop_sql()
-        cur.execute("BEGIN;" + sql_drop_old + "COMMIT;")
-
-        # create new pair of triggers
+        # the pair is replaced in one transaction, keeping its ID
         sql_gen_new = dlg.to_sql_generator()
-        sql_gen_new.trg_fcn_id = self._new_trigger_id()
-        sql = sql_gen_new.create_sql()
-        cur.execute("BEGIN;" + sql + "COMMIT;")
+        if not self._check_plans(conn, [sql_gen_new]):
+            return
+        installed = self._install(conn, [sql_gen_new], "Updating triggers...", old_generators=[sql_gen])
 
         self.populate_triggers()
+        columns = sql_gen_new.changed_target_columns(sql_gen)
+        if installed and columns:
+            res = QMessageBox.question(self, "PostGIS Sampling Tool",
+                                       "Values of these columns of existing features may have changed: %s\n\n"
+                                       "Do you want to sample them again now?" % ", ".join(columns))
+            if res == QMessageBox.Yes:
+                self._run_backfill([sql_gen_new.trg_fcn_id], target_columns=columns)
 
     def remove_trigger(self):
 
@@ -285,10 +488,18 @@ class ConfigDialog(BASE, WIDGET):
         if not sql_gen:
             return
 
-        sql = sql_gen.drop_sql()
-
         conn = self.get_connection()
-        cur = conn.cursor()
-        cur.execute("BEGIN;"+sql+"COMMIT;")
+
+        def remove(task):
+            sql = sql_gen.drop_sql()
+            sql += regenerate_dispatch_sql(conn, [sql_gen.source_table, sql_gen.target_table], removed_ids=[sql_gen.trg_fcn_id])
+            execute_statements(task, [sql], "Removing trigger...")
+
+        try:
+            run_task(self, conn, "Removing trigger...", remove)
+        except TaskCanceled:
+            pass
+        except psycopg2.Error as e:
+            QMessageBox.critical(self, "Error", "Removing of the trigger failed:\n\n" + str(e))
 
         self.populate_triggers()
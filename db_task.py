@@ -0,0 +1,139 @@
+# encoding: utf-8
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+"""
+Database work of the dialogs running in a background thread.
+
+The GUI thread only shows a progress dialog (after a short delay) and keeps processing events while
+the work is done, so QGIS does not freeze on slow or remote databases. Cancelling the progress dialog
+interrupts the running statement with connection.cancel() and rolls the transaction back.
+The connection must not be used by the GUI thread until the task has finished.
+"""
+
+import psycopg2
+import psycopg2.extensions
+
+from qgis.PyQt.QtCore import QThread, QEventLoop, QTimer, QSettings, Qt, pyqtSignal
+from qgis.PyQt.QtWidgets import QProgressDialog
+
+from .ddl import execute_ddl, LOCK_TIMEOUT, RETRIES
+
+SHOW_DELAY = 500  # ms
+
+
+class TaskCanceled(Exception):
+    pass
+
+
+class DbTask(QThread):
+    """ Runs fn(task) in a background thread, fn uses task.conn and reports progress with task.set_progress() """
+
+    progressChanged = pyqtSignal(int, int, str)
+
+    def __init__(self, conn, fn, parent=None, cancel_connections=()):
+        QThread.__init__(self, parent)
+        self.conn = conn
+        self.cancel_connections = [c for c in cancel_connections if c is not conn]
+        self.fn = fn
+        self.result = None
+        self.error = None
+        self.canceled = False
+        self.lock_settings = lock_settings()   # QSettings are read in the GUI thread
+
+    def run(self):
+        try:
+            self.result = self.fn(self)
+        except Exception as e:
+            self.error = e
+            try:
+                self.conn.rollback()
+            except psycopg2.Error:
+                pass
+
+    def set_progress(self, done, total, text=''):
+        self.progressChanged.emit(done, total, text)
+
+    def check_canceled(self):
+        if self.canceled:
+            raise TaskCanceled()
+
+    def cancel(self):
+        self.canceled = True
+        for conn in [self.conn] + self.cancel_connections:
+            conn.cancel()   # interrupts the running statement (if any)
+
+
+def lock_settings():
+    """Returns keyword arguments of execute_ddl() from the settings of the plugin"""
+    settings = QSettings()
+    return {
+        'lock_timeout': settings.value("/Plugins/RRM_Plugin/lock_timeout", LOCK_TIMEOUT, type=int),
+        'statement_timeout': settings.value("/Plugins/RRM_Plugin/statement_timeout", 0, type=int) or None,
+        'retries': settings.value("/Plugins/RRM_Plugin/lock_retries", RETRIES, type=int),
+    }
+
+
+def execute_statements(task, statements, text):
+    """Executes SQL statements in one transaction with progress, to be called from a task.
+    Busy tables are handled by lock timeouts and retries (see ddl.py)."""
+    def progress(done, total, label):
+        task.check_canceled()
+        task.set_progress(done, total, label or text)
+
+    execute_ddl(task.conn, statements, progress=progress, **task.lock_settings)
+
+
+def run_task(parent, conn, text, fn, cancelable=True, cancel_connections=()):
+    """Runs fn(task) in a background thread while events are processed, with a progress dialog.
+    Statements running on conn (and on the other cancel_connections used by fn) are interrupted by cancelling.
+    Returns result of fn, raises its exception (TaskCanceled if the task has been cancelled)."""
+    task = DbTask(conn, fn, cancel_connections=cancel_connections)
+
+    progress_dlg = QProgressDialog(text, "Cancel", 0, 0, parent)
+    if not cancelable:
+        progress_dlg.setCancelButton(None)
+    progress_dlg.setWindowModality(Qt.WindowModal)
+    progress_dlg.setMinimumDuration(SHOW_DELAY)
+    progress_dlg.setAutoClose(False)
+    progress_dlg.setAutoReset(False)
+
+    def progress(done, total, label):
+        progress_dlg.setMaximum(total)
+        progress_dlg.setValue(done)
+        if label:
+            progress_dlg.setLabelText(label)
+
+    task.progressChanged.connect(progress)
+    if cancelable:
+        progress_dlg.canceled.connect(task.cancel)
+
+    loop = QEventLoop()
+    task.finished.connect(loop.quit)
+    task.start()
+
+    # short tasks finish without any dialog and the user cannot do anything else in the meantime,
+    # later the modal progress dialog blocks the parent window
+    timer = QTimer()
+    timer.setSingleShot(True)
+    timer.timeout.connect(loop.quit)
+    timer.start(SHOW_DELAY)
+    loop.exec_(QEventLoop.ExcludeUserInputEvents)
+    timer.stop()
+    if not task.isFinished():
+        progress_dlg.show()
+        loop.exec_()
+    task.wait()
+    progress_dlg.close()
+
+    if task.error is not None:
+        if task.canceled and isinstance(task.error, (TaskCanceled, psycopg2.extensions.QueryCanceledError)):
+            raise TaskCanceled()
+        raise task.error
+    return task.result
@@ -0,0 +1,69 @@
+# encoding: utf-8
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+"""
+Execution of DDL changing triggers of busy tables.
+
+Creating or dropping a trigger needs a lock of the table which conflicts with all writes. While
+a statement waits for such a lock behind a long transaction, every writer of the table queues behind
+it, so the statements are executed with a short lock_timeout. When a lock is not granted in time,
+the whole transaction is rolled back and tried again after a growing pause (with some jitter so that
+concurrent deployments do not collide again). A statement_timeout can limit the whole transaction.
+"""
+
+import random
+import time
+
+import psycopg2
+import psycopg2.errorcodes
+
+LOCK_TIMEOUT = 2000       # ms, 0 waits for locks forever
+RETRIES = 5               # further attempts after the first one
+BACKOFF = 0.5             # s, pause before the first retry, doubled for each further retry
+MAX_BACKOFF = 30.0        # s
+
+
+class LockTimeout(psycopg2.OperationalError):
+    """ Locks of the tables could not be acquired in any attempt (handled like other database errors) """
+    pass
+
+
+def execute_ddl(conn, statements, lock_timeout=LOCK_TIMEOUT, statement_timeout=None, retries=RETRIES, progress=None):
+    """Executes SQL statements in one transaction and commits it, retrying when a lock cannot be acquired.
+    Timeouts are in milliseconds, statement_timeout=None keeps the setting of the session.
+    progress(done, total, text) is called before each statement and before each retry (it may raise
+    an exception to stop). Returns number of attempts, raises LockTimeout after the last one."""
+    statements = [sql for sql in statements if sql]
+    cur = conn.cursor()
+    for attempt in range(retries + 1):
+        try:
+            cur.execute("SET LOCAL lock_timeout = %s", ("%dms" % lock_timeout,))
+            if statement_timeout is not None:
+                cur.execute("SET LOCAL statement_timeout = %s", ("%dms" % statement_timeout,))
+            for i, sql in enumerate(statements):
+                if progress is not None:
+                    progress(i, len(statements), "")
+                cur.execute(sql)
+            conn.commit()
+            return attempt + 1
+        except psycopg2.Error as e:
+            conn.rollback()
+            if e.pgcode != psycopg2.errorcodes.LOCK_NOT_AVAILABLE:
+                raise
+            if attempt == retries:
+                raise LockTimeout("Tables are busy, locks could not be acquired in %d attempts:\n%s" % (
+                    retries + 1, str(e).strip()))
+        # short sleeps, so that progress() can stop the waiting
+        deadline = time.time() + min(MAX_BACKOFF, BACKOFF * 2 ** attempt) * random.uniform(0.5, 1.0)
+        while time.time() < deadline:
+            if progress is not None:
+                progress(0, 0, "Tables are busy, trying again in %.0f s (attempt %d of %d)..." % (
+                    deadline - time.time(), attempt + 2, retries + 1))
+            time.sleep(min(0.2, max(0.0, deadline - time.time())))
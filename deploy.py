@@ -0,0 +1,196 @@
+# encoding: utf-8
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+"""
+Declarative deployment of trigger pairs (does not need QGIS).
+
+A deployment file is a JSON document with a list of pairs in the format of SqlGenerator.write_json()
+(without "trg_fcn_id", options which are not listed get their default values), either directly
+or under the "pairs" key:
+
+  {"pairs": [{"source_table": "public.zones", "target_table": "public.buildings",
+              "attr_map": {"zone_code": "zone"}, "mode": "statement"}]}
+
+Pairs are identified by their tables and target columns: a pair of the file replaces the registered
+pair with the same tables which writes some of its target columns, and no target column may be written
+by two pairs. The file is compared with the pairs registered in the database and only the differences
+are applied, all in one transaction (with lock timeouts and retries, see ddl.py). Changed pairs keep their IDs.
+"""
+
+import json
+
+from .ddl import execute_ddl
+from .sql_generator import SqlGenerator, init_registry, load_sql_generators, new_trigger_ids, regenerate_dispatch_sql
+
+
+def pair_config(sql_gen):
+    """Returns dictionary with complete configuration of the pair, without its ID"""
+    config = json.loads(sql_gen.write_json())
+    del config['trg_fcn_id']
+    return config
+
+
+def target_columns(sql_gen):
+    """Returns set of target columns written by the pair"""
+    return set(sql_gen.attr_map.values()) | set(sql_gen.agg_map.keys())
+
+
+def _overlapping(sql_gen, generators):
+    """Returns pairs from generators writing some of the target columns of the pair"""
+    return [other for other in generators if other.target_table == sql_gen.target_table
+            and target_columns(other) & target_columns(sql_gen)]
+
+
+def _describe(sql_gen):
+    return "%s -> %s (%s)" % (sql_gen.source_table, sql_gen.target_table, ", ".join(sorted(target_columns(sql_gen))))
+
+
+def parse_pairs(data):
+    """Returns list of SqlGenerator from a deployment document (already decoded from JSON)"""
+    if isinstance(data, dict):
+        data = data.get('pairs', [])
+    generators = []
+    for index, entry in enumerate(data):
+        entry = dict(entry)
+        entry['trg_fcn_id'] = None
+        entry.setdefault('attr_map', {})
+        sql_gen = SqlGenerator()
+        try:
+            sql_gen.parse_json(json.dumps(entry))
+        except KeyError as e:
+            raise ValueError("Pair %d: missing %s" % (index + 1, e))
+        except ValueError as e:
+            raise ValueError("Pair %d: %s" % (index + 1, e))
+        if not sql_gen.attr_map and not sql_gen.agg_map:
+            raise ValueError("Pair %d: no attributes are mapped" % (index + 1))
+        if sql_gen.subdivide and not sql_gen.source_key:
+            raise ValueError("Pair %d: subdivide needs source_key (integer primary key of the source table)" % (index + 1))
+        if _overlapping(sql_gen, generators):
+            raise ValueError("Pair %d: the same columns of %s are already written by another pair" % (
+                index + 1, sql_gen.target_table))
+        generators.append(sql_gen)
+    return generators
+
+
+def load_pairs(path):
+    """Returns list of SqlGenerator from a deployment file"""
+    with open(path) as f:
+        return parse_pairs(json.load(f))
+
+
+def export_pairs(conn):
+    """Returns deployment document (dictionary) with all pairs registered in the database"""
+    generators = load_sql_generators(conn)
+    return {'pairs': [pair_config(generators[trigger_id]) for trigger_id in sorted(generators)]}
+
+
+class DeployPlan:
+    """ Differences between the deployment file and the database """
+
+    def __init__(self):
+        self.create = []     # new SqlGenerator
+        self.update = []     # tuples (installed SqlGenerator, new SqlGenerator)
+        self.remove = []     # installed SqlGenerator
+        self.unchanged = []  # installed SqlGenerator
+
+    def is_empty(self):
+        return not self.create and not self.update and not self.remove
+
+    def describe(self):
+        """Returns list of lines with the changes, in the style of a diff"""
+        lines = []
+        for sql_gen in self.create:
+            lines.append("+ %s -> %s" % (sql_gen.source_table, sql_gen.target_table))
+        for old, new in self.update:
+            old_config, new_config = pair_config(old), pair_config(new)
+            changed = [key for key in sorted(new_config) if old_config.get(key) != new_config[key]]
+            lines.append("~ %s -> %s [%d] (%s)" % (new.source_table, new.target_table, old.trg_fcn_id, ", ".join(changed)))
+        for sql_gen in self.remove:
+            lines.append("- %s -> %s [%d]" % (sql_gen.source_table, sql_gen.target_table, sql_gen.trg_fcn_id))
+        return lines
+
+
+def _installed_pair(sql_gen, installed):
+    """Returns the installed pair which the pair of the deployment replaces (the same tables and some
+    of the same target columns) or None - also if there are more of them (the pair is new then)"""
+    matching = [old for old in _overlapping(sql_gen, installed) if old.source_table == sql_gen.source_table]
+    return matching[0] if len(matching) == 1 else None
+
+
+def plan_deployment(conn, generators, prune=False):
+    """Compares pairs of the deployment with the registered ones. A pair replaces the installed pair
+    with the same tables which writes some of its target columns. Installed pairs which are not
+    in the deployment are only removed with prune=True. Raises ValueError if a target column would
+    be written by two pairs."""
+    init_registry(conn)
+    installed = list(load_sql_generators(conn).values())
+
+    plan = DeployPlan()
+    for sql_gen in generators:
+        old = _installed_pair(sql_gen, installed)
+        if old is None:
+            plan.create.append(sql_gen)
+            continue
+        installed.remove(old)
+        if pair_config(old) != pair_config(sql_gen):
+            plan.update.append((old, sql_gen))
+        else:
+            plan.unchanged.append(old)
+    if prune:
+        plan.remove = installed
+    else:
+        for sql_gen in plan.create + [new for old, new in plan.update]:
+            overlapping = _overlapping(sql_gen, installed)
+            if overlapping:
+                raise ValueError("%s writes the same columns as the installed pair [%d] %s (remove it or use prune)" % (
+                    _describe(sql_gen), overlapping[0].trg_fcn_id, _describe(overlapping[0])))
+    return plan
+
+
+def plan_removal(conn, generators):
+    """Returns plan removing the registered pairs which are in the deployment"""
+    init_registry(conn)
+    installed = list(load_sql_generators(conn).values())
+    plan = DeployPlan()
+    for sql_gen in generators:
+        old = _installed_pair(sql_gen, installed)
+        if old is not None:
+            installed.remove(old)
+            plan.remove.append(old)
+    return plan
+
+
+def deployment_sql(conn, plan):
+    """Returns SQL applying the plan (IDs of new pairs are allocated, updated pairs keep their IDs)"""
+    if plan.create:
+        for sql_gen, trigger_id in zip(plan.create, new_trigger_ids(conn, len(plan.create))):
+            sql_gen.trg_fcn_id = trigger_id
+    for old, new in plan.update:
+        new.trg_fcn_id = old.trg_fcn_id
+    new_generators = plan.create + [new for old, new in plan.update]
+    replaced = [old for old, new in plan.update]
+
+    sql = "".join(sql_gen.drop_sql() for sql_gen in plan.remove)
+    sql += "".join(new.replace_sql(old) for old, new in plan.update)
+    sql += "".join(sql_gen.create_sql() for sql_gen in plan.create)
+    tables = [table for sql_gen in new_generators + replaced + plan.remove
+              for table in (sql_gen.source_table, sql_gen.target_table)]
+    sql += regenerate_dispatch_sql(conn, tables, new_generators=new_generators,
+                                   removed_ids=[sql_gen.trg_fcn_id for sql_gen in plan.remove + replaced])
+    return sql
+
+
+def apply_plan(conn, plan, **lock_options):
+    """Applies the plan in one transaction sent in one round trip.
+    lock_options are passed to execute_ddl() (lock_timeout, statement_timeout, retries)."""
+    if plan.is_empty():
+        return
+    sql = deployment_sql(conn, plan)
+    execute_ddl(conn, [sql], **lock_options)
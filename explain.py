@@ -0,0 +1,209 @@
+# encoding: utf-8
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+"""
+Dry-run preview of a trigger pair before it is installed.
+
+The lookup done for every target row and the invalidation (re-sampling of target rows after
+a source feature is edited) are explained with geometries of a few existing features. Plans show
+whether the spatial indexes are used and how many target rows an edit touches. With analyze=True
+the queries are also executed (EXPLAIN ANALYZE) in a transaction which is rolled back,
+which gives the projected time of sampling the existing target rows.
+"""
+
+import copy
+import json
+
+import psycopg2
+
+INDEX_SCANS = ('Index Scan', 'Index Only Scan', 'Bitmap Index Scan', 'Bitmap Heap Scan')
+LARGE_INVALIDATION = 10000  # warn if a single source edit re-samples more target rows
+
+
+class PairPreview:
+    """ Result of the preview of one trigger pair """
+
+    def __init__(self, sql_gen):
+        self.sql_gen = sql_gen
+        self.target_rows = 0          # estimated number of rows of the target table
+        self.lookup_scans = {}        # table -> set of scan types ('index' or 'seq') in the lookup plan
+        self.invalidation_scans = {}  # the same for the invalidation plan
+        self.rows_per_edit = None     # estimated target rows re-sampled by an edit of one source feature
+        self.lookup_ms = None         # average time of a lookup (only with analyze)
+        self.invalidation_ms = None   # average time of the invalidation (only with analyze)
+        self.warnings = []
+        self.errors = []
+
+    def backfill_seconds(self, workers=1):
+        """Returns projected time of sampling all existing target rows or None if not known"""
+        if self.lookup_ms is None:
+            return None
+        return self.lookup_ms * self.target_rows / 1000.0 / max(1, workers)
+
+    def describe(self):
+        """Returns list of lines of the report"""
+        lines = ["%s -> %s" % (self.sql_gen.source_table, self.sql_gen.target_table)]
+        for name, scans in (("lookup", self.lookup_scans), ("invalidation", self.invalidation_scans)):
+            if scans:
+                lines.append("  %s: %s" % (name, ", ".join("%s (%s)" % (table, "/".join(sorted(types)))
+                                                          for table, types in sorted(scans.items()))))
+        if self.rows_per_edit is not None:
+            lines.append("  target rows re-sampled per source edit: ~%d" % self.rows_per_edit)
+        if self.lookup_ms is not None:
+            lines.append("  lookup: %.2f ms, invalidation: %s" % (
+                self.lookup_ms, "%.2f ms" % self.invalidation_ms if self.invalidation_ms is not None else "?"))
+            lines.append("  projected resync of %d target rows: %.0f s" % (self.target_rows, self.backfill_seconds()))
+        lines += ["  WARNING: " + warning for warning in self.warnings]
+        lines += ["  ERROR: " + error for error in self.errors]
+        return lines
+
+
+def _plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        for node in _plan_nodes(child):
+            yield node
+
+
+def _scans(plan):
+    """Returns dictionary table -> set of scan types of the plan"""
+    scans = {}
+    for node in _plan_nodes(plan):
+        if 'Relation Name' not in node:
+            continue
+        table = "%s.%s" % (node.get('Schema', 'public'), node['Relation Name'])
+        if node['Node Type'] == 'Seq Scan':
+            scans.setdefault(table, set()).add('seq')
+        elif node['Node Type'] in INDEX_SCANS:
+            scans.setdefault(table, set()).add('index')
+    return scans
+
+
+def _explain(conn, sql, analyze):
+    """Returns tuple (top plan node, execution time in ms or None). Executed statements are rolled back."""
+    cur = conn.cursor()
+    try:
+        cur.execute("SET LOCAL lock_timeout = '2s'")
+        cur.execute("EXPLAIN (VERBOSE, FORMAT JSON%s) %s" % (", ANALYZE" if analyze else "", sql))
+        result = cur.fetchone()[0]
+    finally:
+        conn.rollback()
+    if isinstance(result, str):
+        result = json.loads(result)
+    return result[0]['Plan'], result[0].get('Execution Time')
+
+
+def _sample_rows(conn, table, count):
+    """Returns list of (ctid, hex EWKB geometry) of a few rows of the table"""
+    cur = conn.cursor()
+    cur.execute("SELECT ctid::text, geom::text FROM %s WHERE geom IS NOT NULL LIMIT %d" % (table, count))
+    rows = cur.fetchall()
+    conn.rollback()
+    return rows
+
+
+def _table_rows(conn, table):
+    """Returns estimated number of rows of the table or None if it does not exist"""
+    cur = conn.cursor()
+    cur.execute("SELECT greatest(reltuples, 0)::bigint FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+    row = cur.fetchone()
+    conn.rollback()
+    return row[0] if row else None
+
+
+def _average(values):
+    values = [value for value in values if value is not None]
+    return sum(values) / len(values) if values else None
+
+
+def preview_pair(conn, sql_gen, analyze=False, samples=5):
+    """Returns PairPreview of the pair (the pair does not need to be installed). The ID of an installed
+    pair is needed to check lookups in its table of subdivided source geometries, new pairs have ID None."""
+    sql_gen = copy.copy(sql_gen)
+    preview = PairPreview(sql_gen)
+    try:
+        if sql_gen._uses_subdivided() and (sql_gen.trg_fcn_id is None or
+                                           _table_rows(conn, sql_gen.subdivided_table()) is None):
+            sql_gen.subdivide = False
+            preview.warnings.append("the table with subdivided source geometries does not exist yet, "
+                                    "lookups are checked with whole source geometries")
+        if sql_gen.trg_fcn_id is None:
+            sql_gen.trg_fcn_id = 0  # not installed yet
+        preview.target_rows = _table_rows(conn, sql_gen.target_table) or 0
+        target_samples = _sample_rows(conn, sql_gen.target_table, samples)
+        source_samples = _sample_rows(conn, sql_gen.source_table, samples)
+    except psycopg2.Error as e:
+        conn.rollback()
+        preview.errors.append(str(e).strip())
+        return preview
+
+    # lookup of source attributes for a target row (target trigger and resync)
+    lookup_times = []
+    for ctid, geom in target_samples:
+        geom_expr = "'%s'::geometry" % geom
+        sql = sql_gen._aggregate_lookup_sql(geom_expr) if sql_gen.agg_map else sql_gen._lookup_sql(geom_expr)
+        try:
+            plan, ms = _explain(conn, sql, analyze)
+        except psycopg2.Error as e:
+            preview.errors.append("lookup: " + str(e).strip())
+            break
+        for table, types in _scans(plan).items():
+            preview.lookup_scans.setdefault(table, set()).update(types)
+        lookup_times.append(ms)
+
+    # re-sampling of target rows after an edit of a source feature
+    rows_estimates = []
+    invalidation_times = []
+    for ctid, geom in source_samples:
+        if sql_gen.agg_map:
+            sql = sql_gen._aggregate_delta_sql("SELECT * FROM %s WHERE ctid = '%s'::tid" % (sql_gen.source_table, ctid),
+                                               removed=False)
+        else:
+            sql = sql_gen.refresh_sql("SELECT '%s'::geometry AS geom" % geom)
+        try:
+            plan, ms = _explain(conn, sql.strip().rstrip(';'), analyze)
+        except psycopg2.Error as e:
+            preview.errors.append("invalidation: " + str(e).strip())
+            break
+        for table, types in _scans(plan).items():
+            preview.invalidation_scans.setdefault(table, set()).update(types)
+        modified = plan['Plans'][0] if plan.get('Plans') else plan
+        rows_estimates.append(modified.get('Actual Rows', modified['Plan Rows']))
+        invalidation_times.append(ms)
+
+    preview.rows_per_edit = _average(rows_estimates)
+    if analyze:
+        preview.lookup_ms = _average(lookup_times)
+        preview.invalidation_ms = _average(invalidation_times)
+
+    source_tables = [sql_gen.source_table, sql_gen.subdivided_table()]
+    for table in source_tables:
+        if 'seq' in preview.lookup_scans.get(table, ()):
+            preview.warnings.append("lookups scan the whole source table %s - is there a spatial index on it?" % table)
+    if 'seq' in preview.invalidation_scans.get(sql_gen.target_table, ()):
+        preview.warnings.append("edits of source features scan the whole target table %s - is there a spatial index on it?"
+                                % sql_gen.target_table)
+    if preview.rows_per_edit is not None and preview.rows_per_edit > LARGE_INVALIDATION:
+        preview.warnings.append("an edit of a source feature re-samples about %d target rows" % preview.rows_per_edit)
+    if not target_samples:
+        preview.warnings.append("target table is empty, the lookup could not be checked")
+    if not source_samples:
+        preview.warnings.append("source table is empty, the invalidation could not be checked")
+    return preview
+
+
+def preview_pairs(conn, generators, analyze=False, samples=5, progress=None):
+    """Returns list of PairPreview of the pairs. progress(done, total) is called after each pair."""
+    previews = []
+    for i, sql_gen in enumerate(generators):
+        previews.append(preview_pair(conn, sql_gen, analyze, samples))
+        if progress is not None:
+            progress(i + 1, len(generators))
+    return previews
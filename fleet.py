@@ -0,0 +1,185 @@
+# encoding: utf-8
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+"""
+Deployment of the same trigger pairs to many databases at once (see deploy.py).
+
+Databases are processed concurrently by a bounded pool of threads (the work is done by the servers),
+each of them in its own transaction, so a failure of one database does not affect the others.
+Slow databases are limited by connect and statement timeouts. Databases are listed in a file,
+one libpq connection string per line, optionally preceded by a name and a tab:
+
+  python -m postgis_sampling_tool.fleet apply --databases regions.txt --workers 8 pairs.json
+"""
+
+import argparse
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+import psycopg2.extensions
+
+from .ddl import LOCK_TIMEOUT, RETRIES
+from .deploy import parse_pairs, plan_deployment, plan_removal, apply_plan
+from .sql_generator import init_registry, list_invalid_triggers, list_missing_indexes
+
+ACTIONS = ('apply', 'diff', 'validate', 'remove')
+
+
+class DatabaseResult:
+    """ Outcome of an action on one database """
+
+    def __init__(self, name):
+        self.name = name
+        self.status = 'ok'  # 'ok', 'changed' (differences found or applied), 'invalid' or 'failed'
+        self.lines = []     # changes or problems
+        self.error = None
+        self.seconds = 0.0
+
+    def to_dict(self):
+        return {'name': self.name, 'status': self.status, 'lines': self.lines, 'error': self.error,
+                'seconds': round(self.seconds, 3)}
+
+
+def read_databases(path):
+    """Returns list of (name, connection string) from a file of databases"""
+    databases = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if '\t' in line:
+                name, dsn = line.split('\t', 1)
+            else:
+                name, dsn = database_name(line), line
+            databases.append((name.strip(), dsn.strip()))
+    return databases
+
+
+def database_name(dsn):
+    """Returns name of the database for reports, without the password"""
+    try:
+        params = psycopg2.extensions.parse_dsn(dsn)
+    except psycopg2.Error:
+        return dsn
+    return "%s/%s" % (params.get('host', 'localhost'), params.get('dbname', ''))
+
+
+def run_action(action, name, dsn, document, prune=False, timeout=60, lock_timeout=LOCK_TIMEOUT, retries=RETRIES):
+    """Runs the action with the deployment document (decoded JSON) on one database. Never raises."""
+    result = DatabaseResult(name)
+    start = time.time()
+    try:
+        conn = psycopg2.connect(dsn, connect_timeout=max(1, int(timeout)),
+                                options="-c statement_timeout=%d" % (timeout * 1000))
+        try:
+            generators = parse_pairs(document)   # own copy - IDs are assigned per database
+            if action == 'validate':
+                init_registry(conn)
+                invalid = list_invalid_triggers(conn)
+                for trigger_id in sorted(invalid):
+                    result.lines.append("! [%d] %s" % (trigger_id, "; ".join(invalid[trigger_id])))
+                missing = list_missing_indexes(conn)
+                for trigger_id in sorted(missing):
+                    result.lines.append("? [%d] %s" % (trigger_id, "; ".join(missing[trigger_id])))
+            if action == 'remove':
+                plan = plan_removal(conn, generators)
+            else:
+                plan = plan_deployment(conn, generators, prune)
+            result.lines += plan.describe()
+            if action in ('apply', 'remove'):
+                apply_plan(conn, plan, lock_timeout=lock_timeout, retries=retries)
+            if action == 'validate' and (invalid or missing):
+                result.status = 'invalid'
+            elif not plan.is_empty():
+                result.status = 'changed'
+        finally:
+            conn.close()
+    except Exception as e:
+        result.status = 'failed'
+        result.error = str(e).strip()
+    result.seconds = time.time() - start
+    return result
+
+
+def run_fleet(action, databases, document, workers=4, prune=False, timeout=60, progress=None,
+              lock_timeout=LOCK_TIMEOUT, retries=RETRIES):
+    """Runs the action on all databases (list of (name, connection string)) concurrently.
+    progress(result) is called from the calling thread after each database. Returns list of DatabaseResult
+    in the order of databases."""
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(run_action, action, name, dsn, document, prune, timeout, lock_timeout, retries)
+                   for name, dsn in databases]
+        results = []
+        for future in futures:
+            results.append(future.result())
+            if progress is not None:
+                progress(results[-1])
+    return results
+
+
+def summary(results):
+    """Returns dictionary status -> number of databases"""
+    counts = dict((status, 0) for status in ('ok', 'changed', 'invalid', 'failed'))
+    for result in results:
+        counts[result.status] += 1
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Deployment of PostGIS Sampling Tool trigger pairs to many databases")
+    parser.add_argument("action", choices=ACTIONS,
+                        help="apply (install or upgrade), diff, validate (diff, broken pairs and missing indexes) or remove the pairs")
+    parser.add_argument("file", help="deployment file (JSON)")
+    parser.add_argument("--databases", required=True, help="file with connection strings, one per line")
+    parser.add_argument("--workers", type=int, default=4, help="number of databases processed at once")
+    parser.add_argument("--timeout", type=int, default=60, help="connect and statement timeout in seconds")
+    parser.add_argument("--prune", action="store_true", help="remove registered pairs which are not in the file")
+    parser.add_argument("--lock-timeout", type=int, default=LOCK_TIMEOUT,
+                        help="maximum wait for a lock of a busy table in ms before the transaction is retried")
+    parser.add_argument("--retries", type=int, default=RETRIES, help="number of retries when tables are busy")
+    parser.add_argument("--json", action="store_true", help="write results as JSON to standard output")
+    args = parser.parse_args(argv)
+
+    with open(args.file) as f:
+        document = json.load(f)
+    try:
+        parse_pairs(document)   # report errors of the file once, not for each database
+    except ValueError as e:
+        sys.stderr.write("%s: %s\n" % (args.file, e))
+        return 1
+    databases = read_databases(args.databases)
+
+    def progress(result):
+        if args.json:
+            return
+        print("%s: %s (%.1f s)" % (result.name, result.status, result.seconds))
+        for line in result.lines:
+            print("  " + line)
+        if result.error:
+            print("  " + result.error.replace("\n", "\n  "))
+
+    results = run_fleet(args.action, databases, document, args.workers, args.prune, args.timeout, progress,
+                        args.lock_timeout, args.retries)
+    counts = summary(results)
+    if args.json:
+        json.dump({'summary': counts, 'databases': [result.to_dict() for result in results]}, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        print("%d databases: %d ok, %d changed, %d invalid, %d failed" % (
+            len(results), counts['ok'], counts['changed'], counts['invalid'], counts['failed']))
+    return 1 if counts['failed'] or counts['invalid'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
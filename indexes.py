@@ -0,0 +1,137 @@
+# encoding: utf-8
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+"""
+Indexes needed by the triggers of a pair.
+
+Every lookup and re-sampling is a spatial query, so without a GiST index on "geom" of the source
+and target tables each edit scans a whole table. Pairs taking the source feature ordered by
+a column also need a btree index on it. Missing indexes are built with CREATE INDEX CONCURRENTLY,
+which does not block writers but cannot run inside a transaction - they are created one by one
+in autocommit mode, never together with the triggers.
+"""
+
+import psycopg2
+
+# an index counts if the column is its first key, it is valid and not partial
+_index_exists_query = """SELECT EXISTS (
+    SELECT 1 FROM pg_index i
+    JOIN pg_class ic ON ic.oid = i.indexrelid
+    JOIN pg_am am ON am.oid = ic.relam
+    JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+    WHERE i.indrelid = to_regclass(%s) AND a.attname = %s AND am.amname = %s AND i.indisvalid AND i.indpred IS NULL)"""
+
+
+def required_indexes(sql_gen):
+    """Returns list of (table, column, method) of indexes the triggers of the pair rely on"""
+    indexes = [(sql_gen.source_table, 'geom', 'gist'), (sql_gen.target_table, 'geom', 'gist')]
+    if sql_gen.predicate != 'nearest' and sql_gen.order_by in ('column', 'column_desc') and sql_gen.order_column \
+            and not sql_gen.agg_map:
+        indexes.append((sql_gen.source_table, sql_gen.order_column, 'btree'))
+    return indexes
+
+
+def missing_indexes(conn, generators):
+    """Returns list of (table, column, method) of indexes needed by the pairs which do not exist"""
+    cur = conn.cursor()
+    missing = []
+    for sql_gen in generators:
+        for index in required_indexes(sql_gen):
+            if index in missing:
+                continue
+            cur.execute(_index_exists_query, index)
+            if not cur.fetchone()[0]:
+                missing.append(index)
+    conn.rollback()
+    return missing
+
+
+def index_name(table, column, method):
+    """Returns schema-qualified name of the index created for the column"""
+    schema, _, name = table.rpartition('.')
+    suffix = "_%s_idx" % method
+    name = ("%s_%s" % (name, column))[:63 - len(suffix)] + suffix
+    return "%s.%s" % (schema, name) if schema else name
+
+
+def create_index_sql(table, column, method):
+    return "CREATE INDEX CONCURRENTLY IF NOT EXISTS %s ON %s USING %s (%s)" % (
+        index_name(table, column, method).rpartition('.')[2], table, method, column)
+
+
+def _drop_invalid_index(cur, name):
+    """Drops an index left invalid by an interrupted CREATE INDEX CONCURRENTLY"""
+    cur.execute("SELECT EXISTS (SELECT 1 FROM pg_index WHERE indexrelid = to_regclass(%s) AND NOT indisvalid)", (name,))
+    if cur.fetchone()[0]:
+        cur.execute("DROP INDEX CONCURRENTLY IF EXISTS %s" % name)
+
+
+def create_indexes(conn, indexes, progress=None):
+    """Creates the indexes (list of (table, column, method)) concurrently, each in its own transaction.
+    progress(done, total, text) is called before each index. An index interrupted by an error or
+    by conn.cancel() is dropped again and the error is raised."""
+    conn.rollback()
+    conn.autocommit = True
+    try:
+        cur = conn.cursor()
+        for i, index in enumerate(indexes):
+            name = index_name(*index)
+            if progress is not None:
+                progress(i, len(indexes), "Creating index %s..." % name)
+            _drop_invalid_index(cur, name)
+            try:
+                cur.execute(create_index_sql(*index))
+            except psycopg2.Error:
+                _drop_invalid_index(cur, name)
+                raise
+    finally:
+        conn.autocommit = False
+
+
+def offer_missing_indexes(parent, conn, generators):
+    """Checks indexes needed by the pairs and offers to create the missing ones, with a progress dialog.
+    Returns False if the user wants to get back to the configuration."""
+    from qgis.PyQt.QtWidgets import QMessageBox   # only the dialogs need Qt
+    from .db_task import run_task, TaskCanceled
+
+    try:
+        missing = run_task(parent, conn, "Checking indexes...", lambda task: missing_indexes(conn, generators))
+    except TaskCanceled:
+        return True
+    if not missing:
+        return True
+
+    res = QMessageBox.question(
+        parent, "PostGIS Sampling Tool",
+        "The triggers need these indexes, without them every edit scans the whole table:\n\n" +
+        "\n".join("%s index on %s of %s" % (method, column, table) for table, column, method in missing) +
+        "\n\nDo you want to create them now? Indexes are built without blocking edits of the tables, "
+        "but it may take a while on large tables.",
+        QMessageBox.Yes | QMessageBox.No | QMessageBox.Cancel)
+    if res == QMessageBox.Cancel:
+        return False
+    if res == QMessageBox.No:
+        return True
+
+    def create(task):
+        def progress(done, total, text):
+            task.check_canceled()
+            task.set_progress(done, total, text)
+        create_indexes(conn, missing, progress)
+
+    try:
+        run_task(parent, conn, "Creating indexes...", create)
+    except TaskCanceled:
+        QMessageBox.information(parent, "PostGIS Sampling Tool", "Creating of the indexes has been cancelled.")
+        return False
+    except psycopg2.Error as e:
+        QMessageBox.critical(parent, "Error", "Creating of the indexes failed:\n\n" + str(e))
+        return False
+    return True
@@ -0,0 +1,111 @@
+# encoding: utf-8
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+"""
+Pairing of source and target names (tables or fields) used by the trigger wizard.
+
+Names on both sides are normalized by a rule (strip a prefix or suffix, take a regular expression
+group, ignore case) and pairs are looked up in a dictionary of normalized target names, so pairing
+thousands of names takes linear time. Normalized lists are cached, so when only one side's rule
+or names change, the other side is not normalized again.
+"""
+
+import re
+
+# matching rules - same order as items of the combo boxes in the wizard
+SAME_NAME = 0
+PREFIX_SOURCE = 1
+SUFFIX_SOURCE = 2
+PREFIX_TARGET = 3
+SUFFIX_TARGET = 4
+REGEX = 5
+
+_cache = {}  # key = (names, side rule), value = list of (name, normalized name)
+_cache_size = 64
+
+
+class MatchRule:
+    """ Rule for normalization of names of one side """
+
+    def __init__(self, prefix='', suffix='', regex=None, case_insensitive=False):
+        self.prefix = prefix
+        self.suffix = suffix
+        self.regex = regex
+        self.case_insensitive = case_insensitive
+
+    def key(self):
+        return (self.prefix, self.suffix, self.regex, self.case_insensitive)
+
+    def normalize(self, name):
+        """Returns normalized name or None if the name does not follow the rule (it is not paired at all)"""
+        if self.case_insensitive:
+            name = name.lower()
+        if self.regex is not None:
+            try:
+                m = re.search(self.regex, name, re.IGNORECASE if self.case_insensitive else 0)
+            except re.error:
+                return None   # incomplete expression while typing
+            if m is None:
+                return None
+            return m.group(1) if m.groups() else m.group(0)
+        prefix = self.prefix.lower() if self.case_insensitive else self.prefix
+        suffix = self.suffix.lower() if self.case_insensitive else self.suffix
+        if not name.startswith(prefix) or not name.endswith(suffix) or len(name) < len(prefix) + len(suffix):
+            return None
+        return name[len(prefix):len(name) - len(suffix)]
+
+
+def rules_from_option(option, text, case_insensitive=False):
+    """Returns tuple (source rule, target rule) for an option of the wizard combo box and the entered text"""
+    source = MatchRule(case_insensitive=case_insensitive)
+    target = MatchRule(case_insensitive=case_insensitive)
+    if option == PREFIX_SOURCE:
+        source.prefix = text
+    elif option == SUFFIX_SOURCE:
+        source.suffix = text
+    elif option == PREFIX_TARGET:
+        target.prefix = text
+    elif option == SUFFIX_TARGET:
+        target.suffix = text
+    elif option == REGEX and text:
+        # the expression is applied to both sides, its first group (or the whole match) is compared
+        source.regex = text
+        target.regex = text
+    return source, target
+
+
+def _normalized(names, rule):
+    """Returns list of (name, normalized name) of names following the rule - cached"""
+    key = (names, rule.key())
+    result = _cache.get(key)
+    if result is None:
+        if len(_cache) >= _cache_size:
+            _cache.clear()
+        result = []
+        for name in names:
+            normalized = rule.normalize(name)
+            if normalized is not None:
+                result.append((name, normalized))
+        _cache[key] = result
+    return result
+
+
+def match_names(sources, targets, source_rule, target_rule):
+    """Returns list of pairs (source name, target name) with the same normalized names,
+    in the order of source names (and target names for a source matching several targets)"""
+    index = {}  # key = normalized name, value = list of target names
+    for name, normalized in _normalized(tuple(targets), target_rule):
+        index.setdefault(normalized, []).append(name)
+
+    pairs = []
+    for name, normalized in _normalized(tuple(sources), source_rule):
+        for target in index.get(normalized, []):
+            pairs.append((name, target))
+    return pairs
@@ -1 +1,18 @@
-rm -f postgis_sampling_tool.zip && git archive --prefix=postgis_sampling_tool/ -o postgis_sampling_tool.zip HEAD
\ No newline at end of file
+#!/bin/sh
+# Usage: package.sh [--compile-ui]
+#   --compile-ui  include UI modules pre-compiled by pyuic5 (faster opening of the dialogs)
+
+rm -f postgis_sampling_tool.zip && git archive --prefix=postgis_sampling_tool/ -o postgis_sampling_tool.zip HEAD || exit 1
+
+if [ "$1" = "--compile-ui" ]; then
+  tmp_dir=$(mktemp -d)
+  ui_dir=$tmp_dir/postgis_sampling_tool/ui_compiled
+  mkdir -p $ui_dir
+  touch $ui_dir/__init__.py
+  for ui in config_dialog trigger_dialog wizard_dialog; do
+    git show HEAD:$ui.ui > $tmp_dir/$ui.ui && pyuic5 -o $ui_dir/$ui.py $tmp_dir/$ui.ui || exit 1
+  done
+  zip_file=$(pwd)/postgis_sampling_tool.zip
+  (cd $tmp_dir && zip -qr $zip_file postgis_sampling_tool/ui_compiled)
+  rm -rf $tmp_dir
+fi
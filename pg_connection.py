@@ -19,6 +19,47 @@ from qgis.core import QgsDataSourceUri, QgsCredentials
 from qgis.PyQt.QtCore import QSettings
 
 
+_connections = {}  # key = connection name, value = open psycopg2 connection
+
+
+def cached_connection(name):
+    """Returns connection for the name reused within the session.
+    A broken connection (e.g. closed by the server or a pooler) is replaced by a new one."""
+    conn = _connections.get(name)
+    if conn is not None and not _is_alive(conn):
+        close_connections(name)
+        conn = None
+    if conn is None:
+        conn = connection_from_name(name)
+        _connections[name] = conn
+    return conn
+
+
+def _is_alive(conn):
+    if conn.closed:
+        return False
+    try:
+        conn.rollback()   # a transaction may have been left open by an error
+        cur = conn.cursor()
+        cur.execute("SELECT 1")
+        cur.fetchone()
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def close_connections(name=None):
+    """Closes cached connections (only the one with the given name if set)"""
+    for key in list(_connections.keys()):
+        if name is None or key == name:
+            conn = _connections.pop(key)
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+
+
 def connection_from_name(name):
     settings = QSettings()
     settings.beginGroup(u"/PostgreSQL/connections/%s" % name)
@@ -0,0 +1,179 @@
+# encoding: utf-8
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+"""
+Background worker for triggers in the deferred mode.
+
+Source triggers in the deferred mode only put bounding boxes of changed features to the queue
+table, the worker drains the queue in batches and re-samples the affected target rows.
+Batches are claimed with SELECT ... FOR UPDATE SKIP LOCKED, so several workers may run in parallel.
+
+It does not need QGIS GUI, it can be started from the directory containing the plugin:
+
+  python -m postgis_sampling_tool.queue_worker --dsn "host=localhost dbname=gis"
+  python -m postgis_sampling_tool.queue_worker --dsn "host=localhost dbname=gis" --stats
+
+Entries of a pair which cannot be re-sampled (e.g. a mapped column has been dropped) are moved to
+the table of failed entries, so that they do not block the queue, and can be queued again later.
+"""
+
+import argparse
+import select
+import sys
+
+import psycopg2
+import psycopg2.extensions
+
+from .sql_generator import load_sql_generator, queue_sql, queue_table, queue_channel
+
+
+def queue_stats(conn):
+    """Returns list of tuples (trigger_id, depth, lag in seconds) for triggers with non-empty queue"""
+    cur = conn.cursor()
+    cur.execute("SELECT to_regclass('%s')" % queue_table)
+    if cur.fetchone()[0] is None:
+        return []   # no trigger in the deferred mode has been created yet
+    cur.execute("""SELECT trg_fcn_id, depth, extract(epoch FROM lag)
+                   FROM %s_stats ORDER BY trg_fcn_id""" % queue_table)
+    stats = cur.fetchall()
+    conn.commit()
+    return stats
+
+
+# errors caused by the configuration of a pair or by the data - unlike errors of the connection or the server
+# (including cancelled queries and deadlocks) retrying the entries would fail again
+_entry_errors = (psycopg2.ProgrammingError, psycopg2.IntegrityError, psycopg2.DataError, psycopg2.InternalError,
+                 psycopg2.NotSupportedError)
+
+
+def process_batch(conn, batch_size=1000, on_error=None):
+    """Claims up to batch_size queue entries, re-samples target rows within their bounding boxes
+    and removes the entries - all in one transaction. Returns number of processed entries.
+
+    When re-sampling of a trigger fails (e.g. a mapped column has been dropped), its entries are moved
+    to the table of failed entries and on_error(trigger_id, entry_count, error) is called, so that
+    they do not block the queue. Errors of the connection or the server are raised."""
+    cur = conn.cursor()
+    cur.execute("""SELECT id, trg_fcn_id FROM %s
+                   ORDER BY id LIMIT %%s FOR UPDATE SKIP LOCKED""" % queue_table, (batch_size,))
+    rows = cur.fetchall()
+    if not rows:
+        conn.commit()
+        return 0
+
+    entries = {}  # key = trigger ID, value = list of queue entry IDs
+    for entry_id, trigger_id in rows:
+        entries.setdefault(trigger_id, []).append(entry_id)
+
+    try:
+        for trigger_id, entry_ids in entries.items():
+            cur.execute("SAVEPOINT dsp_trigger")
+            try:
+                sql_gen = load_sql_generator(conn, trigger_id)
+                if sql_gen is None:
+                    continue  # the trigger has been removed meanwhile - just drop its entries
+                area_sql = "SELECT bbox AS geom FROM %s WHERE id = ANY(%%(ids)s)" % queue_table
+                cur.execute(sql_gen.refresh_sql(area_sql), {'ids': entry_ids})
+            except _entry_errors as e:
+                cur.execute("ROLLBACK TO SAVEPOINT dsp_trigger")
+                cur.execute("""INSERT INTO %(queue_table)s_failed (id, trg_fcn_id, bbox, enqueued_at, error)
+                               SELECT id, trg_fcn_id, bbox, enqueued_at, %%s FROM %(queue_table)s WHERE id = ANY(%%s)
+                               ON CONFLICT (id) DO NOTHING""" % {'queue_table': queue_table}, (str(e).strip(), entry_ids))
+                if on_error is not None:
+                    on_error(trigger_id, len(entry_ids), e)
+
+        cur.execute("DELETE FROM %s WHERE id = ANY(%%s)" % queue_table, ([row[0] for row in rows],))
+        conn.commit()
+    except psycopg2.extensions.TransactionRollbackError:
+        # deadlock with another worker updating the same target rows - the entries stay queued
+        conn.rollback()
+        return 0
+
+    return len(rows)
+
+
+def requeue_failed(conn, trigger_id=None):
+    """Moves failed entries (of the trigger or all of them) back to the queue, e.g. after the pair has been fixed.
+    Returns number of queued entries."""
+    cur = conn.cursor()
+    cur.execute("""WITH moved AS (
+                       DELETE FROM %(queue_table)s_failed WHERE %%(trigger_id)s IS NULL OR trg_fcn_id = %%(trigger_id)s
+                       RETURNING id, trg_fcn_id, bbox, enqueued_at)
+                   INSERT INTO %(queue_table)s (id, trg_fcn_id, bbox, enqueued_at)
+                   SELECT id, trg_fcn_id, bbox, enqueued_at FROM moved""" % {'queue_table': queue_table},
+                {'trigger_id': trigger_id})
+    count = cur.rowcount
+    cur.execute("NOTIFY %s" % queue_channel)
+    conn.commit()
+    return count
+
+
+def run_worker(conn, batch_size=1000, poll_interval=5.0, should_stop=None, on_error=None):
+    """Keeps processing the queue until should_stop() returns True (or forever).
+    When the queue is empty, waits for a notification from the triggers or for poll_interval seconds."""
+    cur = conn.cursor()
+    cur.execute(queue_sql())   # the table of failed entries may be missing in queues of older versions
+    cur.execute("LISTEN %s" % queue_channel)
+    conn.commit()
+
+    while should_stop is None or not should_stop():
+        if process_batch(conn, batch_size, on_error):
+            continue
+        if select.select([conn], [], [], poll_interval) != ([], [], []):
+            conn.poll()
+            del conn.notifies[:]
+
+
+def _report_error(trigger_id, entry_count, error):
+    sys.stderr.write("trigger %d: %d queue entries failed and were moved to %s_failed: %s\n" % (
+        trigger_id, entry_count, queue_table, str(error).strip()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Worker processing the queue of PostGIS Sampling Tool triggers in the deferred mode")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--dsn", help="libpq connection string")
+    group.add_argument("--connection", help="name of a PostGIS connection defined in QGIS")
+    parser.add_argument("--batch-size", type=int, default=1000, help="number of queue entries processed in one transaction")
+    parser.add_argument("--interval", type=float, default=5.0, help="seconds between polls of an empty queue")
+    parser.add_argument("--stats", action="store_true", help="print queue depth and lag of each trigger and exit")
+    parser.add_argument("--requeue-failed", action="store_true", help="move failed entries back to the queue and exit")
+    args = parser.parse_args(argv)
+
+    if args.dsn:
+        conn = psycopg2.connect(args.dsn)
+    else:
+        # QGIS application is needed to read the settings of the connection
+        from qgis.core import QgsApplication
+        from .pg_connection import connection_from_name
+        app = QgsApplication([], False)
+        app.initQgis()
+        conn = connection_from_name(args.connection)
+
+    if args.stats:
+        for trigger_id, depth, lag in queue_stats(conn):
+            print("%d\t%d\t%.1f" % (trigger_id, depth, lag))
+        return 0
+
+    if args.requeue_failed:
+        print("%d entries queued again" % requeue_failed(conn))
+        return 0
+
+    try:
+        run_worker(conn, args.batch_size, args.interval, on_error=_report_error)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,11 +7,46 @@ COMMENT ON TRIGGER dsp_trg_1_source_trigger ON test_dsp_source IS 'test comment
 SELECT obj_description( (SELECT oid FROM pg_trigger WHERE tgname='dsp_trg_1_source_trigger'), 'pg_trigger');
 """
 
+import hashlib
 import json
 
 # global configuration for prefixes of stored functions and triggers
 prefix_fcn = 'dsp_fcn'
 prefix_trg = 'dsp_trg'
+prefix_dispatch = 'dsp_dispatch'  # consolidated triggers shared by all pairs on a table
+
+# queue of dirty areas filled by triggers in the deferred mode (see queue_worker.py)
+queue_table = 'public.dsp_queue'
+queue_channel = 'dsp_queue'
+
+# finished chunks of running backfills, to be able to resume them (see backfill.py)
+backfill_table = 'public.dsp_backfill'
+
+# valid values of the configuration (see SqlGenerator)
+modes = ('row', 'statement', 'deferred')
+predicates = ('dwithin', 'intersects', 'contains', 'covers', 'nearest')
+orderings = ('', 'area', 'column', 'column_desc')
+overlaps = ('', 'largest', 'weighted')
+aggregates = ('count', 'sum', 'min', 'max', 'avg')
+
+# registry of trigger pairs with their configuration, IDs of new pairs come from its sequence
+registry_table = 'public.dsp_registry'
+# version of the generated SQL stored with each pair (0 = pairs migrated from older plugin versions,
+# 1 = without instrumentation)
+generator_version = 2
+
+# version of the objects shared by all pairs (the problems view of the registry, the statistics function and
+# the queue view), stored in their comments - they are only (re)created when missing or older, because only
+# their owner can replace them and replacing locks them
+shared_objects_version = 3
+
+# optional per-pair statistics recorded by the triggers when the "dsp.instrument" setting is on (see stats_sql())
+stats_table = 'public.dsp_stats'
+stats_function = 'public.dsp_record_stats'
+
+# optional event triggers repairing pairs after tables are renamed or dropped (see auto_repair_sql())
+repair_function = 'public.dsp_repair_triggers'
+repair_trigger = 'dsp_repair'
 
 
 def parse_trigger_name(trigger_name):
@@ -23,61 +58,488 @@ def parse_trigger_name(trigger_name):
     return (trigger_id, is_source)
 
 
-def list_triggers(conn):
+def _shared_objects_sql(kind, name, sql):
+    """Returns SQL executing sql (which creates a shared object and the tables it needs) only if the object
+    ('VIEW' or 'FUNCTION' with argument types) does not exist or has an older version in its comment.
+    Roles other than the owner cannot replace an existing object, they keep using the older version."""
+    if kind == 'VIEW':
+        oid, catalog = "to_regclass('%s')" % name, 'pg_class'
+    else:
+        oid, catalog = "to_regprocedure('%s')" % name, 'pg_proc'
+    return """
+        DO $shared$ BEGIN
+            IF coalesce(substring(obj_description(%(oid)s, '%(catalog)s') FROM '^dsp version ([0-9]+)$')::integer, 0) < %(version)d THEN
+                BEGIN
+                    %(sql)s
+                    COMMENT ON %(kind)s %(name)s IS 'dsp version %(version)d';
+                EXCEPTION WHEN insufficient_privilege THEN
+                    IF %(oid)s IS NULL THEN
+                        RAISE;
+                    END IF;
+                    RAISE NOTICE 'PostGIS Sampling Tool: %(name)s can be upgraded only by its owner';
+                END;
+            END IF;
+        END $shared$;
+        """ % {'oid': oid, 'catalog': catalog, 'version': shared_objects_version, 'sql': sql, 'kind': kind, 'name': name}
+
+
+def registry_sql():
+    """Returns SQL creating the registry of trigger pairs together with the view of problems
+    of the registered pairs (if they do not exist yet or are older)"""
+    return _shared_objects_sql('VIEW', registry_table + '_problems', """
+        CREATE SEQUENCE IF NOT EXISTS %(registry_table)s_id_seq;
+        CREATE TABLE IF NOT EXISTS %(registry_table)s (
+            trg_fcn_id integer PRIMARY KEY DEFAULT nextval('%(registry_table)s_id_seq'),
+            source_table regclass,  -- NULL or dangling OID if the table has been dropped
+            target_table regclass,
+            mode text,
+            config jsonb,  -- SqlGenerator.write_json()
+            version integer NOT NULL DEFAULT %(generator_version)d,
+            created_at timestamptz NOT NULL DEFAULT now()
+        );
+        CREATE INDEX IF NOT EXISTS dsp_registry_source_idx ON %(registry_table)s (source_table);
+        CREATE INDEX IF NOT EXISTS dsp_registry_target_idx ON %(registry_table)s (target_table);
+
+        -- everything which breaks registered pairs: tables of the pair must exist under the names
+        -- the trigger functions were generated with (a renamed table or schema breaks them), both triggers
+        -- must exist (and be enabled) on the registered tables, mapped columns must exist and both tables must have
+        -- a geometry column "geom" in the same SRID. Missing indexes (see indexes.py) do not break
+        -- the pair but make every edit scan the whole table, they are reported as 'missing_index'.
+        CREATE OR REPLACE VIEW %(registry_table)s_problems AS
+        WITH pair AS (
+            SELECT r.trg_fcn_id, r.config, side.name AS side, side.stored_name,
+                   c.oid AS table_oid, n.nspname || '.' || c.relname AS current_name,
+                   -- consolidated pairs keep their own triggers disabled, the work is done by dispatch triggers
+                   coalesce((r.config->>'consolidate')::boolean, false) AND coalesce(r.config->>'mode', 'row') = 'row'
+                       AND coalesce(r.config->'agg_map', '{}') IN ('{}', 'null') AS dispatch
+            FROM %(registry_table)s r
+            CROSS JOIN LATERAL (VALUES ('source', r.source_table, r.config->>'source_table'),
+                                       ('target', r.target_table, r.config->>'target_table')) side(name, tbl, stored_name)
+            LEFT JOIN pg_class c ON c.oid = side.tbl
+            LEFT JOIN pg_namespace n ON n.oid = c.relnamespace
+        ),
+        required_column AS (
+            SELECT trg_fcn_id, side, table_oid, current_name, col FROM pair
+            CROSS JOIN LATERAL (
+                SELECT jsonb_object_keys(config->'attr_map') WHERE side = 'source'
+                UNION ALL SELECT value FROM jsonb_each_text(config->'attr_map') WHERE side = 'target'
+                UNION ALL SELECT jsonb_object_keys(config->'agg_map') WHERE side = 'target'
+                UNION ALL SELECT value->>1 FROM jsonb_each(config->'agg_map') WHERE side = 'source' AND value->>0 <> 'count'
+                UNION ALL SELECT config->>'order_column' WHERE side = 'source' AND config->>'order_by' IN ('column', 'column_desc')
+                UNION ALL SELECT config->>'source_key' WHERE side = 'source' AND (config->>'subdivide')::boolean
+            ) required(col)
+            WHERE table_oid IS NOT NULL AND col IS NOT NULL
+        ),
+        required_index AS (
+            SELECT trg_fcn_id, side, table_oid, current_name, col, method FROM pair
+            CROSS JOIN LATERAL (
+                SELECT 'geom', 'gist'
+                UNION ALL SELECT config->>'order_column', 'btree'
+                WHERE side = 'source' AND config->>'order_by' IN ('column', 'column_desc')
+                  AND coalesce(config->>'predicate', '') <> 'nearest' AND coalesce(config->'agg_map', '{}') IN ('{}', 'null')
+            ) required(col, method)
+            WHERE table_oid IS NOT NULL AND col IS NOT NULL
+        ),
+        geom AS (
+            SELECT pair.trg_fcn_id, pair.side, pair.current_name, a.atttypmod, t.typname
+            FROM pair
+            LEFT JOIN pg_attribute a ON a.attrelid = pair.table_oid AND a.attname = 'geom' AND NOT a.attisdropped
+            LEFT JOIN pg_type t ON t.oid = a.atttypid
+            WHERE pair.table_oid IS NOT NULL
+        )
+        SELECT trg_fcn_id, side, 'config' AS problem, 'configuration of the pair is missing' AS reason,
+               NULL::text AS stored_name, NULL::text AS current_name
+        FROM pair WHERE side = 'source' AND config IS NULL
+        UNION ALL
+        SELECT trg_fcn_id, side, 'missing_table', side || ' table does not exist', stored_name, NULL
+        FROM pair WHERE table_oid IS NULL
+        UNION ALL
+        SELECT trg_fcn_id, side, 'renamed', side || ' table ' || stored_name || ' has been renamed to ' || current_name, stored_name, current_name
+        FROM pair WHERE table_oid IS NOT NULL AND stored_name IS NOT NULL AND stored_name <> current_name
+        UNION ALL
+        SELECT trg_fcn_id, side, 'missing_trigger', side || ' trigger is missing on ' || current_name, stored_name, current_name
+        FROM pair
+        WHERE table_oid IS NOT NULL AND NOT EXISTS (
+            SELECT 1 FROM pg_trigger WHERE tgrelid = pair.table_oid AND tgname = '%(prefix_trg)s_' || pair.trg_fcn_id || '_' || pair.side || '_trigger')
+        UNION ALL
+        SELECT trg_fcn_id, side, 'disabled_trigger', side || ' trigger ' || t.tgname || ' is disabled on ' || current_name, stored_name, current_name
+        FROM pair
+        JOIN pg_trigger t ON t.tgrelid = pair.table_oid AND t.tgenabled = 'D' AND t.tgname LIKE '%%\\_' || pair.side || '\\_trigger'
+            AND t.tgname LIKE CASE WHEN pair.dispatch THEN '%(prefix_dispatch)s\\_%%' ELSE '%(prefix_trg)s\\_' || pair.trg_fcn_id || '\\_%%' END
+        UNION ALL
+        SELECT trg_fcn_id, side, 'missing_column', 'column ' || col || ' of ' || side || ' table ' || current_name || ' does not exist', NULL, current_name
+        FROM required_column
+        WHERE NOT EXISTS (SELECT 1 FROM pg_attribute WHERE attrelid = table_oid AND attname = col AND NOT attisdropped)
+        UNION ALL
+        SELECT trg_fcn_id, side, 'geometry', side || ' table ' || current_name || ' has no geometry column geom', NULL, current_name
+        FROM geom WHERE typname IS DISTINCT FROM 'geometry'
+        UNION ALL
+        SELECT s.trg_fcn_id, 'source', 'srid', 'source and target geometries have different SRID', NULL, NULL
+        FROM geom s JOIN geom t ON t.trg_fcn_id = s.trg_fcn_id AND t.side = 'target'
+        WHERE s.side = 'source' AND s.typname = 'geometry' AND t.typname = 'geometry'
+          AND postgis_typmod_srid(s.atttypmod) > 0 AND postgis_typmod_srid(t.atttypmod) > 0
+          AND postgis_typmod_srid(s.atttypmod) <> postgis_typmod_srid(t.atttypmod)
+        UNION ALL
+        SELECT trg_fcn_id, side, 'missing_index', method || ' index on ' || col || ' of ' || side || ' table ' || current_name || ' is missing', NULL, current_name
+        FROM required_index r
+        WHERE EXISTS (SELECT 1 FROM pg_attribute WHERE attrelid = r.table_oid AND attname = r.col AND NOT attisdropped)
+          AND NOT EXISTS (
+            SELECT 1 FROM pg_index i
+            JOIN pg_class ic ON ic.oid = i.indexrelid
+            JOIN pg_am am ON am.oid = ic.relam
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+            WHERE i.indrelid = r.table_oid AND a.attname = r.col AND am.amname = r.method AND i.indisvalid AND i.indpred IS NULL);
+        """ % {'registry_table': registry_table, 'generator_version': generator_version, 'prefix_trg': prefix_trg,
+           'prefix_dispatch': prefix_dispatch})
+
+
+def auto_repair_sql():
+    """Returns SQL installing event triggers which keep registered pairs working after DDL changes.
+
+    When a table of a pair is renamed or moved to another schema (or its schema is renamed),
+    references in the generated functions are rewritten to the new name right away. When a table
+    or a mapped column of a pair is dropped, the remaining triggers of the pair are disabled so that
+    edits do not fail (consolidated pairs also disable dispatch triggers of their tables).
+    Creating event triggers needs superuser privileges.
+    """
+    return r"""
+        CREATE OR REPLACE FUNCTION %(repair_function)s() RETURNS event_trigger AS $$
+        DECLARE
+            pair RECORD;
+            fn RECORD;
+            trg RECORD;
+            old_sidecar text;
+            new_sidecar text;
+        BEGIN
+            -- DDL executed below must not start another repair
+            IF current_setting('dsp.repairing', true) = 'on' THEN
+                RETURN;
+            END IF;
+
+            -- quick exit for DDL not touching registered tables
+            IF TG_EVENT = 'sql_drop' THEN
+                IF NOT EXISTS (SELECT 1 FROM pg_event_trigger_dropped_objects() obj JOIN %(registry_table)s r
+                               ON obj.objid IN (r.source_table::oid, r.target_table::oid)) THEN
+                    RETURN;
+                END IF;
+            ELSIF NOT EXISTS (SELECT 1 FROM pg_event_trigger_ddl_commands() cmd JOIN %(registry_table)s r
+                              ON cmd.objid IN (r.source_table::oid, r.target_table::oid)
+                              OR cmd.objid IN (SELECT relnamespace FROM pg_class WHERE oid IN (r.source_table::oid, r.target_table::oid))) THEN
+                RETURN;
+            END IF;
+            PERFORM set_config('dsp.repairing', 'on', true);
+
+            -- renamed tables: rewrite references in the generated functions
+            FOR pair IN SELECT p.trg_fcn_id, p.side, p.stored_name, p.current_name, r.config
+                        FROM %(registry_table)s_problems p JOIN %(registry_table)s r USING (trg_fcn_id)
+                        WHERE p.problem = 'renamed'
+            LOOP
+                old_sidecar := split_part(pair.stored_name, '.', 1) || '.%(prefix_fcn)s_' || pair.trg_fcn_id || '_subdivided';
+                new_sidecar := split_part(pair.current_name, '.', 1) || '.%(prefix_fcn)s_' || pair.trg_fcn_id || '_subdivided';
+                IF pair.side = 'source' AND old_sidecar <> new_sidecar AND to_regclass(old_sidecar) IS NOT NULL THEN
+                    -- table moved to another schema - the sidecar of subdivided geometries goes with it
+                    EXECUTE format('ALTER TABLE %%s SET SCHEMA %%I', old_sidecar, split_part(pair.current_name, '.', 1));
+                END IF;
+
+                FOR fn IN SELECT p.oid FROM pg_proc p
+                          WHERE (p.proname LIKE '%(prefix_fcn)s\_' || pair.trg_fcn_id || '\_%%' OR p.proname LIKE '%(prefix_dispatch)s\_%%')
+                            AND (p.prosrc LIKE '%%' || pair.stored_name || '%%' OR p.prosrc LIKE '%%' || old_sidecar || '%%')
+                LOOP
+                    EXECUTE regexp_replace(regexp_replace(pg_get_functiondef(fn.oid),
+                        '\m' || replace(pair.stored_name, '.', '\.') || '\M', pair.current_name, 'g'),
+                        '\m' || replace(old_sidecar, '.', '\.') || '\M', new_sidecar, 'g');
+                END LOOP;
+
+                UPDATE %(registry_table)s SET config = jsonb_set(config, ARRAY[pair.side || '_table'], to_jsonb(pair.current_name))
+                WHERE trg_fcn_id = pair.trg_fcn_id;
+                RAISE NOTICE 'PostGIS Sampling Tool: trigger pair %% updated after %% table %% was renamed to %%',
+                    pair.trg_fcn_id, pair.side, pair.stored_name, pair.current_name;
+            END LOOP;
+
+            -- dropped tables or columns: disable the pair instead of failing on every edit
+            FOR pair IN SELECT DISTINCT p.trg_fcn_id, p.reason, r.source_table, r.target_table,
+                               coalesce((r.config->>'consolidate')::boolean, false) AS consolidate
+                        FROM %(registry_table)s_problems p JOIN %(registry_table)s r USING (trg_fcn_id)
+                        WHERE p.problem IN ('missing_table', 'missing_column', 'geometry', 'srid')
+            LOOP
+                FOR trg IN SELECT t.tgrelid::regclass AS tbl, t.tgname FROM pg_trigger t
+                           WHERE t.tgrelid IN (pair.source_table::oid, pair.target_table::oid) AND t.tgenabled <> 'D'
+                             AND (t.tgname LIKE '%(prefix_trg)s\_' || pair.trg_fcn_id || '\_%%'
+                                  OR (pair.consolidate AND t.tgname LIKE '%(prefix_dispatch)s\_%%'))
+                LOOP
+                    EXECUTE format('ALTER TABLE %%s DISABLE TRIGGER %%I', trg.tbl, trg.tgname);
+                    RAISE WARNING 'PostGIS Sampling Tool: trigger %% on %% disabled - %%', trg.tgname, trg.tbl, pair.reason;
+                END LOOP;
+            END LOOP;
+
+            PERFORM set_config('dsp.repairing', 'off', true);
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP EVENT TRIGGER IF EXISTS %(repair_trigger)s_ddl;
+        CREATE EVENT TRIGGER %(repair_trigger)s_ddl ON ddl_command_end
+            WHEN TAG IN ('ALTER TABLE', 'ALTER SCHEMA')
+            EXECUTE PROCEDURE %(repair_function)s();
+
+        DROP EVENT TRIGGER IF EXISTS %(repair_trigger)s_drop;
+        CREATE EVENT TRIGGER %(repair_trigger)s_drop ON sql_drop
+            WHEN TAG IN ('DROP TABLE', 'DROP SCHEMA')
+            EXECUTE PROCEDURE %(repair_function)s();
+        """ % {'registry_table': registry_table, 'prefix_fcn': prefix_fcn, 'prefix_trg': prefix_trg,
+               'prefix_dispatch': prefix_dispatch, 'repair_function': repair_function, 'repair_trigger': repair_trigger}
+
+
+def drop_auto_repair_sql():
+    """Returns SQL removing the event triggers installed by auto_repair_sql()"""
+    return """
+        DROP EVENT TRIGGER IF EXISTS %(repair_trigger)s_ddl;
+        DROP EVENT TRIGGER IF EXISTS %(repair_trigger)s_drop;
+        DROP FUNCTION IF EXISTS %(repair_function)s();
+        """ % {'repair_function': repair_function, 'repair_trigger': repair_trigger}
+
+
+def stats_sql():
+    """Returns SQL creating the unlogged statistics table and the function recording into it (if they do not exist yet
+    or are older).
+
+    Triggers record statistics only when the "dsp.instrument" setting is on (see set_instrumentation()),
+    otherwise instrumentation costs a single check of the setting. Every backend updates its own row,
+    so concurrent transactions do not wait for each other's locks of the statistics."""
+    return _shared_objects_sql('FUNCTION', stats_function + '(integer, text, timestamptz, bigint, bigint)', """
+        CREATE UNLOGGED TABLE IF NOT EXISTS %(stats_table)s (
+            trg_fcn_id integer NOT NULL,
+            side text NOT NULL,
+            backend_pid integer NOT NULL,
+            calls bigint NOT NULL DEFAULT 0,
+            rows_invalidated bigint NOT NULL DEFAULT 0,  -- target rows re-sampled (or areas queued in the deferred mode)
+            lookups bigint NOT NULL DEFAULT 0,           -- spatial lookups of source features
+            total_time double precision NOT NULL DEFAULT 0,  -- milliseconds
+            PRIMARY KEY (trg_fcn_id, side, backend_pid)
+        );
+
+        CREATE OR REPLACE FUNCTION %(stats_function)s(p_trg_fcn_id integer, p_side text, p_started timestamptz,
+                                                      p_rows bigint, p_lookups bigint) RETURNS void AS $$
+            INSERT INTO %(stats_table)s AS s (trg_fcn_id, side, backend_pid, calls, rows_invalidated, lookups, total_time)
+            VALUES (p_trg_fcn_id, p_side, pg_backend_pid(), 1, p_rows, p_lookups,
+                    extract(epoch FROM clock_timestamp() - p_started) * 1000)
+            ON CONFLICT (trg_fcn_id, side, backend_pid) DO UPDATE
+            SET calls = s.calls + 1, rows_invalidated = s.rows_invalidated + EXCLUDED.rows_invalidated,
+                lookups = s.lookups + EXCLUDED.lookups, total_time = s.total_time + EXCLUDED.total_time;
+        $$ LANGUAGE sql SECURITY DEFINER SET search_path = pg_catalog, public;
+        """ % {'stats_table': stats_table, 'stats_function': stats_function})
+
+
+def set_instrumentation(conn, enabled):
+    """Switches recording of statistics by the triggers on or off for new sessions of the current database
+    (needs owner of the database), existing triggers do not need to be re-created"""
     cur = conn.cursor()
-    sources = {}  # key = trigger ID, value = source table name
-    targets = {}  # key = trigger ID, value = target table name
-    cur.execute("""SELECT tgname, relname, nspname FROM pg_trigger
-        LEFT JOIN pg_class ON tgrelid = pg_class.oid
-        LEFT JOIN pg_namespace nsp ON relnamespace = nsp.oid
-        WHERE tgname LIKE '%s%%'""" % prefix_trg)
-    for row in cur.fetchall():
-        (trigger_id, is_source) = parse_trigger_name(row[0])
-        table_name = row[1]
-        schema_name = row[2]
+    cur.execute(stats_sql())
+    cur.execute("SELECT format('ALTER DATABASE %%I SET dsp.instrument = %%L', current_database(), %s)",
+                ('on' if enabled else 'off',))
+    cur.execute(cur.fetchone()[0])
+    conn.commit()
+
+
+def has_instrumentation(conn):
+    """Returns True if the triggers record statistics in new sessions of the current database"""
+    cur = conn.cursor()
+    cur.execute("""SELECT 'dsp.instrument=on' = ANY(setconfig) FROM pg_db_role_setting
+                   WHERE setdatabase = (SELECT oid FROM pg_database WHERE datname = current_database()) AND setrole = 0""")
+    row = cur.fetchone()
+    conn.commit()
+    return bool(row and row[0])
+
+
+def pair_stats(conn):
+    """Returns dictionary trigger ID -> dictionary with statistics of the pair: recorded by instrumented
+    triggers (calls, rows_invalidated, lookups, total_time in ms, summed over both sides) and calls and time
+    of its trigger functions from pg_stat_user_functions (fn_calls, fn_time - needs track_functions = 'pl')"""
+    cur = conn.cursor()
+    stats = {}
+    cur.execute("SELECT to_regclass(%s)", (stats_table,))
+    if cur.fetchone()[0] is not None:
+        cur.execute("""SELECT trg_fcn_id, sum(calls), sum(rows_invalidated), sum(lookups), sum(total_time)
+                       FROM %s GROUP BY trg_fcn_id""" % stats_table)
+        for trigger_id, calls, rows, lookups, total_time in cur.fetchall():
+            stats[trigger_id] = {'calls': int(calls), 'rows_invalidated': int(rows), 'lookups': int(lookups),
+                                 'total_time': total_time}
+    cur.execute("""SELECT substring(funcname FROM '^%(prefix_fcn)s_([0-9]+)_')::integer AS trg_fcn_id,
+                          sum(calls), sum(total_time)
+                   FROM pg_stat_user_functions
+                   WHERE funcname ~ '^%(prefix_fcn)s_[0-9]+_(source|target)_trigger$'
+                   GROUP BY 1""" % {'prefix_fcn': prefix_fcn})
+    for trigger_id, calls, total_time in cur.fetchall():
+        stats.setdefault(trigger_id, {}).update({'fn_calls': int(calls), 'fn_time': total_time})
+    conn.commit()
+    return stats
+
+
+def has_auto_repair(conn):
+    """Returns True if the event triggers of automatic repair are installed"""
+    cur = conn.cursor()
+    cur.execute("SELECT count(*) FROM pg_event_trigger WHERE evtname LIKE %s", (repair_trigger + '\\_%',))
+    return cur.fetchone()[0] > 0
+
+
+def init_registry(conn):
+    """Creates the registry if it does not exist yet (and updates its problems view to the current version),
+    together with migration of trigger pairs created by older versions of the plugin. Returns number of migrated pairs."""
+    cur = conn.cursor()
+    cur.execute("SELECT to_regclass(%s)", (registry_table,))
+    exists = cur.fetchone()[0] is not None
+    cur.execute(registry_sql())
+    if exists:
+        # the registry may have been created without migration (e.g. by create_sql() of a new pair)
+        cur.execute(_unregistered_query)
+        if not cur.fetchone()[0]:
+            conn.commit()
+            return 0
+    return migrate_registry(conn)
+
+
+# whether there are triggers of pairs which are not in the registry
+_unregistered_query = """SELECT EXISTS (SELECT 1 FROM pg_trigger
+    WHERE tgname LIKE '%(prefix_trg)s\\_%%'
+      AND split_part(substr(tgname, %(start)d), '_', 1) NOT IN (SELECT trg_fcn_id::text FROM %(registry_table)s))""" % {
+    'prefix_trg': prefix_trg, 'start': len(prefix_trg) + 2, 'registry_table': registry_table}
+
+
+def migrate_registry(conn):
+    """Registers trigger pairs which have configuration stored in comments of their target triggers
+    (created by older versions of the plugin) and are not registered yet. Returns number of migrated pairs."""
+    cur = conn.cursor()
+    cur.execute(registry_sql())
+    cur.execute("""SELECT tgname, tgrelid, obj_description(oid, 'pg_trigger') FROM pg_trigger
+        WHERE tgname LIKE '%s\\_%%'""" % prefix_trg)
+    pairs = {}  # key = trigger ID, value = [source table OID, target table OID, config]
+    for tgname, table_oid, comment in cur.fetchall():
+        try:
+            (trigger_id, is_source) = parse_trigger_name(tgname)
+        except ValueError:
+            continue  # not our trigger
+        pair = pairs.setdefault(trigger_id, [None, None, None])
         if is_source:
-            sources[trigger_id] = schema_name + "." + table_name
+            pair[0] = table_oid
         else:
-            targets[trigger_id] = schema_name + "." + table_name
+            pair[1] = table_oid
+            try:
+                pair[2] = json.loads(comment) if comment else None
+            except ValueError:
+                pass  # malformed configuration - the pair can be only removed
+
+    migrated = 0
+    for trigger_id, (source_oid, target_oid, config) in sorted(pairs.items()):
+        cur.execute("""INSERT INTO %s (trg_fcn_id, source_table, target_table, mode, config, version)
+            VALUES (%%s, %%s::oid::regclass, %%s::oid::regclass, %%s, %%s, 0)
+            ON CONFLICT (trg_fcn_id) DO NOTHING""" % registry_table,
+                    (trigger_id, source_oid, target_oid, config.get('mode', 'row') if config else None,
+                     json.dumps(config) if config else None))
+        migrated += cur.rowcount
+
+    # new IDs must not collide with the migrated ones
+    cur.execute("""SELECT setval('%(registry_table)s_id_seq', greatest(
+            (SELECT coalesce(max(trg_fcn_id), 0) FROM %(registry_table)s),
+            (SELECT last_value FROM %(registry_table)s_id_seq)))""" % {'registry_table': registry_table})
+    conn.commit()
+    return migrated
+
+
+def new_trigger_id(conn):
+    """Returns ID for a new trigger pair"""
+    return new_trigger_ids(conn, 1)[0]
+
+
+def new_trigger_ids(conn, count):
+    """Returns list of IDs for new trigger pairs, fetched in one query"""
+    cur = conn.cursor()
+    cur.execute("SELECT nextval('%s_id_seq') FROM generate_series(1, %%s)" % registry_table, (count,))
+    trigger_ids = [row[0] for row in cur.fetchall()]
+    conn.commit()
+    return trigger_ids
 
-    lst = []
-    for trigger_id in sources:
-        src = sources[trigger_id]
-        trg = targets[trigger_id] if trigger_id in targets else None
-        lst.append((trigger_id, src, trg))
 
-    diff = set(targets.keys()) - set(sources.keys())
-    for trigger_id in diff:
-        if trigger_id not in targets: continue
-        src = sources[trigger_id] if trigger_id in sources else None
-        trg = targets[trigger_id]
-        lst.append((trigger_id, src, trg))
-    return lst
+# current schema-qualified names of the registered tables (NULL if the table does not exist anymore)
+_registry_query = """SELECT r.trg_fcn_id, sn.nspname || '.' || sc.relname, tn.nspname || '.' || tc.relname, r.config
+        FROM %s r
+        LEFT JOIN pg_class sc ON sc.oid = r.source_table
+        LEFT JOIN pg_namespace sn ON sn.oid = sc.relnamespace
+        LEFT JOIN pg_class tc ON tc.oid = r.target_table
+        LEFT JOIN pg_namespace tn ON tn.oid = tc.relnamespace""" % registry_table
 
 
-# function check ONLY if schema.table reference in fc exists!
-def list_invalid_triggers(conn, triggers):
+def list_triggers(conn, schema=None):
+    """Returns list of tuples (trigger ID, source table, target table) of registered trigger pairs,
+    optionally only those with source or target table in the given schema"""
     cur = conn.cursor()
-    invalid = []
-
-    for id, source, target in triggers:
-        query = """
-        SELECT tgname, prosrc, nspname || '.' || relname as source FROM pg_trigger t
-        LEFT JOIN pg_class ON tgrelid = pg_class.oid
-        LEFT JOIN pg_namespace nsp ON relnamespace = nsp.oid
-        LEFT JOIN pg_proc f
-          ON f.oid = t.tgfoid
-        WHERE prosrc ILIKE '%%%(target)s%%' AND nspname || '.' || relname = '%(source)s'
-        OR prosrc ILIKE '%%%(source)s%%' AND nspname || '.' || relname = '%(target)s';
-        """ % {'target': str(target), 'source':str(source)}
-        cur.execute(query)
-        res = list(cur.fetchall())
-        if len(res) < 2:
-            invalid.append((id, source, target))
+    if schema is None:
+        cur.execute(_registry_query + " ORDER BY r.trg_fcn_id")
+    else:
+        cur.execute(_registry_query + " WHERE sn.nspname = %s OR tn.nspname = %s ORDER BY r.trg_fcn_id", (schema, schema))
+    return [(trigger_id, source_table, target_table) for trigger_id, source_table, target_table, config in cur.fetchall()]
 
+
+def load_sql_generators(conn, trigger_ids=None):
+    """Returns dictionary trigger ID -> SqlGenerator with stored configuration of all registered
+    trigger pairs (or those with the given IDs). Pairs without valid configuration are skipped."""
+    cur = conn.cursor()
+    if trigger_ids is None:
+        cur.execute(_registry_query)
+    else:
+        cur.execute(_registry_query + " WHERE r.trg_fcn_id = ANY(%s)", (list(trigger_ids),))
+    generators = {}
+    for trigger_id, source_table, target_table, config in cur.fetchall():
+        if config is None:
+            continue
+        sql_gen = SqlGenerator()
+        try:
+            sql_gen.parse_json(json.dumps(config))
+        except (ValueError, KeyError):
+            continue
+        sql_gen.trg_fcn_id = trigger_id
+        # tables may have been renamed or moved to another schema since the pair was created
+        sql_gen.source_table = source_table or sql_gen.source_table
+        sql_gen.target_table = target_table or sql_gen.target_table
+        generators[trigger_id] = sql_gen
+    return generators
+
+
+def list_invalid_triggers(conn):
+    """Returns dictionary trigger ID -> list of reasons why the pair does not work, for all broken pairs.
+    Everything is checked by a single query (see the problems view in registry_sql())."""
+    cur = conn.cursor()
+    cur.execute("SELECT trg_fcn_id, reason FROM %s_problems WHERE problem <> 'missing_index' ORDER BY trg_fcn_id" % registry_table)
+    invalid = {}
+    for trigger_id, reason in cur.fetchall():
+        invalid.setdefault(trigger_id, []).append(reason)
     return invalid
 
 
+def list_missing_indexes(conn):
+    """Returns dictionary trigger ID -> list of indexes needed by the pair which do not exist (see indexes.py)"""
+    cur = conn.cursor()
+    cur.execute("SELECT trg_fcn_id, reason FROM %s_problems WHERE problem = 'missing_index' ORDER BY trg_fcn_id" % registry_table)
+    missing = {}
+    for trigger_id, reason in cur.fetchall():
+        missing.setdefault(trigger_id, []).append(reason)
+    return missing
+
+
+def load_sql_generator(conn, trigger_id):
+    """Returns SqlGenerator with stored configuration of the trigger or None if it cannot be loaded"""
+    return load_sql_generators(conn, [trigger_id]).get(trigger_id)
+
+
+def get_primary_key(conn, table, integer_only=True):
+    """Returns name of the single-column (integer) primary key of the table or None if it has no such key"""
+    cur = conn.cursor()
+    cur.execute("""SELECT a.attname FROM pg_index i
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+        WHERE i.indrelid = %%s::regclass AND i.indisprimary AND i.indnatts = 1%s""" % (
+        " AND a.atttypid IN ('int2'::regtype, 'int4'::regtype, 'int8'::regtype)" if integer_only else ""), (table,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
 def list_uic_geom_fields(conn):
     cur = conn.cursor()
     query = """
@@ -96,6 +558,35 @@ def list_uic_geom_fields(conn):
     return uic_geom_columns
 
 
+def queue_sql():
+    """Returns SQL creating the queue table of the deferred mode with the table of failed entries
+    and the monitoring view (if they do not exist yet or are older)"""
+    return _shared_objects_sql('VIEW', queue_table + '_stats', """
+        CREATE TABLE IF NOT EXISTS %(queue_table)s (
+            id bigserial PRIMARY KEY,
+            trg_fcn_id integer NOT NULL,
+            bbox geometry NOT NULL,
+            enqueued_at timestamptz NOT NULL DEFAULT now()
+        );
+
+        -- entries whose re-sampling failed (e.g. a mapped column has been dropped), moved aside by the worker
+        -- so that they do not block the queue - they can be queued again with --requeue-failed of the worker
+        CREATE TABLE IF NOT EXISTS %(queue_table)s_failed (
+            id bigint PRIMARY KEY,
+            trg_fcn_id integer NOT NULL,
+            bbox geometry NOT NULL,
+            enqueued_at timestamptz NOT NULL,
+            failed_at timestamptz NOT NULL DEFAULT now(),
+            error text
+        );
+
+        -- queue depth and lag of each trigger, for monitoring
+        CREATE OR REPLACE VIEW %(queue_table)s_stats AS
+        SELECT trg_fcn_id, count(*) AS depth, now() - min(enqueued_at) AS lag
+        FROM %(queue_table)s GROUP BY trg_fcn_id;
+        """ % {'queue_table': queue_table})
+
+
 class SqlGenerator:
     """ Class to generate SQL for our triggers """
     
@@ -103,14 +594,73 @@ class SqlGenerator:
     target_table = 'public.test_dsp_target'
     trg_fcn_id = 1
     attr_map = { 'attr_int': 'attr_int1', 'attr_text': 'attr_text1' }  # source to target mapping
+    agg_map = {}  # target attribute to [aggregate, source attribute] - aggregates of all related source features
+                  # ('count', 'sum', 'min', 'max' or 'avg') instead of copying attributes of a single one
+    consolidate = False  # use per-table dispatch triggers instead of own triggers (only in 'row' mode)
+    mode = 'row'  # 'row' - source trigger for each row, 'statement' - once per statement with transition tables,
+                  # 'deferred' - statement trigger only enqueues dirty areas for the background worker
+    predicate = 'dwithin'  # spatial relation of source and target: 'dwithin', 'intersects', 'contains', 'covers'
+                           # or 'nearest' (the nearest source feature within the tolerance distance)
+    tolerance = 0.01  # distance for 'dwithin' (in CRS units) - to account for numerical issues with linestrings,
+                      # maximum distance for 'nearest'
+    order_by = ''  # which source feature wins if more match: '' (any), 'area' (smallest), 'column' (lowest value), 'column_desc'
+    order_column = None  # source column for 'column' and 'column_desc' ordering
+    overlap = ''  # for line and polygon targets: '' (any matching feature), 'largest' (feature with the largest
+                  # overlap - area or length) or 'weighted' (overlap-weighted average of numeric attributes)
+    subdivide = False  # look up in a sidecar table with ST_Subdivide'd source geometries (for very complex polygons)
+    subdivide_vertices = 256  # maximum number of vertices of a piece
+    source_key = None  # primary key of the source table - needed for the sidecar table
     
-    def drop_sql(self):
-        return """
+    def _drop_triggers_sql(self):
+        """Returns SQL dropping the triggers of the pair (in all modes), their functions are kept.
+        Tables which do not exist anymore (None) are skipped."""
+        sql = ""
+        if self.source_table:
+            sql += """
         DROP TRIGGER IF EXISTS %(prefix_trg)s_%(trg_fcn_id)d_source_trigger ON %(source_table)s cascade;
+        DROP TRIGGER IF EXISTS %(prefix_trg)s_%(trg_fcn_id)d_upd_source_trigger ON %(source_table)s cascade;
+        DROP TRIGGER IF EXISTS %(prefix_trg)s_%(trg_fcn_id)d_del_source_trigger ON %(source_table)s cascade;"""
+        if self.target_table:
+            sql += """
+        DROP TRIGGER IF EXISTS %(prefix_trg)s_%(trg_fcn_id)d_target_trigger ON %(target_table)s cascade;"""
+        return sql % self._params() + "\n"
+
+    def _drop_subdivided_sql(self):
+        """Returns SQL dropping the sidecar table - looked up by its name in all schemas if the source table is gone"""
+        if self.source_table:
+            return """
+        DROP TABLE IF EXISTS %s;""" % self.subdivided_table()
+        return """
+        DO $$ DECLARE sidecar regclass; BEGIN
+            FOR sidecar IN SELECT oid::regclass FROM pg_class WHERE relname = '%(prefix_fcn)s_%(trg_fcn_id)d_subdivided' AND relkind = 'r' LOOP
+                EXECUTE format('DROP TABLE %%s', sidecar);
+            END LOOP;
+        END $$;""" % self._params()
+
+    def drop_sql(self):
+        return self._drop_triggers_sql() + """
         DROP FUNCTION IF EXISTS %(prefix_fcn)s_%(trg_fcn_id)d_source_trigger() cascade;
-        DROP TRIGGER IF EXISTS %(prefix_trg)s_%(trg_fcn_id)d_target_trigger ON %(target_table)s cascade;
-        DROP FUNCTION IF EXISTS %(prefix_fcn)s_%(trg_fcn_id)d_target_trigger() cascade;
-        """ % {
+        DROP FUNCTION IF EXISTS %(prefix_fcn)s_%(trg_fcn_id)d_target_trigger() cascade;%(drop_subdivided)s
+        DO $$ BEGIN
+            IF to_regclass('%(queue_table)s') IS NOT NULL THEN
+                DELETE FROM %(queue_table)s WHERE trg_fcn_id = %(trg_fcn_id)d;
+            END IF;
+            IF to_regclass('%(queue_table)s_failed') IS NOT NULL THEN
+                DELETE FROM %(queue_table)s_failed WHERE trg_fcn_id = %(trg_fcn_id)d;
+            END IF;
+            IF to_regclass('%(registry_table)s') IS NOT NULL THEN
+                DELETE FROM %(registry_table)s WHERE trg_fcn_id = %(trg_fcn_id)d;
+            END IF;
+            IF to_regclass('%(stats_table)s') IS NOT NULL THEN
+                DELETE FROM %(stats_table)s WHERE trg_fcn_id = %(trg_fcn_id)d;
+            END IF;
+        END $$;
+        """ % dict(self._params(), queue_table=queue_table, registry_table=registry_table,
+                   stats_table=stats_table, drop_subdivided=self._drop_subdivided_sql())
+
+    def _params(self):
+        """Returns dictionary with values shared by all SQL templates"""
+        return {
             'source_table': self.source_table,
             'target_table': self.target_table,
             'prefix_fcn': prefix_fcn,
@@ -118,22 +668,370 @@ class SqlGenerator:
             'trg_fcn_id': self.trg_fcn_id,
             }
 
-    def create_sql(self):
-        if not self.attr_map:
-            return
-        
-        first_target_attr = next(iter(self.attr_map.values()))
-        assignments_null = []
-        assignments_copy = []
-        for source_attr, target_attr in self.attr_map.items():
-            assignments_null.append("NEW.%s = NULL;" % target_attr)
-            assignments_copy.append("NEW.%s = myrec.%s;" % (target_attr, source_attr))
-            
+    def subdivided_table(self):
+        """Returns name of the sidecar table with subdivided source geometries (in the schema of the source table)"""
+        return "%s.%s_%d_subdivided" % (self.source_table.split('.')[0], prefix_fcn, self.trg_fcn_id)
+
+    def _uses_subdivided(self):
+        """Whether lookups go through the sidecar table with subdivided source geometries.
+        Containment cannot be tested on the pieces, so it always uses the whole source geometries."""
+        return self.subdivide and self.source_key and not self.agg_map and not self._uses_overlap() \
+            and self.predicate not in ('contains', 'covers')
+
+    def _uses_overlap(self):
+        """Whether the lookup measures overlaps of source and target geometries"""
+        return self.overlap in ('largest', 'weighted') and self.predicate != 'nearest'
+
+    def _overlap_measure_sql(self, geom_expr, source_geom='src.geom'):
+        """Returns size of the overlap of source geometry and target geometry given by SQL expression -
+        area for polygon targets, length for line targets"""
+        return ("CASE WHEN st_dimension(%(g)s) = 2 THEN st_area(st_intersection(%(s)s, %(g)s)) "
+                "ELSE st_length(st_intersection(%(s)s, %(g)s)) END") % {'g': geom_expr, 's': source_geom}
+
+    def _predicate_sql(self, geom_expr, source_geom='src.geom'):
+        """Returns condition of the spatial relation between target geometry given by SQL expression and source geometry"""
+        if self.predicate == 'intersects':
+            return "st_intersects(%s, %s)" % (geom_expr, source_geom)
+        elif self.predicate == 'contains':
+            return "st_contains(%s, %s)" % (source_geom, geom_expr)
+        elif self.predicate == 'covers':
+            return "st_covers(%s, %s)" % (source_geom, geom_expr)
+        else:  # dwithin, nearest
+            return "st_dwithin(%s, %s, %s)" % (geom_expr, source_geom, repr(float(self.tolerance)))
+
+    def _order_by_sql(self, geom_expr, source_geom='src.geom'):
+        """Returns ORDER BY clause deciding which of more matching source features is used"""
+        if self.predicate == 'nearest':
+            # KNN ordering is done by the spatial index, no need to compute distances to all candidates
+            return " ORDER BY %s <-> %s" % (source_geom, geom_expr)
+        elif self.order_by == 'area':
+            return " ORDER BY st_area(src.geom)"
+        elif self.order_by == 'column' and self.order_column:
+            return " ORDER BY src.%s" % self.order_column
+        elif self.order_by == 'column_desc' and self.order_column:
+            return " ORDER BY src.%s DESC" % self.order_column
+        return ""
+
+    def _lookup_sql(self, geom_expr, into=None, source_attrs=None):
+        """Returns SELECT of mapped source attributes (or the given ones) for a target geometry given by SQL expression"""
+        if source_attrs is None:
+            source_attrs = list(self.attr_map)
+        columns = ", ".join("src.%s" % source_attr for source_attr in source_attrs)
+        if self._uses_overlap():
+            return self._overlap_lookup_sql(geom_expr, into, source_attrs)
+        if self._uses_subdivided():
+            # spatial test on small pieces, attributes from the source table
+            source_sql = "%s piece JOIN %s src ON src.%s = piece.src_key" % (self.subdivided_table(), self.source_table, self.source_key)
+            source_geom = 'piece.geom'
+        else:
+            source_sql = "%s src" % self.source_table
+            source_geom = 'src.geom'
+        return "SELECT %(columns)s%(into)s FROM %(source_sql)s WHERE %(predicate)s%(order_by)s LIMIT 1" % {
+            'columns': columns,
+            'into': " INTO %s" % into if into else "",
+            'source_sql': source_sql,
+            'predicate': self._predicate_sql(geom_expr, source_geom),
+            'order_by': self._order_by_sql(geom_expr, source_geom),
+        }
+
+    def _aggregate_predicate_sql(self, target_geom, source_geom):
+        """Returns condition of the spatial relation for aggregates - target features collect the source features
+        they intersect, contain, cover or are within the tolerance distance of"""
+        if self.predicate == 'intersects':
+            return "st_intersects(%s, %s)" % (target_geom, source_geom)
+        elif self.predicate == 'contains':
+            return "st_contains(%s, %s)" % (target_geom, source_geom)
+        elif self.predicate == 'covers':
+            return "st_covers(%s, %s)" % (target_geom, source_geom)
+        else:  # dwithin (the nearest feature has no meaning for aggregates)
+            return "st_dwithin(%s, %s, %s)" % (target_geom, source_geom, repr(float(self.tolerance)))
+
+    def _aggregated_source_columns(self):
+        """Returns list of source columns whose values are aggregated (count does not need any)"""
+        columns = []
+        for func, source_attr in self.agg_map.values():
+            if func != 'count' and source_attr not in columns:
+                columns.append(source_attr)
+        return columns
+
+    def _aggregate_expr_sql(self, func, source_attr, alias):
+        """Returns aggregate expression over rows with the given alias - sum of no rows is 0 to allow adjusting it"""
+        if func == 'count':
+            return "count(*)"
+        elif func == 'sum':
+            return "coalesce(sum(%s.%s), 0)" % (alias, source_attr)
+        return "%s(%s.%s)" % (func, alias, source_attr)
+
+    def _aggregate_lookup_sql(self, geom_expr, into=None, target_attrs=None):
+        """Returns SELECT of aggregates (all or of the given target attributes) over source features related
+        to target geometry given by SQL expression. Columns are named by target attributes."""
+        if target_attrs is None:
+            target_attrs = list(self.agg_map)
+        columns = ", ".join("%s AS %s" % (self._aggregate_expr_sql(self.agg_map[target_attr][0], self.agg_map[target_attr][1], 'src'), target_attr)
+                            for target_attr in target_attrs)
+        return "SELECT %(columns)s%(into)s FROM %(source_table)s src WHERE %(predicate)s" % {
+            'columns': columns,
+            'into': " INTO %s" % into if into else "",
+            'source_table': self.source_table,
+            'predicate': self._aggregate_predicate_sql(geom_expr, 'src.geom'),
+        }
+
+    def _aggregate_delta_sql(self, rows_sql, removed):
+        """Returns UPDATE statement applying source rows returned by the given query (geometry and aggregated
+        columns) to aggregates of the related target rows, either as removed or as added rows.
+
+        count and sum are adjusted by the difference, min and max only need a recompute of the target row
+        when a removed value may have been the extreme, avg is always recomputed (for the affected rows only).
+        """
+        deltas = ["count(*) AS n"]
+        assignments = []
+        for i, (target_attr, (func, source_attr)) in enumerate(self.agg_map.items()):
+            params = {'attr': target_attr, 'delta': "d.d%d" % i, 'sign': '-' if removed else '+',
+                      'recompute': "(%s)" % self._aggregate_lookup_sql('t.geom', target_attrs=[target_attr])}
+            if func in ('count', 'sum'):
+                deltas.append("%s AS d%d" % (self._aggregate_expr_sql(func, source_attr, 'chg'), i))
+                assignments.append("%(attr)s = coalesce(t.%(attr)s, 0) %(sign)s %(delta)s" % params)
+            elif func in ('min', 'max') and not removed:
+                deltas.append("%s(chg.%s) AS d%d" % (func, source_attr, i))
+                assignments.append("%(attr)s = %(extreme)s(t.%(attr)s, %(delta)s)" % dict(params, extreme='least' if func == 'min' else 'greatest'))
+            elif func in ('min', 'max'):
+                deltas.append("%s(chg.%s) AS d%d" % (func, source_attr, i))
+                assignments.append("%(attr)s = CASE WHEN %(delta)s IS NULL OR %(delta)s %(op)s t.%(attr)s THEN t.%(attr)s ELSE %(recompute)s END"
+                                   % dict(params, op='>' if func == 'min' else '<'))
+            else:  # avg
+                assignments.append("%(attr)s = %(recompute)s" % params)
+
+        return """
+            UPDATE %(target_table)s t SET %(assignments)s
+            FROM (SELECT tt.ctid AS row_id, %(deltas)s
+                  FROM %(target_table)s tt
+                  JOIN (%(rows_sql)s) chg ON %(predicate)s
+                  GROUP BY tt.ctid) d
+            WHERE t.ctid = d.row_id;""" % {
+            'target_table': self.target_table,
+            'assignments': ", ".join(assignments),
+            'deltas': ", ".join(deltas),
+            'rows_sql': rows_sql,
+            'predicate': self._aggregate_predicate_sql('tt.geom', 'chg.geom'),
+        }
+
+    def _overlap_lookup_sql(self, geom_expr, into, source_attrs):
+        """Returns SELECT of source attributes of the feature with the largest overlap or their weighted averages.
+        Candidates are found by the spatial index, intersections are only computed if there are more of them."""
+        columns = ", ".join("src.%s" % source_attr for source_attr in source_attrs)
+        candidates = """SELECT %(columns)s, CASE WHEN count(*) OVER () = 1 THEN 1 ELSE %(measure)s END AS overlap_size
+                FROM %(source_table)s src WHERE %(predicate)s""" % {
+            'columns': columns,
+            'measure': self._overlap_measure_sql(geom_expr),
+            'source_table': self.source_table,
+            'predicate': self._predicate_sql(geom_expr),
+        }
+        if self.overlap == 'weighted':
+            columns = ", ".join("sum(src.%(attr)s * src.overlap_size) / nullif(sum(src.overlap_size), 0) AS %(attr)s" % {'attr': source_attr}
+                                for source_attr in source_attrs)
+            return "SELECT %s%s FROM (%s) src" % (columns, " INTO %s" % into if into else "", candidates)
+        return "SELECT %s%s FROM (%s) src ORDER BY src.overlap_size DESC LIMIT 1" % (
+            columns, " INTO %s" % into if into else "", candidates)
+
+    def _lookup_key(self):
+        """Returns tuple identifying the lookup - pairs with the same key can share a single lookup"""
+        sidecar = self.subdivided_table() if self._uses_subdivided() else None
+        overlap = self.overlap if self._uses_overlap() else None
+        return (self.source_table, sidecar, overlap, self._predicate_sql('g'), self._order_by_sql('g'))
+
+    def _watched_source_columns(self):
+        """Returns list of source columns (besides geometry) whose change may change values in the target table"""
+        columns = list(self.attr_map) + self._aggregated_source_columns()
+        if self.predicate != 'nearest' and self.order_by in ('column', 'column_desc') and self.order_column and self.order_column not in columns:
+            columns.append(self.order_column)
+        if self._uses_subdivided() and self.source_key not in columns:
+            columns.append(self.source_key)
+        return columns
+
+    def _target_filter_sql(self, target_alias, geom_expr):
+        """Returns condition selecting rows of the target table which may be affected by a change of source geometry"""
+        if self.predicate in ('dwithin', 'nearest'):
+            return "%s.geom && st_expand(%s, %s)" % (target_alias, geom_expr, repr(float(self.tolerance)))
+        return "%s.geom && %s" % (target_alias, geom_expr)
+
+    def _assignment_sql(self, geom_expr, attr_pairs=None, target_attrs=None):
+        """Returns SET clause assigning looked up source attributes to all mapped target attributes
+        (or to the given list of (source attribute, target attribute) pairs, or the given aggregated target attributes)"""
+        if attr_pairs is None and self.agg_map:
+            # aggregates of the target row are recomputed from all related source features
+            if target_attrs is None:
+                target_attrs = list(self.agg_map)
+            lookup = self._aggregate_lookup_sql(geom_expr, target_attrs=target_attrs)
+            if len(target_attrs) == 1:
+                return "%s = (%s)" % (target_attrs[0], lookup)
+            return "(%s) = (%s)" % (", ".join(target_attrs), lookup)
+        if attr_pairs is None:
+            attr_pairs = list(self.attr_map.items())
+        lookup = self._lookup_sql(geom_expr, source_attrs=[source_attr for source_attr, target_attr in attr_pairs])
+        if len(attr_pairs) == 1:
+            return "%s = (%s)" % (attr_pairs[0][1], lookup)
+        return "(%s) = (%s)" % (", ".join(target_attr for source_attr, target_attr in attr_pairs), lookup)
+
+    def refresh_sql(self, area_sql):
+        """Returns UPDATE statement that re-samples all target rows intersecting geometries
+        returned by the given query (its column must be called "geom").
+
+        Each target row is updated exactly once, even if it intersects several of the geometries.
+        """
+        return """
+            UPDATE %(target_table)s t SET %(assignment)s
+            FROM (SELECT DISTINCT tt.ctid AS row_id
+                  FROM %(target_table)s tt
+                  JOIN (%(area_sql)s) chg ON %(filter)s) affected
+            WHERE t.ctid = affected.row_id;""" % {
+            'target_table': self.target_table,
+            'assignment': self._assignment_sql('t.geom'),
+            'filter': self._target_filter_sql('tt', 'chg.geom'),
+            'area_sql': area_sql,
+        }
+
+    def _changed_area_sql(self, removed_sql, added_sql):
+        """Returns query with geometries of source rows removed and added by a statement (queries or None)"""
+        return " UNION ALL ".join("SELECT geom FROM (%s) r%d" % (rows_sql, i)
+                                  for i, rows_sql in enumerate([removed_sql, added_sql]) if rows_sql)
+
+    def _refresh_action(self, removed_sql, added_sql):
+        # every re-sampled target row does one lookup
+        return self.refresh_sql(self._changed_area_sql(removed_sql, added_sql)) + _count_rows_sql(lookups=True)
+
+    def _enqueue_action(self, removed_sql, added_sql):
+        return self.enqueue_sql(self._changed_area_sql(removed_sql, added_sql))
+
+    def _aggregate_action(self, removed_sql, added_sql):
+        sql = ""
+        if removed_sql:
+            sql += self._aggregate_delta_sql(removed_sql, removed=True) + _count_rows_sql()
+        if added_sql:
+            sql += self._aggregate_delta_sql(added_sql, removed=False) + _count_rows_sql()
+        return sql
+
+    def _stats_declare_sql(self):
+        """Returns declarations of plpgsql variables of the instrumentation"""
+        return """
+            dsp_started timestamptz := CASE WHEN current_setting('dsp.instrument', true) = 'on' THEN clock_timestamp() END;
+            dsp_rows bigint := 0;
+            dsp_lookups bigint := 0;
+            dsp_count bigint;"""
+
+    def _stats_record_sql(self, side):
+        """Returns plpgsql code recording statistics of the trigger call (if instrumentation is on)"""
+        return """
+        IF dsp_started IS NOT NULL THEN
+            PERFORM %(stats_function)s(%(trg_fcn_id)d, '%(side)s', dsp_started, dsp_rows, dsp_lookups);
+        END IF;""" % {'stats_function': stats_function, 'trg_fcn_id': self.trg_fcn_id, 'side': side}
+
+    def enqueue_sql(self, area_sql):
+        """Returns INSERT statement that puts bounding boxes of geometries returned by the given query
+        (its column must be called "geom") to the queue of the deferred mode."""
+        return """
+            INSERT INTO %(queue_table)s (trg_fcn_id, bbox)
+            SELECT %(trg_fcn_id)d, st_envelope(chg.geom) FROM (%(area_sql)s) chg WHERE chg.geom IS NOT NULL;%(count_rows)s
+            PERFORM pg_notify('%(queue_channel)s', '%(trg_fcn_id)d');""" % {
+            'queue_table': queue_table,
+            'queue_channel': queue_channel,
+            'trg_fcn_id': self.trg_fcn_id,
+            'area_sql': area_sql,
+            'count_rows': _count_rows_sql(),
+        }
+
+    def backfill_sql(self, key_column=None, target_columns=None):
+        """Returns UPDATE statement that re-samples all target rows with key in range given by
+        query parameters "start" (inclusive) and "end" (exclusive), or the whole table without key.
+        Only the given target columns are re-sampled if target_columns is set."""
+        if target_columns is None:
+            assignment = self._assignment_sql('t.geom')
+        elif not set(target_columns) & (set(self.attr_map.values()) | set(self.agg_map)):
+            raise ValueError("None of the columns %s is written by the trigger pair" % ", ".join(target_columns))
+        elif self.agg_map:
+            assignment = self._assignment_sql('t.geom', target_attrs=[attr for attr in self.agg_map if attr in target_columns])
+        else:
+            assignment = self._assignment_sql('t.geom', [(source_attr, target_attr) for source_attr, target_attr
+                                                         in self.attr_map.items() if target_attr in target_columns])
+        return """
+            UPDATE %(target_table)s t SET %(assignment)s%(where)s;""" % {
+            'target_table': self.target_table,
+            'assignment': assignment,
+            'where': " WHERE t.%s >= %%(start)s AND t.%s < %%(end)s" % (key_column, key_column) if key_column else "",
+        }
+
+    def _subdivided_table_sql(self):
+        """Returns SQL (re)creating the sidecar table with subdivided source geometries"""
+        return """
+        DROP TABLE IF EXISTS %(subdivided_table)s;
+        CREATE TABLE %(subdivided_table)s AS
+            SELECT src.%(source_key)s AS src_key, st_subdivide(src.geom, %(vertices)d) AS geom FROM %(source_table)s src;
+        CREATE INDEX ON %(subdivided_table)s USING gist (geom);
+        CREATE INDEX ON %(subdivided_table)s (src_key);
+        ANALYZE %(subdivided_table)s;
+        """ % dict(self._params(), subdivided_table=self.subdivided_table(),
+                   source_key=self.source_key, vertices=self.subdivide_vertices)
+
+    def _subdivided_row_sync_sql(self):
+        """Returns plpgsql code of a row trigger keeping the sidecar table in sync with the source table"""
+        if not self._uses_subdivided():
+            return ""
+        return """
+        -- keep subdivided pieces of source geometries in sync
+        IF (TG_OP = 'DELETE') THEN
+            DELETE FROM %(subdivided_table)s WHERE src_key = OLD.%(source_key)s;
+        ELSIF (TG_OP = 'INSERT') THEN
+            INSERT INTO %(subdivided_table)s (src_key, geom) SELECT NEW.%(source_key)s, st_subdivide(NEW.geom, %(vertices)d);
+        ELSIF (OLD.geom IS DISTINCT FROM NEW.geom OR OLD.%(source_key)s IS DISTINCT FROM NEW.%(source_key)s) THEN
+            DELETE FROM %(subdivided_table)s WHERE src_key = OLD.%(source_key)s;
+            INSERT INTO %(subdivided_table)s (src_key, geom) SELECT NEW.%(source_key)s, st_subdivide(NEW.geom, %(vertices)d);
+        END IF;
+        """ % {'subdivided_table': self.subdivided_table(), 'source_key': self.source_key, 'vertices': self.subdivide_vertices}
+
+    def _subdivided_statement_sync_sql(self, old_rows, new_rows):
+        """Returns SQL keeping the sidecar table in sync from transition tables (their queries or None)"""
+        if not self._uses_subdivided():
+            return ""
+        sql = ""
+        if old_rows:
+            sql += """
+            DELETE FROM %(subdivided_table)s WHERE src_key IN (SELECT %(source_key)s FROM (%(old_rows)s) o);"""
+        if new_rows:
+            sql += """
+            INSERT INTO %(subdivided_table)s (src_key, geom) SELECT %(source_key)s, st_subdivide(geom, %(vertices)d) FROM (%(new_rows)s) n;"""
+        return sql % {'subdivided_table': self.subdivided_table(), 'source_key': self.source_key,
+                      'vertices': self.subdivide_vertices, 'old_rows': old_rows, 'new_rows': new_rows}
+
+    def _source_changed_condition(self):
+        """Returns condition (for WHEN clause) which is true if a relevant column of the source row has changed"""
+        return _changed_condition(self._watched_source_columns())
+
+    def _source_row_update_sql(self):
+        """Returns plpgsql code of the row source trigger updating the target table"""
+        if not self.agg_map:
+            return """
+        UPDATE %(target_table)s t SET %(assignment)s WHERE %(filter)s;%(count_rows)s""" % {
+                'target_table': self.target_table,
+                'count_rows': _count_rows_sql(lookups=True),
+                'assignment': self._assignment_sql('t.geom'),
+                'filter': self._target_filter_sql('t', 'bbox'),
+            }
+        columns = ['geom'] + self._aggregated_source_columns()
+        return """
+        IF (TG_OP <> 'INSERT') THEN%(remove)s
+        END IF;
+        IF (TG_OP <> 'DELETE') THEN%(add)s
+        END IF;""" % {
+            'remove': self._aggregate_action("SELECT %s" % ", ".join("OLD.%s AS %s" % (c, c) for c in columns), None),
+            'add': self._aggregate_action(None, "SELECT %s" % ", ".join("NEW.%s AS %s" % (c, c) for c in columns)),
+        }
+
+    def _source_row_sql(self):
+        """Source trigger firing for each modified row of the source table"""
         return """
         -- trigger to watch changes in the source table
         CREATE OR REPLACE FUNCTION %(prefix_fcn)s_%(trg_fcn_id)d_source_trigger() RETURNS TRIGGER AS $$
         DECLARE
-            bbox geometry;
+            bbox geometry;%(stats_declare)s
         BEGIN
         IF (TG_OP = 'DELETE') THEN
             bbox := OLD.geom;
@@ -142,59 +1040,288 @@ class SqlGenerator:
         ELSE  -- update
             bbox := st_envelope(st_union(st_envelope(OLD.geom), st_envelope(NEW.geom)));
         END IF;
-        
-        -- trigger update of target layer
-        UPDATE %(target_table)s SET %(first_target_attr)s = NULL WHERE geom && bbox;
-        
+        %(subdivided_sync)s
+        -- update of target layer%(update)s
+%(stats_record)s
         RETURN NULL;
         END;
         $$ LANGUAGE plpgsql;
+        """ % dict(self._params(),
+                   stats_declare=self._stats_declare_sql(),
+                   stats_record=self._stats_record_sql('source'),
+                   update=self._source_row_update_sql(),
+                   subdivided_sync=self._subdivided_row_sync_sql())
 
-        -- TODO: better performance - for the whole table just once?
+    def _source_row_triggers_sql(self):
+        """Returns SQL (re)creating the row source triggers"""
+        return """
+        DROP TRIGGER IF EXISTS %(prefix_trg)s_%(trg_fcn_id)d_del_source_trigger ON %(source_table)s;
         DROP TRIGGER IF EXISTS %(prefix_trg)s_%(trg_fcn_id)d_source_trigger ON %(source_table)s;
         CREATE TRIGGER %(prefix_trg)s_%(trg_fcn_id)d_source_trigger
-        AFTER INSERT OR UPDATE OR DELETE ON %(source_table)s
+        AFTER INSERT OR DELETE ON %(source_table)s
             FOR EACH ROW EXECUTE PROCEDURE %(prefix_fcn)s_%(trg_fcn_id)d_source_trigger();
 
+        -- updates which do not touch geometry or mapped attributes are skipped
+        DROP TRIGGER IF EXISTS %(prefix_trg)s_%(trg_fcn_id)d_upd_source_trigger ON %(source_table)s;
+        CREATE TRIGGER %(prefix_trg)s_%(trg_fcn_id)d_upd_source_trigger
+        AFTER UPDATE ON %(source_table)s
+            FOR EACH ROW WHEN (%(changed)s)
+            EXECUTE PROCEDURE %(prefix_fcn)s_%(trg_fcn_id)d_source_trigger();
+        """ % dict(self._params(), changed=self._source_changed_condition())
+
+    def _source_statement_sql(self, action):
+        """Source trigger firing once per statement, using transition tables (PostgreSQL >= 10).
+
+        The action is a method returning SQL for source rows removed and added by the statement
+        (queries or None) - either _refresh_action() which re-samples every affected target row exactly
+        once, no matter how many of the modified source rows overlap it, _enqueue_action() for the
+        deferred mode or _aggregate_action() adjusting aggregates.
+        """
+        columns = ", ".join(['geom'] + [c for c in self._watched_source_columns() if c != 'geom'])
+        # rows of an update where neither geometry nor mapped attributes changed cancel out
+        removed_update = "SELECT %(columns)s FROM old_rows EXCEPT ALL SELECT %(columns)s FROM new_rows" % {'columns': columns}
+        added_update = "SELECT %(columns)s FROM new_rows EXCEPT ALL SELECT %(columns)s FROM old_rows" % {'columns': columns}
+
+        return """
+        -- trigger to watch changes in the source table
+        CREATE OR REPLACE FUNCTION %(prefix_fcn)s_%(trg_fcn_id)d_source_trigger() RETURNS TRIGGER AS $$
+        DECLARE%(stats_declare)s
+        BEGIN
+        -- update of target layer
+        IF (TG_OP = 'DELETE') THEN%(sync_delete)s%(action_delete)s
+        ELSIF (TG_OP = 'INSERT') THEN%(sync_insert)s%(action_insert)s
+        ELSE  -- update%(sync_update)s%(action_update)s
+        END IF;
+%(stats_record)s
+        RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """ % dict(self._params(),
+                   stats_declare=self._stats_declare_sql(),
+                   stats_record=self._stats_record_sql('source'),
+                   sync_delete=self._subdivided_statement_sync_sql("SELECT * FROM old_rows", None),
+                   sync_insert=self._subdivided_statement_sync_sql(None, "SELECT * FROM new_rows"),
+                   sync_update=self._subdivided_statement_sync_sql(
+                       "SELECT %(key)s, geom FROM old_rows EXCEPT SELECT %(key)s, geom FROM new_rows" % {'key': self.source_key},
+                       "SELECT %(key)s, geom FROM new_rows EXCEPT SELECT %(key)s, geom FROM old_rows" % {'key': self.source_key}),
+                   action_delete=action("SELECT * FROM old_rows", None),
+                   action_insert=action(None, "SELECT * FROM new_rows"),
+                   action_update=action(removed_update, added_update))
+
+    def _source_statement_triggers_sql(self):
+        """Returns SQL (re)creating the statement source triggers.
+        PostgreSQL does not allow transition tables on triggers with more than one event,
+        so there is one trigger per event, all of them sharing the same function."""
+        return """
+        DROP TRIGGER IF EXISTS %(prefix_trg)s_%(trg_fcn_id)d_source_trigger ON %(source_table)s;
+        CREATE TRIGGER %(prefix_trg)s_%(trg_fcn_id)d_source_trigger
+        AFTER INSERT ON %(source_table)s
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE PROCEDURE %(prefix_fcn)s_%(trg_fcn_id)d_source_trigger();
+
+        DROP TRIGGER IF EXISTS %(prefix_trg)s_%(trg_fcn_id)d_upd_source_trigger ON %(source_table)s;
+        CREATE TRIGGER %(prefix_trg)s_%(trg_fcn_id)d_upd_source_trigger
+        AFTER UPDATE ON %(source_table)s
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE PROCEDURE %(prefix_fcn)s_%(trg_fcn_id)d_source_trigger();
+
+        DROP TRIGGER IF EXISTS %(prefix_trg)s_%(trg_fcn_id)d_del_source_trigger ON %(source_table)s;
+        CREATE TRIGGER %(prefix_trg)s_%(trg_fcn_id)d_del_source_trigger
+        AFTER DELETE ON %(source_table)s
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE PROCEDURE %(prefix_fcn)s_%(trg_fcn_id)d_source_trigger();
+        """ % self._params()
+
+    def _target_sql(self):
+        """Target trigger doing the actual lookup of attributes in the source table"""
+        assignments_null = []
+        assignments_copy = []
+        for source_attr, target_attr in self.attr_map.items():
+            assignments_null.append("NEW.%s = NULL;" % target_attr)
+            assignments_copy.append("NEW.%s = myrec.%s;" % (target_attr, source_attr))
+        for target_attr in self.agg_map:
+            # aggregate query always returns a row
+            assignments_null.append("NEW.%s = NULL;" % target_attr)
+            assignments_copy.append("NEW.%s = myrec.%s;" % (target_attr, target_attr))
+        if self.agg_map:
+            lookup = self._aggregate_lookup_sql('NEW.geom', into='myrec')
+        else:
+            lookup = self._lookup_sql('NEW.geom', into='myrec')
+
+        return """
         -- trigger on the target table to actually update the data
         CREATE OR REPLACE FUNCTION %(prefix_fcn)s_%(trg_fcn_id)d_target_trigger() RETURNS TRIGGER AS $$
         DECLARE
-        myrec RECORD;
+        myrec RECORD;%(stats_declare)s
             BEGIN
-                -- using dwithin to account for numerical issues when dealing with linestrings
-                -- set to 1cm tolerance (assuming CRS in meters)
-                SELECT * INTO myrec FROM %(source_table)s src WHERE st_dwithin(NEW.geom, src.geom, 0.01);
+                -- re-sample only if the geometry has changed
+                IF (TG_OP = 'UPDATE' AND NEW.geom IS NOT DISTINCT FROM OLD.geom) THEN%(stats_record)s
+                  RETURN NEW;
+                END IF;
+
+                %(lookup)s;
                 IF NOT FOUND THEN
                   %(assignments_null)s
                 ELSE
                   %(assignments_copy)s
                 END IF;
+                dsp_rows := 1;
+                dsp_lookups := 1;%(stats_record)s
                 RETURN NEW;
             END;
         $$ LANGUAGE plpgsql;
+        """ % dict(self._params(),
+                   stats_declare=self._stats_declare_sql(),
+                   stats_record=self._stats_record_sql('target'),
+                   lookup=lookup,
+                   assignments_null="\n".join(assignments_null),
+                   assignments_copy="\n".join(assignments_copy))
 
+    def _target_trigger_sql(self):
+        """Returns SQL (re)creating the target trigger"""
+        return """
         DROP TRIGGER IF EXISTS %(prefix_trg)s_%(trg_fcn_id)d_target_trigger ON %(target_table)s;
 
+        -- updates of the target table coming from the source trigger do not include geometry
         CREATE TRIGGER %(prefix_trg)s_%(trg_fcn_id)d_target_trigger
-        BEFORE INSERT OR UPDATE ON %(target_table)s
+        BEFORE INSERT OR UPDATE OF geom ON %(target_table)s
             FOR EACH ROW EXECUTE PROCEDURE %(prefix_fcn)s_%(trg_fcn_id)d_target_trigger();
+        """ % self._params()
 
-        COMMENT ON TRIGGER %(prefix_trg)s_%(trg_fcn_id)d_target_trigger ON %(target_table)s IS '%(json)s';
+    def _functions_sql(self):
+        """Returns SQL creating or replacing the trigger functions (and the tables they need)"""
+        if self.mode == 'statement':
+            source_sql = self._source_statement_sql(self._aggregate_action if self.agg_map else self._refresh_action)
+        elif self.mode == 'deferred':
+            # the worker recomputes aggregates of the target rows in the queued areas
+            source_sql = queue_sql() + self._source_statement_sql(self._enqueue_action)
+        else:
+            source_sql = self._source_row_sql()
+        return registry_sql() + stats_sql() + source_sql + self._target_sql()
 
-        """ % {
-            'source_table': self.source_table,
-            'target_table': self.target_table,
-            'prefix_fcn': prefix_fcn,
-            'prefix_trg': prefix_trg,
-            'trg_fcn_id': self.trg_fcn_id,
-            'first_target_attr': first_target_attr,
-            'assignments_null': "\n".join(assignments_null),
-            'assignments_copy': "\n".join(assignments_copy),
-            'json': self.write_json().replace("'", "\\'")
-            }
+    def _uses_dispatch(self):
+        return self.consolidate and self.mode == 'row' and not self.agg_map
+
+    def _triggers_sql(self):
+        """Returns SQL (re)creating the triggers - unlike replacing of functions this locks the tables against writes"""
+        if self.mode == 'row':
+            sql = self._source_row_triggers_sql()
+        else:
+            sql = self._source_statement_triggers_sql()
+        sql += self._target_trigger_sql()
+        if self._uses_dispatch():
+            # the pair's own triggers are kept (they carry the configuration), the work is done by dispatch triggers
+            sql += """
+        ALTER TABLE %(source_table)s DISABLE TRIGGER %(prefix_trg)s_%(trg_fcn_id)d_source_trigger;
+        ALTER TABLE %(source_table)s DISABLE TRIGGER %(prefix_trg)s_%(trg_fcn_id)d_upd_source_trigger;
+        ALTER TABLE %(target_table)s DISABLE TRIGGER %(prefix_trg)s_%(trg_fcn_id)d_target_trigger;
+        """ % self._params()
+        return sql
+
+    def _enable_triggers_sql(self):
+        """Returns SQL enabling disabled triggers of the pair - without locking the tables if none is disabled"""
+        return r"""
+        DO $$ DECLARE
+            trg RECORD;
+        BEGIN
+            FOR trg IN SELECT tgrelid::regclass AS tbl, tgname FROM pg_trigger
+                       WHERE tgrelid IN ('%(source_table)s'::regclass, '%(target_table)s'::regclass) AND tgenabled = 'D'
+                         AND tgname LIKE '%(prefix_trg)s\_%(trg_fcn_id)d\_%%'
+            LOOP
+                EXECUTE format('ALTER TABLE %%s ENABLE TRIGGER %%I', trg.tbl, trg.tgname);
+            END LOOP;
+        END $$;
+        """ % self._params()
+
+    def _triggers_key(self):
+        """Returns everything definitions of the triggers depend on (but not their functions)"""
+        return (self.trg_fcn_id, self.source_table, self.target_table, self.mode == 'row', self._uses_dispatch(),
+                self._source_changed_condition() if self.mode == 'row' else None)
+
+    def _subdivided_key(self):
+        """Returns everything the sidecar table depends on (None without it)"""
+        if not self._uses_subdivided():
+            return None
+        return self.subdivided_table(), self.source_table, self.source_key, self.subdivide_vertices
+
+    def check(self):
+        """Raises ValueError if the configuration cannot be generated"""
+        if self.attr_map and self.agg_map:
+            raise ValueError("Copied and aggregated attributes cannot be mixed in one trigger pair")
+        for name, values in (('mode', modes), ('predicate', predicates), ('order_by', orderings), ('overlap', overlaps)):
+            if getattr(self, name) not in values:
+                raise ValueError("Unknown %s '%s' (valid values: %s)" % (name, getattr(self, name), ", ".join(
+                    "'%s'" % value for value in values)))
+        for target_attr, (func, source_attr) in self.agg_map.items():
+            if func not in aggregates:
+                raise ValueError("Unknown aggregate '%s' of %s" % (func, target_attr))
+
+    def create_sql(self):
+        if not self.attr_map and not self.agg_map:
+            return
+        self.check()
+
+        sql = self._functions_sql() + self._triggers_sql() + self.register_sql()
+        if self._uses_subdivided():
+            sql = self._subdivided_table_sql() + sql
+        return sql
+
+    def replace_sql(self, old):
+        """Returns SQL replacing the installed pair old (with the same ID) by this configuration.
+
+        Functions are replaced in place, which does not lock the tables. Triggers are only re-created
+        (in the same transaction, so no edit is missed) if their definition has changed and the sidecar
+        table is only rebuilt if its settings have changed. Triggers disabled by the automatic repair
+        are enabled again (the edit may have removed the cause). Progress of an interrupted resync is reset.
+        """
+        if not self.attr_map and not self.agg_map:
+            return
+        self.check()
+        sql = ""
+        if old._subdivided_key() is not None and self._subdivided_key() != old._subdivided_key():
+            sql += """
+        DROP TABLE IF EXISTS %s;""" % old.subdivided_table()
+        if self._uses_subdivided() and self._subdivided_key() != old._subdivided_key():
+            sql += self._subdivided_table_sql()
+        sql += self._functions_sql()
+        if self._triggers_key() != old._triggers_key():
+            sql += old._drop_triggers_sql() + self._triggers_sql()
+        elif not self._uses_dispatch():
+            sql += self._enable_triggers_sql()
+        sql += self.register_sql()
+        sql += """
+        DO $$ BEGIN
+            IF to_regclass('%(backfill_table)s') IS NOT NULL THEN
+                DELETE FROM %(backfill_table)s WHERE trg_fcn_id = %(trg_fcn_id)d;
+            END IF;
+        END $$;
+        """ % dict(self._params(), backfill_table=backfill_table)
+        return sql
+
+    def changed_target_columns(self, old):
+        """Returns sorted list of target columns whose values may differ after old has been replaced
+        by this configuration - all of them if the lookup itself has changed"""
+        lookup = ('source_table', 'target_table', 'predicate', 'tolerance', 'order_by', 'order_column', 'overlap')
+        if any(getattr(self, key) != getattr(old, key) for key in lookup):
+            return sorted(set(self.attr_map.values()) | set(self.agg_map))
+        columns = set(target_attr for target_attr in self.agg_map if self.agg_map[target_attr] != old.agg_map.get(target_attr))
+        old_sources = dict((target_attr, source_attr) for source_attr, target_attr in old.attr_map.items())
+        columns |= set(target_attr for source_attr, target_attr in self.attr_map.items()
+                       if old_sources.get(target_attr) != source_attr)
+        return sorted(columns)
+
+    def register_sql(self):
+        """Returns SQL storing the pair with its configuration in the registry"""
+        return """
+        INSERT INTO %(registry_table)s (trg_fcn_id, source_table, target_table, mode, config, version)
+        VALUES (%(trg_fcn_id)d, '%(source_table)s'::regclass, '%(target_table)s'::regclass, '%(mode)s', '%(json)s'::jsonb, %(version)d)
+        ON CONFLICT (trg_fcn_id) DO UPDATE SET source_table = EXCLUDED.source_table, target_table = EXCLUDED.target_table,
+            mode = EXCLUDED.mode, config = EXCLUDED.config, version = EXCLUDED.version;
+        """ % dict(self._params(), registry_table=registry_table, mode=self.mode, version=generator_version,
+                   json=self.write_json().replace("'", "''"))
 
     def load_trigger_sql(self):
-        """Gets trigger definition stored in JSON from target table's comments"""
+        """Gets trigger definition stored in JSON from target table's comments (older versions of the plugin)"""
         return """SELECT obj_description( (SELECT oid FROM pg_trigger WHERE tgname='%(prefix_trg)s_%(trg_fcn_id)d_target_trigger'), 'pg_trigger');""" % {
             'prefix_trg': prefix_trg,
             'trg_fcn_id': self.trg_fcn_id,
@@ -207,6 +1334,18 @@ class SqlGenerator:
         self.target_table = data['target_table']
         self.trg_fcn_id = data['trg_fcn_id']
         self.attr_map = data['attr_map']
+        self.agg_map = data.get('agg_map', {})
+        self.mode = data.get('mode', 'row')  # older triggers do not have the mode stored
+        self.consolidate = data.get('consolidate', False)
+        self.predicate = data.get('predicate', 'dwithin')
+        self.tolerance = data.get('tolerance', 0.01)
+        self.order_by = data.get('order_by', '')
+        self.order_column = data.get('order_column')
+        self.overlap = data.get('overlap', '')
+        self.subdivide = data.get('subdivide', False)
+        self.subdivide_vertices = data.get('subdivide_vertices', 256)
+        self.source_key = data.get('source_key')
+        self.check()
 
     def write_json(self):
         """Returns string with trigger data encoded in JSON document"""
@@ -215,5 +1354,204 @@ class SqlGenerator:
             'target_table': self.target_table,
             'trg_fcn_id': self.trg_fcn_id,
             'attr_map': self.attr_map,
+            'agg_map': self.agg_map,
+            'mode': self.mode,
+            'consolidate': self.consolidate,
+            'predicate': self.predicate,
+            'tolerance': self.tolerance,
+            'order_by': self.order_by,
+            'order_column': self.order_column,
+            'overlap': self.overlap,
+            'subdivide': self.subdivide,
+            'subdivide_vertices': self.subdivide_vertices,
+            'source_key': self.source_key,
         }
         return json.dumps(data)
+
+
+def _count_rows_sql(lookups=False):
+    """Returns plpgsql code adding number of rows processed by the previous statement to the statistics
+    of the trigger call (and to the lookups if every row did a lookup)"""
+    return """
+            GET DIAGNOSTICS dsp_count = ROW_COUNT;
+            dsp_rows := dsp_rows + dsp_count;%s""" % ("\n            dsp_lookups := dsp_lookups + dsp_count;" if lookups else "")
+
+
+def _changed_condition(source_attrs):
+    """Returns condition which is true if geometry or any of the given columns of the row has changed"""
+    columns = ['geom']
+    for source_attr in source_attrs:
+        if source_attr not in columns:
+            columns.append(source_attr)
+    return " OR ".join("OLD.%s IS DISTINCT FROM NEW.%s" % (c, c) for c in columns)
+
+
+def _dispatch_function_name(table, side):
+    """Returns name of the dispatch function of the table ('source' or 'target' side)"""
+    table_hash = hashlib.md5(table.encode('utf-8')).hexdigest()[:10]
+    return "%s_%s_%s_trigger" % (prefix_dispatch, table_hash, side)
+
+
+def _group_by(generators, key):
+    """Returns list of lists of generators with the same key, in the order of first occurrence"""
+    groups = {}
+    for sql_gen in generators:
+        groups.setdefault(key(sql_gen), []).append(sql_gen)
+    return list(groups.values())
+
+
+def _dispatch_source_sql(table, generators):
+    """Source dispatch trigger - one row trigger on the source table doing the work of all consolidated pairs"""
+    actions = []
+    # pairs updating the same target table with the same filter share one UPDATE statement
+    for group in _group_by(generators, lambda g: (g.target_table, g._target_filter_sql('t', 'bbox'))):
+        changed = _changed_condition([c for sql_gen in group for c in sql_gen._watched_source_columns()])
+        actions.append("""
+        -- pairs %(ids)s
+        IF (TG_OP <> 'UPDATE' OR %(changed)s) THEN
+            UPDATE %(target_table)s t SET %(assignments)s WHERE %(filter)s;
+        END IF;""" % {
+            'ids': ", ".join(str(sql_gen.trg_fcn_id) for sql_gen in group),
+            'changed': changed,
+            'target_table': group[0].target_table,
+            # pairs with the same lookup share a single sub-select
+            'assignments': ", ".join(
+                lookup_group[0]._assignment_sql('t.geom', [pair for g in lookup_group for pair in g.attr_map.items()])
+                for lookup_group in _group_by(group, lambda g: g._lookup_key())),
+            'filter': group[0]._target_filter_sql('t', 'bbox'),
+        })
+
+    return """
+        CREATE OR REPLACE FUNCTION %(function)s() RETURNS TRIGGER AS $$
+        DECLARE
+            bbox geometry;
+        BEGIN
+        IF (TG_OP = 'DELETE') THEN
+            bbox := OLD.geom;
+        ELSIF (TG_OP = 'INSERT') THEN
+            bbox := NEW.geom;
+        ELSE  -- update
+            bbox := st_envelope(st_union(st_envelope(OLD.geom), st_envelope(NEW.geom)));
+        END IF;
+        %(subdivided_sync)s%(actions)s
+
+        RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS %(prefix_dispatch)s_source_trigger ON %(table)s;
+        CREATE TRIGGER %(prefix_dispatch)s_source_trigger
+        AFTER INSERT OR DELETE ON %(table)s
+            FOR EACH ROW EXECUTE PROCEDURE %(function)s();
+
+        DROP TRIGGER IF EXISTS %(prefix_dispatch)s_upd_source_trigger ON %(table)s;
+        CREATE TRIGGER %(prefix_dispatch)s_upd_source_trigger
+        AFTER UPDATE ON %(table)s
+            FOR EACH ROW WHEN (%(changed)s)
+            EXECUTE PROCEDURE %(function)s();
+        """ % {
+        'function': _dispatch_function_name(table, 'source'),
+        'prefix_dispatch': prefix_dispatch,
+        'table': table,
+        'actions': "\n".join(actions),
+        'subdivided_sync': "".join(sql_gen._subdivided_row_sync_sql() for sql_gen in generators),
+        'changed': _changed_condition([c for sql_gen in generators for c in sql_gen._watched_source_columns()]),
+    }
+
+
+def _dispatch_target_sql(table, generators):
+    """Target dispatch trigger - one row trigger on the target table doing lookups of all consolidated pairs"""
+    declarations = []
+    lookups = []
+    # pairs with the same lookup (e.g. the same source table) share a single query
+    for i, group in enumerate(_group_by(generators, lambda g: g._lookup_key())):
+        source_attrs = []
+        assignments_null = []
+        assignments_copy = []
+        for sql_gen in group:
+            for source_attr, target_attr in sql_gen.attr_map.items():
+                if source_attr not in source_attrs:
+                    source_attrs.append(source_attr)
+                assignments_null.append("NEW.%s = NULL;" % target_attr)
+                assignments_copy.append("NEW.%s = myrec%d.%s;" % (target_attr, i, source_attr))
+
+        declarations.append("myrec%d RECORD;" % i)
+        lookups.append("""
+                -- pairs %(ids)s
+                %(lookup)s;
+                IF NOT FOUND THEN
+                  %(assignments_null)s
+                ELSE
+                  %(assignments_copy)s
+                END IF;""" % {
+            'ids': ", ".join(str(sql_gen.trg_fcn_id) for sql_gen in group),
+            'lookup': group[0]._lookup_sql('NEW.geom', into='myrec%d' % i, source_attrs=source_attrs),
+            'assignments_null': "\n".join(assignments_null),
+            'assignments_copy': "\n".join(assignments_copy),
+        })
+
+    return """
+        CREATE OR REPLACE FUNCTION %(function)s() RETURNS TRIGGER AS $$
+        DECLARE
+        %(declarations)s
+            BEGIN
+                -- re-sample only if the geometry has changed
+                IF (TG_OP = 'UPDATE' AND NEW.geom IS NOT DISTINCT FROM OLD.geom) THEN
+                  RETURN NEW;
+                END IF;
+                %(lookups)s
+                RETURN NEW;
+            END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS %(prefix_dispatch)s_target_trigger ON %(table)s;
+        CREATE TRIGGER %(prefix_dispatch)s_target_trigger
+        BEFORE INSERT OR UPDATE OF geom ON %(table)s
+            FOR EACH ROW EXECUTE PROCEDURE %(function)s();
+        """ % {
+        'function': _dispatch_function_name(table, 'target'),
+        'prefix_dispatch': prefix_dispatch,
+        'table': table,
+        'declarations': "\n".join(declarations),
+        'lookups': "\n".join(lookups),
+    }
+
+
+def dispatch_sql(table, generators):
+    """Returns SQL (re)creating dispatch triggers of the table for all consolidated pairs using it.
+    Dispatch triggers which are not needed anymore are dropped."""
+    generators = [sql_gen for sql_gen in generators if sql_gen.consolidate and sql_gen.mode == 'row' and not sql_gen.agg_map]
+    sources = [sql_gen for sql_gen in generators if sql_gen.source_table == table]
+    targets = [sql_gen for sql_gen in generators if sql_gen.target_table == table]
+
+    sql = ""
+    for side, side_generators, create in [('source', sources, _dispatch_source_sql),
+                                          ('target', targets, _dispatch_target_sql)]:
+        if side_generators:
+            sql += create(table, side_generators)
+        else:
+            sql += """
+        DROP FUNCTION IF EXISTS %s() cascade;""" % _dispatch_function_name(table, side)
+    return sql
+
+
+def regenerate_dispatch_sql(conn, tables, new_generators=(), removed_ids=()):
+    """Returns SQL regenerating dispatch triggers of the given tables after pairs have been added or removed.
+    The stored pairs are loaded from the database, new_generators are pairs about to be created
+    and pairs with IDs in removed_ids are about to be dropped."""
+    cur = conn.cursor()
+    existing_tables = set()
+    for table in set(tables):
+        if not table:
+            continue
+        cur.execute("SELECT to_regclass(%s)", (table,))
+        if cur.fetchone()[0] is not None:
+            existing_tables.add(table)
+    tables = existing_tables
+
+    trigger_ids = [trigger_id for trigger_id, source_table, target_table in list_triggers(conn)
+                   if trigger_id not in removed_ids and (source_table in tables or target_table in tables)]
+    generators = list(load_sql_generators(conn, trigger_ids).values()) if trigger_ids else []
+    generators += list(new_generators)
+
+    return "".join(dispatch_sql(table, generators) for table in sorted(tables))
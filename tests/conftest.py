@@ -0,0 +1,76 @@
+# encoding: utf-8
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+"""
+The plugin directory is imported as package "postgis_sampling_tool" (its name when installed in QGIS),
+tests only use modules which do not need QGIS.
+"""
+
+import importlib.util
+import os
+import sys
+
+import pytest
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if 'postgis_sampling_tool' not in sys.modules:
+    spec = importlib.util.spec_from_file_location('postgis_sampling_tool', os.path.join(PLUGIN_DIR, '__init__.py'),
+                                                  submodule_search_locations=[PLUGIN_DIR])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['postgis_sampling_tool'] = module
+    spec.loader.exec_module(module)
+
+
+class FakeCursor:
+    """ Cursor recording executed statements, results are taken from the connection's queue """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, params=None):
+        self.conn.executed.append((sql, params))
+        result = self.conn.results.pop(0) if self.conn.results else []
+        if isinstance(result, Exception):
+            raise result
+        self.rows = result
+        self.rowcount = len(result)
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+    """ Connection for code which only needs cursors, commit and rollback. results is a list with rows
+    (or an exception to raise) for each executed statement. """
+
+    def __init__(self, results=None):
+        self.results = list(results or [])
+        self.executed = []
+        self.commits = 0
+        self.rollbacks = 0
+        self.autocommit = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+@pytest.fixture
+def fake_conn():
+    return FakeConnection()
@@ -0,0 +1,90 @@
+# encoding: utf-8
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+import psycopg2
+import pytest
+
+from postgis_sampling_tool import ddl
+from postgis_sampling_tool.ddl import LockTimeout, execute_ddl
+
+
+class LockNotAvailable(psycopg2.OperationalError):
+    pgcode = '55P03'
+
+
+class UndefinedTable(psycopg2.ProgrammingError):
+    pgcode = '42P01'
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(ddl, 'BACKOFF', 0.0)
+
+
+def test_execute_ddl(fake_conn):
+    assert execute_ddl(fake_conn, ["DROP TRIGGER a ON t", None, "CREATE TRIGGER a"], statement_timeout=5000) == 1
+    assert fake_conn.executed == [("SET LOCAL lock_timeout = %s", ("2000ms",)),
+                                  ("SET LOCAL statement_timeout = %s", ("5000ms",)),
+                                  ("DROP TRIGGER a ON t", None), ("CREATE TRIGGER a", None)]
+    assert fake_conn.commits == 1 and fake_conn.rollbacks == 0
+
+
+def test_execute_ddl_retries_when_locked(fake_conn):
+    fake_conn.results = [[], LockNotAvailable("locked"), [], LockNotAvailable("locked"), [], []]
+    assert execute_ddl(fake_conn, ["DROP TRIGGER a ON t"]) == 3
+    assert fake_conn.rollbacks == 2 and fake_conn.commits == 1
+    assert [sql for sql, params in fake_conn.executed].count("DROP TRIGGER a ON t") == 3
+
+
+def test_execute_ddl_backoff(fake_conn, monkeypatch):
+    monkeypatch.setattr(ddl, 'BACKOFF', 0.5)
+    monkeypatch.setattr(ddl.random, 'uniform', lambda a, b: 1.0)
+    clock = [0.0]
+    pauses = []
+    monkeypatch.setattr(ddl.time, 'time', lambda: clock[0])
+
+    def sleep(seconds):
+        clock[0] += seconds
+        pauses.append(seconds)
+    monkeypatch.setattr(ddl.time, 'sleep', sleep)
+
+    fake_conn.results = [[], LockNotAvailable("locked")] * 3
+    with pytest.raises(LockTimeout):
+        execute_ddl(fake_conn, ["DROP TRIGGER a ON t"], retries=2)
+    assert sum(pauses) == pytest.approx(0.5 + 1.0)   # doubled for the second retry, none after the last attempt
+
+
+def test_execute_ddl_gives_up(fake_conn):
+    fake_conn.results = [[], LockNotAvailable("locked")] * 3
+    with pytest.raises(LockTimeout, match="3 attempts"):
+        execute_ddl(fake_conn, ["DROP TRIGGER a ON t"], retries=2)
+    assert fake_conn.rollbacks == 3 and fake_conn.commits == 0
+
+
+def test_execute_ddl_other_errors_are_not_retried(fake_conn):
+    fake_conn.results = [[], UndefinedTable("no table")]
+    with pytest.raises(UndefinedTable):
+        execute_ddl(fake_conn, ["DROP TRIGGER a ON t"])
+    assert fake_conn.rollbacks == 1 and len(fake_conn.executed) == 2
+
+
+def test_execute_ddl_progress_can_stop(fake_conn, monkeypatch):
+    monkeypatch.setattr(ddl, 'BACKOFF', 10.0)
+
+    class Stop(Exception):
+        pass
+
+    def progress(done, total, text):
+        if text:
+            raise Stop()
+    fake_conn.results = [[], LockNotAvailable("locked")]
+    with pytest.raises(Stop):   # stops waiting for the retry
+        execute_ddl(fake_conn, ["DROP TRIGGER a ON t"], progress=progress)
+    assert fake_conn.rollbacks == 1
@@ -0,0 +1,140 @@
+# encoding: utf-8
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+import pytest
+
+from postgis_sampling_tool import deploy
+from postgis_sampling_tool.deploy import parse_pairs, plan_deployment, plan_removal
+
+
+def pair(source_table='public.zones', target_table='public.buildings', **config):
+    entry = {'source_table': source_table, 'target_table': target_table, 'attr_map': {'zone_code': 'zone'}}
+    entry.update(config)
+    return entry
+
+
+def installed(monkeypatch, entries):
+    """Registers pairs of the entries (with IDs from 1) in place of the database"""
+    generators = parse_pairs(entries)
+    for trigger_id, sql_gen in enumerate(generators, 1):
+        sql_gen.trg_fcn_id = trigger_id
+    monkeypatch.setattr(deploy, 'init_registry', lambda conn: None)
+    monkeypatch.setattr(deploy, 'load_sql_generators', lambda conn: dict((g.trg_fcn_id, g) for g in generators))
+    return generators
+
+
+def test_parse_pairs():
+    generators = parse_pairs({'pairs': [pair(), pair(target_table='public.parcels', predicate='intersects')]})
+    assert [sql_gen.target_table for sql_gen in generators] == ['public.buildings', 'public.parcels']
+    assert generators[0].attr_map == {'zone_code': 'zone'} and generators[0].trg_fcn_id is None
+    assert generators[1].predicate == 'intersects'
+    assert len(parse_pairs([pair()])) == 1   # a bare list of pairs
+
+
+def test_parse_pairs_missing_key():
+    with pytest.raises(ValueError, match="Pair 1: missing 'target_table'"):
+        parse_pairs([{'source_table': 'public.zones', 'attr_map': {'zone_code': 'zone'}}])
+
+
+def test_parse_pairs_without_attributes():
+    with pytest.raises(ValueError, match="Pair 2: no attributes are mapped"):
+        parse_pairs([pair(), pair(attr_map={})])
+
+
+def test_parse_pairs_rejects_duplicates():
+    with pytest.raises(ValueError, match="Pair 2: the same columns of public.buildings"):
+        parse_pairs([pair(), pair(predicate='intersects')])
+
+
+def test_parse_pairs_rejects_overlapping_columns():
+    with pytest.raises(ValueError, match="Pair 2: the same columns of public.buildings"):
+        parse_pairs([pair(), pair(source_table='public.districts', attr_map={'district': 'zone', 'name': 'name'})])
+
+
+@pytest.mark.parametrize('name, value', [('mode', 'rows'), ('predicate', 'within')])
+def test_parse_pairs_rejects_unknown_values(name, value):
+    with pytest.raises(ValueError, match="Pair 1: Unknown %s" % name):
+        parse_pairs([pair(**{name: value})])
+
+
+def test_parse_pairs_subdivide_needs_source_key():
+    with pytest.raises(ValueError, match="Pair 1: subdivide needs source_key"):
+        parse_pairs([pair(subdivide=True)])
+    assert parse_pairs([pair(subdivide=True, source_key='id')])[0]._uses_subdivided()
+
+
+def test_parse_pairs_rejects_mixed_maps():
+    with pytest.raises(ValueError, match="Pair 1"):
+        parse_pairs({'pairs': [{'source_table': 'public.zones', 'target_table': 'public.buildings',
+                                'attr_map': {'zone_code': 'zone'}, 'agg_map': {'zones': ['count', None]}}]})
+
+
+def test_plan_deployment(fake_conn, monkeypatch):
+    installed(monkeypatch, [pair(), pair(target_table='public.parcels'), pair(target_table='public.roads')])
+    generators = parse_pairs([pair(), pair(target_table='public.parcels', predicate='intersects'),
+                              pair(target_table='public.trees')])
+    plan = plan_deployment(fake_conn, generators)
+    assert [sql_gen.trg_fcn_id for sql_gen in plan.unchanged] == [1]
+    assert [(old.trg_fcn_id, new.predicate) for old, new in plan.update] == [(2, 'intersects')]
+    assert [sql_gen.target_table for sql_gen in plan.create] == ['public.trees']
+    assert plan.remove == []
+    assert plan.describe() == ["+ public.zones -> public.trees",
+                               "~ public.zones -> public.parcels [2] (predicate)"]
+
+
+def test_plan_deployment_prune(fake_conn, monkeypatch):
+    installed(monkeypatch, [pair(), pair(target_table='public.roads')])
+    plan = plan_deployment(fake_conn, parse_pairs([pair()]), prune=True)
+    assert [sql_gen.trg_fcn_id for sql_gen in plan.remove] == [2]
+    assert plan.describe() == ["- public.zones -> public.roads [2]"]
+    assert plan_deployment(fake_conn, parse_pairs([pair()])).is_empty()
+
+
+def test_plan_deployment_other_columns_are_another_pair(fake_conn, monkeypatch):
+    installed(monkeypatch, [pair()])
+    plan = plan_deployment(fake_conn, parse_pairs([pair(attr_map={'zone_code': 'zone_id'})]), prune=True)
+    assert len(plan.create) == 1 and len(plan.remove) == 1 and not plan.update
+
+
+def test_plan_deployment_added_column_updates_pair(fake_conn, monkeypatch):
+    installed(monkeypatch, [pair()])
+    plan = plan_deployment(fake_conn, parse_pairs([pair(attr_map={'zone_code': 'zone', 'zone_name': 'name'})]))
+    assert [(old.trg_fcn_id, new.attr_map) for old, new in plan.update] == [(1, {'zone_code': 'zone', 'zone_name': 'name'})]
+    assert not plan.create and not plan.remove
+
+
+def test_plan_deployment_renamed_source_column_updates_pair(fake_conn, monkeypatch):
+    installed(monkeypatch, [pair()])
+    plan = plan_deployment(fake_conn, parse_pairs([pair(attr_map={'zone_label': 'zone'})]))
+    assert [old.trg_fcn_id for old, new in plan.update] == [1] and not plan.create
+
+
+def test_plan_deployment_rejects_columns_of_installed_pair(fake_conn, monkeypatch):
+    installed(monkeypatch, [pair(), pair(source_table='public.districts', attr_map={'district': 'district'})])
+    generators = parse_pairs([pair(source_table='public.districts', attr_map={'district': 'zone'})])
+    with pytest.raises(ValueError, match=r"writes the same columns as the installed pair \[1\]"):
+        plan_deployment(fake_conn, generators)
+    plan = plan_deployment(fake_conn, generators, prune=True)
+    assert len(plan.create) == 1 and sorted(sql_gen.trg_fcn_id for sql_gen in plan.remove) == [1, 2]
+
+
+def test_plan_deployment_merged_pairs(fake_conn, monkeypatch):
+    installed(monkeypatch, [pair(), pair(attr_map={'zone_name': 'name'})])
+    generators = parse_pairs([pair(attr_map={'zone_code': 'zone', 'zone_name': 'name'})])
+    with pytest.raises(ValueError, match=r"installed pair \[1\]"):
+        plan_deployment(fake_conn, generators)
+    plan = plan_deployment(fake_conn, generators, prune=True)
+    assert len(plan.create) == 1 and sorted(sql_gen.trg_fcn_id for sql_gen in plan.remove) == [1, 2]
+
+
+def test_plan_removal(fake_conn, monkeypatch):
+    installed(monkeypatch, [pair(), pair(target_table='public.roads')])
+    plan = plan_removal(fake_conn, parse_pairs([pair(attr_map={'zone_label': 'zone'})]))
+    assert [sql_gen.trg_fcn_id for sql_gen in plan.remove] == [1]
@@ -0,0 +1,35 @@
+# encoding: utf-8
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+from postgis_sampling_tool.explain import preview_pair
+from postgis_sampling_tool.sql_generator import SqlGenerator
+
+
+def make_subdivided_generator(trigger_id):
+    sql_gen = SqlGenerator()
+    sql_gen.trg_fcn_id = trigger_id
+    sql_gen.source_table, sql_gen.target_table, sql_gen.attr_map = 'public.zones', 'public.buildings', {'code': 'zone'}
+    sql_gen.subdivide, sql_gen.source_key = True, 'id'
+    return sql_gen
+
+
+def test_preview_new_pair_does_not_use_subdivided_table(fake_conn):
+    fake_conn.results = [[(100,)], [], []]   # target rows, no samples
+    preview = preview_pair(fake_conn, make_subdivided_generator(None))
+    assert not any("subdivided" in str(params) + sql for sql, params in fake_conn.executed)
+    assert any("subdivided source geometries does not exist" in warning for warning in preview.warnings)
+    assert preview.target_rows == 100
+
+
+def test_preview_installed_pair_uses_its_subdivided_table(fake_conn):
+    fake_conn.results = [[(50,)], [(100,)], [], []]
+    preview = preview_pair(fake_conn, make_subdivided_generator(7))
+    assert fake_conn.executed[0][1] == ('public.dsp_fcn_7_subdivided',)
+    assert not any("subdivided source geometries" in warning for warning in preview.warnings)
@@ -0,0 +1,29 @@
+# encoding: utf-8
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+from postgis_sampling_tool.indexes import create_index_sql, index_name
+
+
+def test_index_name():
+    assert index_name('public.zones', 'geom', 'gist') == 'public.zones_geom_gist_idx'
+    assert index_name('zones', 'geom', 'gist') == 'zones_geom_gist_idx'
+
+
+def test_index_name_truncated():
+    name = index_name('data.' + 'b' * 70, 'geom', 'btree')
+    schema, _, name = name.partition('.')
+    assert schema == 'data'
+    assert len(name) == 63
+    assert name.startswith('bbbb') and name.endswith('_btree_idx')
+
+
+def test_create_index_sql():
+    assert create_index_sql('public.zones', 'code', 'btree') == \
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS zones_code_btree_idx ON public.zones USING btree (code)"
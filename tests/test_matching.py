@@ -0,0 +1,84 @@
+# encoding: utf-8
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+from postgis_sampling_tool import matching
+from postgis_sampling_tool.matching import (MatchRule, match_names, rules_from_option, PREFIX_SOURCE, SUFFIX_TARGET,
+                                            REGEX, SAME_NAME)
+
+
+def test_normalize_prefix_and_suffix():
+    rule = MatchRule(prefix='src_', suffix='_v2')
+    assert rule.normalize('src_zones_v2') == 'zones'
+    assert rule.normalize('zones_v2') is None
+    assert rule.normalize('src_zones') is None
+    assert rule.normalize('src__v2') == ''
+    assert MatchRule(prefix='ab', suffix='ba').normalize('aba') is None   # prefix and suffix overlap
+
+
+def test_normalize_case_insensitive():
+    assert MatchRule(prefix='SRC_').normalize('src_Zones') is None
+    assert MatchRule(prefix='SRC_', case_insensitive=True).normalize('src_Zones') == 'zones'
+
+
+def test_normalize_regex():
+    assert MatchRule(regex=r'^(\w+)_\d+$').normalize('zones_2020') == 'zones'
+    assert MatchRule(regex=r'\d+').normalize('zones_2020') == '2020'   # whole match without a group
+    assert MatchRule(regex=r'^x').normalize('zones') is None
+    assert MatchRule(regex=r'(zones').normalize('zones') is None       # incomplete expression
+    assert MatchRule(regex=r'^(ZONES)', case_insensitive=True).normalize('Zones_a') == 'zones'
+
+
+def test_rules_from_option():
+    source, target = rules_from_option(PREFIX_SOURCE, 'src_')
+    assert source.key() == ('src_', '', None, False) and target.key() == ('', '', None, False)
+    source, target = rules_from_option(SUFFIX_TARGET, '_t', case_insensitive=True)
+    assert source.key() == ('', '', None, True) and target.key() == ('', '_t', None, True)
+    source, target = rules_from_option(REGEX, r'(\w+)')
+    assert source.regex == target.regex == r'(\w+)'
+    source, target = rules_from_option(REGEX, '')
+    assert source.regex is None and target.regex is None
+
+
+def test_match_names():
+    source, target = rules_from_option(PREFIX_SOURCE, 'src_')
+    pairs = match_names(['src_b', 'src_a', 'other'], ['a', 'b', 'c'], source, target)
+    assert pairs == [('src_b', 'b'), ('src_a', 'a')]
+
+
+def test_match_names_several_targets():
+    source, target = rules_from_option(REGEX, r'^([a-z]+)')
+    pairs = match_names(['zones'], ['zones1', 'roads', 'zones2'], source, target)
+    assert pairs == [('zones', 'zones1'), ('zones', 'zones2')]
+
+
+def test_match_names_same_name():
+    source, target = rules_from_option(SAME_NAME, '')
+    assert match_names(['a', 'B'], ['b', 'a'], source, target) == [('a', 'a')]
+    source, target = rules_from_option(SAME_NAME, '', case_insensitive=True)
+    assert match_names(['a', 'B'], ['b', 'a'], source, target) == [('a', 'a'), ('B', 'b')]
+
+
+def test_cache_is_keyed_by_names_and_rule():
+    matching._cache.clear()
+    names = ('src_a', 'src_b')
+    match_names(names, ['a'], MatchRule(prefix='src_'), MatchRule())
+    assert matching._cache[(names, ('src_', '', None, False))] == [('src_a', 'a'), ('src_b', 'b')]
+    # another rule for the same names is cached separately
+    assert match_names(names, ['src_a'], MatchRule(), MatchRule()) == [('src_a', 'src_a')]
+    assert matching._cache[(names, ('', '', None, False))] == [('src_a', 'src_a'), ('src_b', 'src_b')]
+    assert matching._cache[(names, ('src_', '', None, False))] == [('src_a', 'a'), ('src_b', 'b')]
+
+
+def test_cache_is_cleared_when_full(monkeypatch):
+    monkeypatch.setattr(matching, '_cache_size', 2)
+    matching._cache.clear()
+    for i in range(3):
+        match_names(['a%d' % i], [], MatchRule(), MatchRule())
+    assert len(matching._cache) <= 2
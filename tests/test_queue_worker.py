@@ -0,0 +1,58 @@
+# encoding: utf-8
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+import psycopg2
+import psycopg2.extensions
+import pytest
+
+from postgis_sampling_tool import queue_worker
+from postgis_sampling_tool.queue_worker import process_batch
+from postgis_sampling_tool.sql_generator import SqlGenerator
+
+
+@pytest.fixture(autouse=True)
+def generators(monkeypatch):
+    sql_gen = SqlGenerator()
+    sql_gen.source_table, sql_gen.target_table, sql_gen.attr_map = 'public.zones', 'public.buildings', {'code': 'zone'}
+    monkeypatch.setattr(queue_worker, 'load_sql_generator', lambda conn, trigger_id: sql_gen)
+
+
+def test_process_batch(fake_conn):
+    fake_conn.results = [[(1, 7), (2, 7)]]
+    assert process_batch(fake_conn) == 2
+    assert fake_conn.executed[-1] == ("DELETE FROM public.dsp_queue WHERE id = ANY(%s)", ([1, 2],))
+    assert fake_conn.commits == 1
+
+
+def test_process_batch_moves_failed_entries(fake_conn):
+    # entries of trigger 7 fail (e.g. a dropped column), those of trigger 8 are processed
+    fake_conn.results = [[(1, 7), (2, 8), (3, 7)], [], psycopg2.ProgrammingError("column \"zone\" does not exist")]
+    errors = []
+    assert process_batch(fake_conn, on_error=lambda *args: errors.append(args)) == 3
+    statements = [sql for sql, params in fake_conn.executed]
+    assert "ROLLBACK TO SAVEPOINT dsp_trigger" in statements
+    failed = [params for sql, params in fake_conn.executed if "INSERT INTO public.dsp_queue_failed" in sql]
+    assert failed == [('column "zone" does not exist', [1, 3])]
+    assert [(trigger_id, count) for trigger_id, count, error in errors] == [(7, 2)]
+    assert fake_conn.executed[-1] == ("DELETE FROM public.dsp_queue WHERE id = ANY(%s)", ([1, 2, 3],))
+    assert fake_conn.commits == 1 and fake_conn.rollbacks == 0
+
+
+def test_process_batch_deadlock(fake_conn):
+    fake_conn.results = [[(1, 7)], [], psycopg2.extensions.TransactionRollbackError("deadlock detected")]
+    assert process_batch(fake_conn) == 0
+    assert fake_conn.rollbacks == 1 and fake_conn.commits == 0
+    assert not any("dsp_queue_failed" in sql for sql, params in fake_conn.executed)
+
+
+def test_process_batch_connection_errors_are_raised(fake_conn):
+    fake_conn.results = [[(1, 7)], [], psycopg2.OperationalError("server closed the connection")]
+    with pytest.raises(psycopg2.OperationalError):
+        process_batch(fake_conn)
@@ -0,0 +1,178 @@
+# encoding: utf-8
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+import pytest
+
+from postgis_sampling_tool.sql_generator import SqlGenerator, init_registry, registry_sql, shared_objects_version
+
+
+def make_generator(trigger_id=7, source_table='public.zones', target_table='data.buildings'):
+    sql_gen = SqlGenerator()
+    sql_gen.trg_fcn_id = trigger_id
+    sql_gen.source_table = source_table
+    sql_gen.target_table = target_table
+    sql_gen.attr_map = {'zone_code': 'zone'}
+    return sql_gen
+
+
+def test_drop_sql():
+    sql = make_generator().drop_sql()
+    assert "DROP TRIGGER IF EXISTS dsp_trg_7_source_trigger ON public.zones" in sql
+    assert "DROP TRIGGER IF EXISTS dsp_trg_7_target_trigger ON data.buildings" in sql
+    assert "DROP TABLE IF EXISTS public.dsp_fcn_7_subdivided;" in sql
+    assert "DELETE FROM public.dsp_registry WHERE trg_fcn_id = 7;" in sql
+
+
+def test_drop_sql_missing_source_table():
+    sql = make_generator(source_table=None).drop_sql()
+    assert " ON None" not in sql
+    assert "DROP TRIGGER IF EXISTS dsp_trg_7_target_trigger ON data.buildings" in sql
+    assert "relname = 'dsp_fcn_7_subdivided'" in sql   # sidecar found by name
+    for table in ('public.dsp_registry', 'public.dsp_queue', 'public.dsp_stats'):
+        assert "DELETE FROM %s WHERE trg_fcn_id = 7;" % table in sql
+
+
+def test_drop_sql_missing_target_table():
+    sql = make_generator(target_table=None).drop_sql()
+    assert " ON None" not in sql
+    assert "dsp_trg_7_target_trigger" not in sql
+    assert "DROP TRIGGER IF EXISTS dsp_trg_7_source_trigger ON public.zones" in sql
+    assert "DELETE FROM public.dsp_registry WHERE trg_fcn_id = 7;" in sql
+
+
+def test_drop_sql_missing_both_tables():
+    sql = make_generator(source_table=None, target_table=None).drop_sql()
+    assert "DROP TRIGGER" not in sql
+    assert "DELETE FROM public.dsp_registry WHERE trg_fcn_id = 7;" in sql
+
+
+def test_mixed_copy_and_aggregate_rejected():
+    sql_gen = make_generator()
+    sql_gen.agg_map = {'zone_count': ['count', None]}
+    with pytest.raises(ValueError):
+        sql_gen.create_sql()
+    with pytest.raises(ValueError):
+        SqlGenerator().parse_json(sql_gen.write_json())
+
+
+def test_init_registry_updates_existing_registry(fake_conn):
+    fake_conn.results = [[('public.dsp_registry',)], [], [(False,)]]
+    assert init_registry(fake_conn) == 0
+    assert any(sql == registry_sql() for sql, params in fake_conn.executed)
+
+
+def test_init_registry_migrates_unregistered_pairs(fake_conn):
+    # registry exists (e.g. created by create_sql()), but a pair of an older version is not registered
+    fake_conn.results = [[('public.dsp_registry',)], [], [(True,)], [],
+                         [('dsp_trg_3_source_trigger', 101, None), ('dsp_trg_3_target_trigger', 102, '{"mode": "row"}')],
+                         [(3,)], []]
+    assert init_registry(fake_conn) == 1
+    sql, params = [(sql, params) for sql, params in fake_conn.executed if 'INSERT INTO' in sql][0]
+    assert params[:4] == (3, 101, 102, 'row')
+
+
+def test_replace_sql_keeps_triggers():
+    old = make_generator()
+    new = make_generator()
+    new.predicate = 'intersects'
+    sql = new.replace_sql(old)
+    assert "CREATE OR REPLACE FUNCTION dsp_fcn_7_source_trigger()" in sql
+    assert "DROP TRIGGER" not in sql and "CREATE TRIGGER" not in sql
+    assert "subdivided" not in sql
+    assert "ON CONFLICT (trg_fcn_id) DO UPDATE" in sql
+    assert "DELETE FROM public.dsp_backfill WHERE trg_fcn_id = 7;" in sql
+
+
+def test_replace_sql_recreates_triggers():
+    old = make_generator()
+    new = make_generator()
+    new.mode = 'statement'
+    sql = new.replace_sql(old)
+    assert sql.index("DROP TRIGGER IF EXISTS dsp_trg_7_source_trigger ON public.zones") < sql.index("CREATE TRIGGER")
+    new = make_generator()
+    new.attr_map = {'zone_name': 'zone'}   # the source trigger fires on updates of other columns
+    assert "CREATE TRIGGER dsp_trg_7_source_trigger" in new.replace_sql(old)
+
+
+def test_replace_sql_subdivided_table():
+    old = make_generator()
+    new = make_generator()
+    new.subdivide, new.source_key = True, 'id'
+    sql = new.replace_sql(old)
+    assert sql.count("DROP TABLE IF EXISTS public.dsp_fcn_7_subdivided;") == 1
+    assert "CREATE TABLE public.dsp_fcn_7_subdivided" in sql
+    assert "public.dsp_fcn_7_subdivided" not in make_generator().replace_sql(make_generator())
+
+    newer = make_generator()
+    newer.subdivide, newer.source_key, newer.subdivide_vertices = True, 'id', 64
+    assert "CREATE TABLE public.dsp_fcn_7_subdivided" in newer.replace_sql(new)
+    assert "CREATE TABLE public.dsp_fcn_7_subdivided" not in new.replace_sql(new)
+
+    assert "DROP TABLE IF EXISTS public.dsp_fcn_7_subdivided;" in make_generator().replace_sql(new)
+
+
+def test_changed_target_columns():
+    old = make_generator()
+    old.attr_map = {'zone_code': 'zone', 'zone_name': 'name'}
+    new = make_generator()
+    new.attr_map = {'zone_code': 'zone', 'zone_label': 'name', 'area': 'zone_area'}
+    assert new.changed_target_columns(old) == ['name', 'zone_area']
+    assert old.changed_target_columns(old) == []
+    new.predicate = 'intersects'
+    assert new.changed_target_columns(old) == ['name', 'zone', 'zone_area']
+
+
+def test_changed_target_columns_aggregates():
+    old = make_generator()
+    old.attr_map = {}
+    old.agg_map = {'zone_count': ['count', None], 'zone_area': ['sum', 'area']}
+    new = make_generator()
+    new.attr_map = {}
+    new.agg_map = {'zone_count': ['count', None], 'zone_area': ['max', 'area']}
+    assert new.changed_target_columns(old) == ['zone_area']
+
+
+def test_registry_sql_replaces_only_older_objects():
+    sql = registry_sql()
+    assert "FROM '^dsp version ([0-9]+)$')::integer, 0) < %d THEN" % shared_objects_version in sql
+    assert sql.index("CREATE OR REPLACE VIEW public.dsp_registry_problems") < \
+        sql.index("COMMENT ON VIEW public.dsp_registry_problems IS 'dsp version %d'" % shared_objects_version)
+    assert "EXCEPTION WHEN insufficient_privilege" in sql
+
+
+def test_replace_sql_enables_disabled_triggers():
+    sql = make_generator().replace_sql(make_generator())
+    assert "tgenabled = 'D'" in sql and "ENABLE TRIGGER" in sql
+    consolidated = make_generator()
+    consolidated.consolidate = True   # own triggers stay disabled, dispatch triggers are re-created
+    assert "ENABLE TRIGGER" not in consolidated.replace_sql(consolidated)
+
+
+def test_registry_sql_reports_disabled_triggers():
+    assert "'disabled_trigger'" in registry_sql()
+
+
+@pytest.mark.parametrize('name, value', [('mode', 'rows'), ('predicate', 'within'), ('order_by', 'length'),
+                                         ('overlap', 'smallest')])
+def test_unknown_values_rejected(name, value):
+    sql_gen = make_generator()
+    setattr(sql_gen, name, value)
+    with pytest.raises(ValueError, match="Unknown %s" % name):
+        sql_gen.create_sql()
+    with pytest.raises(ValueError, match="Unknown %s" % name):
+        SqlGenerator().parse_json(sql_gen.write_json())
+
+
+def test_unknown_aggregate_rejected():
+    sql_gen = make_generator()
+    sql_gen.attr_map = {}
+    sql_gen.agg_map = {'zone_code': ['median', 'code']}
+    with pytest.raises(ValueError, match="Unknown aggregate 'median'"):
+        sql_gen.create_sql()
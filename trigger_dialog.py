@@ -14,58 +14,43 @@ import os
 
 from qgis.PyQt.QtGui import *
 from qgis.PyQt.QtCore import *
-from qgis.PyQt import uic
-from qgis.PyQt.QtWidgets import QMessageBox, QStyledItemDelegate, QComboBox
+from qgis.PyQt.QtWidgets import QMessageBox, QStyledItemDelegate, QComboBox, QDialogButtonBox
 
 from .sql_generator import SqlGenerator
+from .catalog import get_snapshot
+from .ui_loader import load_ui
+from .db_task import run_task, TaskCanceled
+from .explain import preview_pair
+from .indexes import offer_missing_indexes
 
 this_dir = os.path.dirname(__file__)
 
-WIDGET, BASE = uic.loadUiType(os.path.join(this_dir, 'trigger_dialog.ui'))
+# source trigger modes in the order of items in cboMode
+MODES = ['row', 'statement', 'deferred']
+# spatial relations in the order of items in cboPredicate
+PREDICATES = ['dwithin', 'intersects', 'contains', 'covers', 'nearest']
+# tie-breaking rules in the order of items in cboOrderBy
+ORDER_BY = ['', 'area', 'column', 'column_desc']
+# overlap rules in the order of items in cboOverlap
+OVERLAP = ['', 'largest', 'weighted']
+# types of fields which can be averaged
+NUMERIC_TYPES = ['int2', 'int4', 'int8', 'float4', 'float8', 'numeric']
+# aggregates offered in the mapping (besides "[none]" - copy of the attribute)
+AGGREGATES = ['count', 'sum', 'min', 'max', 'avg']
+
+WIDGET, BASE = load_ui('trigger_dialog')
 
 
 def get_table_fields(conn, schema, table):
-    sql = u"""SELECT a.attnum AS ordinal_position,
-                            a.attname AS column_name,
-                            t.typname AS data_type,
-                            a.attlen AS char_max_len,
-                            a.atttypmod AS modifier,
-                            a.attnotnull AS notnull,
-                            a.atthasdef AS hasdefault,
-                            adef.adsrc AS default_value,
-                            pg_catalog.format_type(a.atttypid,a.atttypmod) AS formatted_type
-                    FROM pg_class c
-                    JOIN pg_attribute a ON a.attrelid = c.oid
-                    JOIN pg_type t ON a.atttypid = t.oid
-                    JOIN pg_namespace nsp ON c.relnamespace = nsp.oid
-                    LEFT JOIN pg_attrdef adef ON adef.adrelid = a.attrelid AND adef.adnum = a.attnum
-                    WHERE
-                      a.attnum > 0 AND c.relname='%s' AND nspname='%s'
-                    ORDER BY a.attnum""" % (table, schema)
-
-    cur = conn.cursor()
-    cur.execute(sql)
-    return cur.fetchall()
+    return get_snapshot(conn).table_fields(schema, table)
 
 
 def get_spatial_tables(conn):
-    sql = """SELECT f_table_schema, f_table_name, f_geometry_column
-             FROM geometry_columns
-             ORDER BY f_table_schema, f_table_name"""
-
-    cur = conn.cursor()
-    cur.execute(sql)
-    return cur.fetchall()
+    return get_snapshot(conn).spatial_tables()
 
 
 def get_schemas(conn):
-    sql = """SELECT oid, nspname
-             FROM pg_namespace
-             WHERE nspname !~ '^pg_' AND nspname != 'information_schema'
-             ORDER BY nspname"""
-    cur = conn.cursor()
-    cur.execute(sql)
-    return cur.fetchall()
+    return get_snapshot(conn).schemas()
 
 
 class MyDelegate(QStyledItemDelegate):
@@ -87,7 +72,8 @@ class MyDelegate(QStyledItemDelegate):
             cbo.setCurrentIndex(self.fields.index(target_attr_name)+1)
 
     def setModelData(self, cbo, model, index):
-        field_name = self.fields[cbo.currentIndex()-1]
+        # index 0 is "[none]" - no target field (or no aggregate: the attribute is copied)
+        field_name = self.fields[cbo.currentIndex()-1] if cbo.currentIndex() >= 1 else "[none]"
         model.setData(index, field_name, Qt.DisplayRole)
 
 
@@ -96,23 +82,31 @@ class TriggerDialog(BASE, WIDGET):
         BASE.__init__(self, parent)
         self.setupUi(self)
         self.conn = conn    # psycopg2 connection to the DB
+        self.trigger_id = sql_gen.trg_fcn_id if sql_gen is not None else None  # ID of the edited pair
+        self.catalog = get_snapshot(conn)  # shared metadata of tables
 
         self.buttonBox.accepted.connect(self.on_ok)
+        self.btnPreview = self.buttonBox.addButton("Preview", QDialogButtonBox.ActionRole)
+        self.btnPreview.setToolTip("Check plans and timings of the trigger's queries on a few existing features")
+        self.btnPreview.clicked.connect(self.preview)
 
         self.model = QStandardItemModel()
         self.treeMapping.setModel(self.model)
         self.delegate = MyDelegate()
         self.treeMapping.setItemDelegateForColumn(1, self.delegate)
+        self.agg_delegate = MyDelegate()
+        self.agg_delegate.fields = AGGREGATES
+        self.treeMapping.setItemDelegateForColumn(2, self.agg_delegate)
 
         # populate source/target schemas
-        for schema_oid, schema_name in get_schemas(conn):
+        for schema_oid, schema_name in self.catalog.schemas():
             self.cboSourceSchema.addItem(schema_name)
             self.cboTargetSchema.addItem(schema_name)
 
         self.cboSourceSchema.currentIndexChanged.connect(self.populate_source_tables)
         self.cboTargetSchema.currentIndexChanged.connect(self.populate_target_tables)
 
-        self.layers = get_spatial_tables(conn)
+        self.layers = self.catalog.spatial_tables()
 
         self.populate_source_tables()
         self.populate_target_tables()
@@ -134,7 +128,7 @@ class TriggerDialog(BASE, WIDGET):
 
         if sql_gen is not None:
             source_schema, source_table = sql_gen.source_table.split('.')
-            source_field_names = [ field[1] for field in get_table_fields(self.conn, source_schema, source_table) ]
+            source_field_names = [ field[1] for field in self.catalog.table_fields(source_schema, source_table) ]
             for source_attr, target_attr in sql_gen.attr_map.items():
                 try:
                     source_field_index = source_field_names.index(source_attr)
@@ -144,6 +138,56 @@ class TriggerDialog(BASE, WIDGET):
                 item.setCheckState(Qt.Checked)
                 item2 = self.treeMapping.model().item(source_field_index, 1)
                 item2.setText(target_attr)
+            for target_attr, (func, source_attr) in sql_gen.agg_map.items():
+                try:
+                    source_field_index = source_field_names.index(source_attr)
+                except ValueError:
+                    continue
+                self.treeMapping.model().item(source_field_index, 0).setCheckState(Qt.Checked)
+                self.treeMapping.model().item(source_field_index, 1).setText(target_attr)
+                self.treeMapping.model().item(source_field_index, 2).setText(func)
+
+            if sql_gen.mode in MODES:
+                self.cboMode.setCurrentIndex(MODES.index(sql_gen.mode))
+            self.chkConsolidate.setChecked(sql_gen.consolidate)
+
+            if sql_gen.predicate in PREDICATES:
+                self.cboPredicate.setCurrentIndex(PREDICATES.index(sql_gen.predicate))
+            self.spinTolerance.setValue(sql_gen.tolerance)
+            if sql_gen.order_by in ORDER_BY:
+                self.cboOrderBy.setCurrentIndex(ORDER_BY.index(sql_gen.order_by))
+            if sql_gen.order_column:
+                self.cboOrderColumn.setCurrentIndex(self.cboOrderColumn.findText(sql_gen.order_column))
+            if sql_gen.overlap in OVERLAP:
+                self.cboOverlap.setCurrentIndex(OVERLAP.index(sql_gen.overlap))
+            self.chkSubdivide.setChecked(sql_gen.subdivide)
+            self.spinSubdivideVertices.setValue(sql_gen.subdivide_vertices)
+
+        # shared triggers are only available for row-level triggers
+        self.cboMode.currentIndexChanged.connect(self.mode_changed)
+        self.mode_changed()
+
+        self.cboPredicate.currentIndexChanged.connect(self.sampling_options_changed)
+        self.cboOrderBy.currentIndexChanged.connect(self.sampling_options_changed)
+        self.cboOverlap.currentIndexChanged.connect(self.sampling_options_changed)
+        self.chkSubdivide.toggled.connect(self.sampling_options_changed)
+        self.sampling_options_changed()
+
+    def mode_changed(self):
+        self.chkConsolidate.setEnabled(MODES[self.cboMode.currentIndex()] == 'row')
+
+    def sampling_options_changed(self):
+        predicate = PREDICATES[self.cboPredicate.currentIndex()]
+        self.spinTolerance.setEnabled(predicate in ('dwithin', 'nearest'))
+        # the nearest feature is always used
+        self.cboOverlap.setEnabled(predicate != 'nearest')
+        overlap = self.cboOverlap.isEnabled() and OVERLAP[self.cboOverlap.currentIndex()] != ''
+        # the overlap decides which feature is used
+        self.cboOrderBy.setEnabled(predicate != 'nearest' and not overlap)
+        self.cboOrderColumn.setEnabled(self.cboOrderBy.isEnabled() and ORDER_BY[self.cboOrderBy.currentIndex()] in ('column', 'column_desc'))
+        # containment and overlaps cannot be evaluated on pieces of the source geometry
+        self.chkSubdivide.setEnabled(predicate not in ('contains', 'covers') and not overlap)
+        self.spinSubdivideVertices.setEnabled(self.chkSubdivide.isEnabled() and self.chkSubdivide.isChecked())
 
     def populate_source_tables(self):
         current_schema = self.cboSourceSchema.currentText()
@@ -162,19 +206,21 @@ class TriggerDialog(BASE, WIDGET):
     def populate_source_attrs(self):
 
         self.model.clear()
-        self.model.setHorizontalHeaderLabels(["Source field", "Target field"])
+        self.model.setHorizontalHeaderLabels(["Source field", "Target field", "Aggregate"])
+        self.cboOrderColumn.clear()
 
         current_schema = self.cboSourceSchema.currentText()
         current_table = self.cboSourceTable.currentText()
         if not current_schema or not current_table:
             return
 
-        fields = get_table_fields(self.conn, current_schema, current_table)
+        fields = self.catalog.table_fields(current_schema, current_table)
         for field in fields:
             item = QStandardItem(field[1])
             item.setCheckable(True)
             item.setEditable(False)
-            self.model.appendRow([item, QStandardItem("[none]")])
+            self.model.appendRow([item, QStandardItem("[none]"), QStandardItem("[none]")])
+            self.cboOrderColumn.addItem(field[1])
 
         self.treeMapping.resizeColumnToContents(0)
 
@@ -186,47 +232,112 @@ class TriggerDialog(BASE, WIDGET):
             self.delegate.fields = []
             return
 
-        fields = get_table_fields(self.conn, current_schema, current_table)
+        fields = self.catalog.table_fields(current_schema, current_table)
         self.delegate.fields = [ field[1] for field in fields ]
 
     def to_sql_generator(self):
         """Populate and return SqlGenerator instance from trigger dialog"""
         sql_gen = SqlGenerator()
+        sql_gen.trg_fcn_id = self.trigger_id  # None for a new pair
         sql_gen.source_table = self.cboSourceSchema.currentText() + "." + self.cboSourceTable.currentText()
         sql_gen.target_table = self.cboTargetSchema.currentText() + "." + self.cboTargetTable.currentText()
         # mapping
         sql_gen.attr_map = {}
+        sql_gen.agg_map = {}
         for row in range(self.model.rowCount()):
             if self.model.item(row, 0).checkState() == Qt.Checked:
                 source_attr = self.model.item(row, 0).text()
                 target_attr = self.model.item(row, 1).text()
-                sql_gen.attr_map[source_attr] = target_attr
+                func = self.model.item(row, 2).text()
+                if func in AGGREGATES:
+                    sql_gen.agg_map[target_attr] = [func, source_attr]
+                else:
+                    sql_gen.attr_map[source_attr] = target_attr
+        sql_gen.mode = MODES[self.cboMode.currentIndex()]
+        sql_gen.consolidate = self.chkConsolidate.isEnabled() and self.chkConsolidate.isChecked()
+        sql_gen.predicate = PREDICATES[self.cboPredicate.currentIndex()]
+        sql_gen.tolerance = self.spinTolerance.value()
+        sql_gen.order_by = ORDER_BY[self.cboOrderBy.currentIndex()]
+        if sql_gen.order_by in ('column', 'column_desc'):
+            sql_gen.order_column = self.cboOrderColumn.currentText()
+        if self.cboOverlap.isEnabled():
+            sql_gen.overlap = OVERLAP[self.cboOverlap.currentIndex()]
+        if self.chkSubdivide.isEnabled() and self.chkSubdivide.isChecked():
+            sql_gen.subdivide = True
+            sql_gen.subdivide_vertices = self.spinSubdivideVertices.value()
+            sql_gen.source_key = self.catalog.primary_key(sql_gen.source_table, integer_only=False)
         return sql_gen
 
     def on_ok(self):
-        """ Do some sanity checks before accepting the dialog """
+        if self.validate() and offer_missing_indexes(self, self.conn, [self.to_sql_generator()]):
+            self.accept()
+
+    def validate(self):
+        """ Do some sanity checks of the configuration, returns False (with a warning) if it is not valid """
 
         if self.cboSourceTable.currentText() == self.cboTargetTable.currentText() and \
            self.cboSourceSchema.currentText() == self.cboTargetSchema.currentText():
             QMessageBox.warning(self, "Warning", "Source and target tables must be different.")
-            return
+            return False
 
         # at least one attribute must be checked
         has_checked_item = False
         has_chosen_target_attrs = True
+        funcs = set()
         for row in range(self.model.rowCount()):
             if self.model.item(row, 0).checkState() == Qt.Checked:
                 has_checked_item = True
 
                 if self.model.item(row, 1).text() == "[none]":
                     has_chosen_target_attrs = False
+                funcs.add(self.model.item(row, 2).text() in AGGREGATES)
 
         if not has_checked_item:
             QMessageBox.warning(self, "Warning", "At least one attribute must be checked.")
-            return
+            return False
 
         if not has_chosen_target_attrs:
             QMessageBox.warning(self, "Warning", "All checked attributes must have a target attribute.")
+            return False
+
+        if len(funcs) > 1:
+            QMessageBox.warning(self, "Warning", "Copied and aggregated attributes cannot be mixed in one trigger.")
+            return False
+
+        if self.cboOverlap.isEnabled() and OVERLAP[self.cboOverlap.currentIndex()] == 'weighted' and True not in funcs:
+            field_types = dict((field[1], field[2]) for field in self.catalog.table_fields(
+                self.cboSourceSchema.currentText(), self.cboSourceTable.currentText()))
+            for row in range(self.model.rowCount()):
+                if self.model.item(row, 0).checkState() == Qt.Checked and \
+                   field_types.get(self.model.item(row, 0).text()) not in NUMERIC_TYPES:
+                    QMessageBox.warning(self, "Warning", "Overlap-weighted average can be used only with numeric attributes.")
+                    return False
+
+        if True in funcs and PREDICATES[self.cboPredicate.currentIndex()] == 'nearest':
+            QMessageBox.warning(self, "Warning", "Aggregates cannot be used with the nearest feature.")
+            return False
+
+        if self.chkSubdivide.isEnabled() and self.chkSubdivide.isChecked():
+            source_table = self.cboSourceSchema.currentText() + "." + self.cboSourceTable.currentText()
+            if self.catalog.primary_key(source_table, integer_only=False) is None:
+                QMessageBox.warning(self, "Warning", "Subdivided source geometries need a single-column primary key in the source table.")
+                return False
+
+        return True
+
+    def preview(self):
+        """ Shows plans and timings of the trigger's queries on a few existing features """
+        if not self.validate():
+            return
+        sql_gen = self.to_sql_generator()
+        try:
+            result = run_task(self, self.conn, "Checking the trigger's queries...",
+                              lambda task: preview_pair(self.conn, sql_gen, analyze=True))
+        except TaskCanceled:
             return
+        text = "\n".join(result.describe())
+        if result.warnings or result.errors:
+            QMessageBox.warning(self, "Preview", text)
+        else:
+            QMessageBox.information(self, "Preview", text)
 
-        self.accept()
@@ -0,0 +1,34 @@
+# encoding: utf-8
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+"""
+Loading of the dialogs' UI classes.
+
+Packages built by "package.sh --compile-ui" contain modules pre-compiled by pyuic5 in the ui_compiled
+directory, which are imported much faster than compiling the .ui files with uic at runtime.
+"""
+
+import importlib
+import os
+
+this_dir = os.path.dirname(__file__)
+
+
+def load_ui(name):
+    """Returns tuple (form class, base class) for the name.ui file - same as uic.loadUiType()"""
+    try:
+        module = importlib.import_module('.ui_compiled.%s' % name, __package__)
+    except ImportError:
+        from qgis.PyQt import uic
+        return uic.loadUiType(os.path.join(this_dir, name + '.ui'))
+
+    from qgis.PyQt.QtWidgets import QDialog
+    form_class = [getattr(module, attr) for attr in dir(module) if attr.startswith('Ui_')][0]
+    return form_class, QDialog   # all dialogs of the plugin are based on QDialog
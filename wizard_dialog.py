@@ -11,17 +11,21 @@
 # ---------------------------------------------------------------------
 
 import os
-from qgis.PyQt import uic
 
 from qgis.PyQt.QtCore import *
 from qgis.PyQt.QtGui import QStandardItemModel, QStandardItem
 
-from .trigger_dialog import get_schemas, get_spatial_tables, get_table_fields
-from .sql_generator import SqlGenerator, list_uic_geom_fields
+from .sql_generator import SqlGenerator
+from .catalog import get_snapshot
+from .ui_loader import load_ui
+from .matching import match_names, rules_from_option
+from .indexes import offer_missing_indexes
 
 this_dir = os.path.dirname(__file__)
 
-WIDGET, BASE = uic.loadUiType(os.path.join(this_dir, 'wizard_dialog.ui'))
+WIDGET, BASE = load_ui('wizard_dialog')
+
+FILTER_DELAY = 300  # ms
 
 
 class WizardDialog(BASE, WIDGET):
@@ -30,30 +34,43 @@ class WizardDialog(BASE, WIDGET):
         self.setupUi(self)
 
         self.conn = conn
+        self.catalog = get_snapshot(conn)  # shared metadata of tables
 
         self.table_model = QStandardItemModel()
         self.tableView.setModel(self.table_model)
 
-        for schema_oid, schema_name in get_schemas(conn):
+        for schema_oid, schema_name in self.catalog.schemas():
             self.cboSourceSchema.addItem(schema_name)
             self.cboTargetSchema.addItem(schema_name)
 
-        self.ignore_attr = list_uic_geom_fields(self.conn)
+        self.ignore_attr = self.catalog.uic_geom_fields()
 
         self.cboSourceSchema.currentIndexChanged.connect(self.populate_tables)
         self.cboTargetSchema.currentIndexChanged.connect(self.populate_tables)
 
-        self.tableFld.textChanged.connect(self.populate_tables)
+        # filter edits are applied after a short pause in typing
+        self.table_timer = QTimer(self)
+        self.table_timer.setSingleShot(True)
+        self.table_timer.setInterval(FILTER_DELAY)
+        self.table_timer.timeout.connect(self.populate_tables)
+        self.field_timer = QTimer(self)
+        self.field_timer.setSingleShot(True)
+        self.field_timer.setInterval(FILTER_DELAY)
+        self.field_timer.timeout.connect(self.populate_fields)
+
+        self.tableFld.textChanged.connect(self.table_timer.start)
         self.tableFld.setVisible(self.cboTablesOpt.currentIndex() != 0)
         self.cboTablesOpt.currentIndexChanged.connect(self.table_search_option_changed)
 
-        self.attrFld.textChanged.connect(self.populate_tables)
+        self.attrFld.textChanged.connect(self.field_timer.start)
         self.attrFld.setVisible(self.cboFieldsOpt.currentIndex() != 0)
         self.cboFieldsOpt.currentIndexChanged.connect(self.field_search_option_changed)
 
-        self.layers = get_spatial_tables(conn)
+        self.chkCaseInsensitive.stateChanged.connect(self.populate_tables)
+
+        self.layers = self.catalog.spatial_tables()
         self.doSampleCheck.setCheckState(Qt.Checked)
-        self.doSampleCheck.stateChanged.connect(self.populate_tables)
+        self.doSampleCheck.stateChanged.connect(self.populate_fields)
 
         self.populate_tables()
 
@@ -63,21 +80,15 @@ class WizardDialog(BASE, WIDGET):
 
     def field_search_option_changed(self, index):
         self.attrFld.setVisible(index != 0)
-        self.populate_tables()
+        self.populate_fields()
 
-    # TODO support for regex??
-    def filter_prefix_suffix(self, list, prefix, suffix):
-        result = []
-        ix = 0
-        for item in list:
-            if prefix and item.startswith(prefix):
-                item = item.replace(prefix, "", 1)
-            if suffix and item.endswith(suffix):
-                item = "".join(item.rsplit(suffix, 1))
-
-            result.append(item)
-            ix += 1
-        return result
+    def table_rules(self):
+        return rules_from_option(self.cboTablesOpt.currentIndex(), self.tableFld.text(),
+                                 self.chkCaseInsensitive.isChecked())
+
+    def field_rules(self):
+        return rules_from_option(self.cboFieldsOpt.currentIndex(), self.attrFld.text(),
+                                 self.chkCaseInsensitive.isChecked())
 
     def update_table_model(self, pairs):
         self.table_model.clear()
@@ -97,48 +108,38 @@ class WizardDialog(BASE, WIDGET):
         self.tableView.resizeColumnToContents(0)
 
     def populate_tables(self):
+        self.table_timer.stop()
         tabs1 = self.get_tables(self.cboSourceSchema.currentText())
         tabs2 = self.get_tables(self.cboTargetSchema.currentText())
 
-        prefix_source = self.tableFld.text() if self.cboTablesOpt.currentIndex() == 1 else ""
-        suffix_source = self.tableFld.text() if self.cboTablesOpt.currentIndex() == 2 else ""
-        prefix_target = self.tableFld.text() if self.cboTablesOpt.currentIndex() == 3 else ""
-        suffix_target = self.tableFld.text() if self.cboTablesOpt.currentIndex() == 4 else ""
-
-        tab11, tab22 = self.get_similar(tabs1, tabs2, prefix_source, suffix_source, prefix_target, suffix_target)
-
-        source = [elem for (elem, schema) in tab11]
-        target = [elem for (elem, schema) in tab22]
-
-        pairs = [(source[ix], target[ix]) for ix in range(len(source))]
+        pairs = match_names(tabs1, tabs2, *self.table_rules())
         self.update_table_model(pairs)
-        self.populate_attr(pairs)
+        self.populate_fields()
         self.tableView.resizeColumnToContents(0)
 
-    def populate_attr(self, pairs):
-
-        all_field_pairs = {}
-        for source_tab, target_tab in pairs:
-            fields1 = self.get_attr(self.cboSourceSchema.currentText(), source_tab)
-            fields2 = self.get_attr(self.cboTargetSchema.currentText(), target_tab)
-
-            prefix_source = self.attrFld.text() if self.cboFieldsOpt.currentIndex() == 1 else ""
-            suffix_source = self.attrFld.text() if self.cboFieldsOpt.currentIndex() == 2 else ""
-            prefix_target = self.attrFld.text() if self.cboFieldsOpt.currentIndex() == 3 else ""
-            suffix_target = self.attrFld.text() if self.cboFieldsOpt.currentIndex() == 4 else ""
+    def populate_fields(self):
+        """Pairs fields of the listed table pairs again (table pairs are kept)"""
+        self.field_timer.stop()
+        source_schema = self.cboSourceSchema.currentText()
+        target_schema = self.cboTargetSchema.currentText()
+        source_rule, target_rule = self.field_rules()
 
-            tab11, tab22 = self.get_similar(fields1, fields2, prefix_source,suffix_source, prefix_target, suffix_target)
-
-            source = [elem for (elem, schema) in tab11]
-            target = [elem for (elem, schema) in tab22]
-
-            field_pairs = [(source[ix], target[ix]) for ix in range(len(source))]
-            all_field_pairs[source_tab] = field_pairs
-
-        self.update_field_model(all_field_pairs)
+        for row in range(self.table_model.rowCount()):
+            item = self.table_model.item(row)
+            fields1 = self.get_attr(source_schema, item.text())
+            fields2 = self.get_attr(target_schema, self.table_model.item(row, 1).text())
+            item.removeRows(0, item.rowCount())
+            for source, target in match_names(fields1, fields2, source_rule, target_rule):
+                item_0 = QStandardItem(source)
+                item_0.setCheckable(True)
+                item_0.setCheckState(Qt.Checked)
+                item_1 = QStandardItem(target)
+                for i in [item_0, item_1]:
+                    i.setEditable(False)
+                item.appendRow([item_0, item_1])
 
     def get_attr(self, schema, table):
-        fields = get_table_fields(self.conn, schema, table)
+        fields = self.catalog.table_fields(schema, table)
         return [elem[1] for elem in fields if self.is_not_ignored_attr(elem[1], schema, table)]
 
     def is_not_ignored_attr(self, item, schema, table):
@@ -147,25 +148,6 @@ class WizardDialog(BASE, WIDGET):
         else:
             return True
 
-    def get_similar(self, tabs1, tabs2, prefix1, suffix1, prefix2, suffix2):
-        fil_tab1 = self.filter_prefix_suffix(tabs1, prefix1, suffix1)
-        fil_tab2 = self.filter_prefix_suffix(tabs2, prefix2, suffix2)
-        pairs = []
-        for ix in range(len(fil_tab1)):
-            item = fil_tab1[ix]
-            if item in fil_tab2:
-                indices = [i for i, x in enumerate(fil_tab2) if x == item]
-                for ix2 in indices:
-                    if not self.have_prefix_suffix(tabs1[ix], tabs2[ix2], prefix1, suffix1, prefix2,
-                            suffix2): continue
-                    pairs.append((ix, ix2))
-        tab11 = [(tabs1[ix], self.cboSourceSchema.currentText()) for ix, ix2 in pairs]
-        tab22 = [(tabs2[ix2], self.cboTargetSchema.currentText()) for ix, ix2 in pairs]
-        return tab11, tab22
-
-    def have_prefix_suffix(self, src, trg, prefix1, suffix1, prefix2, suffix2):
-        return src.startswith(prefix1) and src.endswith(suffix1) and trg.startswith(prefix2) and trg.endswith(suffix2)
-
     def get_tables(self, current_schema):
         tables = []
         for schema, table, geom in self.layers:
@@ -173,31 +155,9 @@ class WizardDialog(BASE, WIDGET):
                 tables.append(table)
         return tables
 
-    def update_field_model(self, pairs):
-        row = self.table_model.rowCount()
-        for ix in range(0, row):
-            content = self.table_model.data(self.table_model.index(ix, 0))
-            related_table_item = self.table_model.item(ix)
-            if content in pairs:
-                attrs = pairs[content]
-                #if self.is_uic_attr(attrs): continue
-
-                for source, target in attrs:
-                    item_0 = QStandardItem(source)
-                    item_0.setCheckable(True)
-                    item_0.setCheckState(Qt.Checked)
-                    item_1 = QStandardItem(target)
-                    for i in [item_0, item_1]:
-                        i.setEditable(False)
-                    related_table_item.appendRow([item_0, item_1])
-    # def is_uic_attr(self, attrs):
-    #     source = attrs[0]
-    #     target = attrs[1]
-
-
-
     def single_sgl_generator(self, source_table, target_table, parent_item):
         sql_gen = SqlGenerator()
+        sql_gen.trg_fcn_id = None  # new pair, its ID is allocated when it is installed
         sql_gen.source_table = self.cboSourceSchema.currentText() + "." + source_table
         sql_gen.target_table = self.cboTargetSchema.currentText() + "." + target_table
         # mapping
@@ -228,3 +188,8 @@ class WizardDialog(BASE, WIDGET):
 
         return generators
 
+
+    def accept(self):
+        """ Offers to create indexes missing for the configured pairs before the dialog is closed """
+        if offer_missing_indexes(self, self.conn, self.to_sql_generator()):
+            BASE.accept(self)